@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+"""
+Fair sharing of write bandwidth between installations running at the same time
+
+Targets are grouped by the USB host controller they hang off (read from sysfs).  Every controller has a
+bandwidth budget, by default derived from the speed of its root hub, which is divided between the jobs writing
+through it by max-min fairness: jobs that can't use their equal share (slow sticks) keep what they use, the rest
+is split between the others.  Shares are rebalanced periodically and whenever a job starts or finishes, so the
+fastest stick can't starve the slow ones and nobody's bandwidth is left unused.
+
+Writers ask for permission before every write through BandwidthShare.consume(), which sleeps as long as the token
+buckets of the job and of its controller require.
+"""
+
+import os
+import re
+import time
+import threading
+
+#: Share of the nominal USB speed that is usable for bulk transfers
+USB_EFFICIENCY = 0.7
+
+#: Seconds between two rebalancing passes
+REBALANCE_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """
+    Reservation based token bucket, callers are told how long to wait instead of being blocked under a lock
+    """
+
+    def __init__(self, rate=None, burst=1.0):
+        """
+        :param rate: Bytes per second, None means unlimited
+        :param burst: Seconds worth of rate that can be spent at once after being idle
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+
+    def reserve(self, amount):
+        """
+        Take amount tokens, going into debt if there aren't enough
+
+        :param amount: Bytes about to be written
+        :return: Seconds the caller has to wait before writing
+        """
+        with self._lock:
+            self._refill()
+            if self.rate is None:
+                return 0.0
+
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self._tokens = min(self._tokens + (now - self._last) * self.rate, self.rate * self.burst)
+        self._last = now
+
+
+class BandwidthShare:
+    """
+    Bandwidth of a single job, obtained from BandwidthScheduler.register()
+    """
+
+    def __init__(self, scheduler, name, controller):
+        self.scheduler = scheduler
+        self.name = name
+        self.controller = controller
+        self.bucket = TokenBucket()
+
+        #: Bytes written and seconds spent throttled since the last rebalance
+        self.written = 0
+        self.throttled = 0.0
+
+    def consume(self, amount):
+        """
+        Wait until amount bytes may be written
+
+        :param amount: Bytes about to be written
+        """
+        delay = max(self.bucket.reserve(amount), self.scheduler.controller_bucket(self.controller).reserve(amount))
+        self.written += amount
+        self.throttled += delay
+
+        if delay > 0:
+            time.sleep(delay)
+        self.scheduler.maybe_rebalance()
+
+    def release(self):
+        self.scheduler.unregister(self)
+
+
+class BandwidthScheduler:
+    """
+    Shares bandwidth of USB controllers between the jobs writing through them
+    """
+
+    def __init__(self, controller_bandwidth=None, job_bandwidth=None):
+        """
+        :param controller_bandwidth: Budget of every controller in bytes per second, None derives it from the
+            speed of the controller's root hub
+        :param job_bandwidth: Upper limit of every job in bytes per second, None means unlimited
+        """
+        self.controller_bandwidth = controller_bandwidth
+        self.job_bandwidth = job_bandwidth
+
+        self.shares = []
+        self._controllers = {}
+        self._last_rebalance = time.monotonic()
+        self._lock = threading.Lock()
+
+    def register(self, name, target_device):
+        """
+        :param name: Name of the job, shown in status()
+        :param target_device: Block device the job writes to, e.g. /dev/sdb
+        :return: BandwidthShare
+        """
+        controller = usb_controller(target_device)
+        share = BandwidthShare(self, name, controller)
+
+        with self._lock:
+            if controller not in self._controllers:
+                self._controllers[controller] = TokenBucket()
+            self.shares.append(share)
+            self._rebalance()
+        return share
+
+    def unregister(self, share):
+        with self._lock:
+            self.shares.remove(share)
+            self._rebalance()
+
+    def set_limits(self, controller_bandwidth=None, job_bandwidth=None):
+        """
+        Change the limits while jobs are running, see __init__()
+        """
+        with self._lock:
+            self.controller_bandwidth = controller_bandwidth
+            self.job_bandwidth = job_bandwidth
+            self._rebalance()
+
+    def controller_bucket(self, controller):
+        return self._controllers[controller]
+
+    def maybe_rebalance(self):
+        if time.monotonic() - self._last_rebalance < REBALANCE_INTERVAL:
+            return
+
+        with self._lock:
+            if time.monotonic() - self._last_rebalance >= REBALANCE_INTERVAL:
+                self._rebalance()
+
+    def status(self):
+        """
+        :return: Current limits and the rate every job has been given, in bytes per second
+        """
+        with self._lock:
+            return dict(controller_bandwidth=self.controller_bandwidth, job_bandwidth=self.job_bandwidth,
+                        controllers={str(controller): bucket.rate for controller, bucket in self._controllers.items()},
+                        jobs={share.name: dict(controller=share.controller, rate=share.bucket.rate)
+                              for share in self.shares})
+
+    def _rebalance(self):
+        now = time.monotonic()
+        interval = max(now - self._last_rebalance, 1e-3)
+        self._last_rebalance = now
+
+        for controller, bucket in self._controllers.items():
+            shares = [share for share in self.shares if share.controller == controller]
+            capacity = self._controller_capacity(controller)
+            bucket.set_rate(capacity)
+
+            # A job that wasn't held back used all it could, so its demand is what it wrote, with some room to grow
+            demands = []
+            for share in shares:
+                if share.written and share.throttled < interval * 0.1:
+                    demands.append(share.written / interval * 1.2)
+                else:
+                    demands.append(None)
+                share.written = 0
+                share.throttled = 0.0
+
+            for share, rate in zip(shares, _max_min_fair(capacity, demands)):
+                if self.job_bandwidth is not None:
+                    rate = self.job_bandwidth if rate is None else min(rate, self.job_bandwidth)
+                share.bucket.set_rate(rate)
+
+    def _controller_capacity(self, controller):
+        if controller is None:
+            return None  # Topology unknown, nothing to share
+        if self.controller_bandwidth is not None:
+            return self.controller_bandwidth
+        return usb_controller_speed(controller)
+
+
+def _max_min_fair(capacity, demands):
+    """
+    Split capacity between demands, smallest demands are satisfied first and the rest is divided equally
+
+    :param capacity: Bytes per second to be divided, None means unlimited
+    :param demands: Bytes per second every job can use, None for jobs that can use anything
+    :return: List of rates, None meaning unlimited
+    """
+    if capacity is None:
+        return [None] * len(demands)
+
+    rates = [None] * len(demands)
+    pending = sorted(range(len(demands)), key=lambda index: float("inf") if demands[index] is None else demands[index])
+    remaining = capacity
+
+    while pending:
+        equal_share = remaining / len(pending)
+        index = pending[0]
+        if demands[index] is not None and demands[index] < equal_share:
+            rates[index] = demands[index]
+            remaining -= demands[index]
+            pending.pop(0)
+        else:
+            for index in pending:
+                rates[index] = equal_share
+            break
+
+    return rates
+
+
+def usb_controller(device):
+    """
+    USB host controller a block device is attached to
+
+    :param device: Block device or partition, e.g. /dev/sdb or /dev/sdb1
+    :return: sysfs path of the controller's root hub, None if the device isn't on USB or can't be found
+    """
+    if device is None:
+        return None
+
+    name = os.path.basename(device)
+    if not os.path.exists("/sys/class/block/" + name):
+        return None
+
+    # Partitions live in a subdirectory of their device, the path still goes through the controller
+    path = os.path.realpath("/sys/class/block/" + name)
+    match = re.search(r"^(.*?/usb[0-9]+)/", path)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def usb_controller_speed(controller):
+    """
+    :param controller: Path returned by usb_controller()
+    :return: Usable bandwidth of the controller in bytes per second, None if unknown
+    """
+    try:
+        with open(os.path.join(controller, "speed")) as speed:
+            megabits = float(speed.read().strip())
+    except (OSError, ValueError):
+        return None
+
+    return megabits * 1000 * 1000 / 8 * USB_EFFICIENCY
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""
+Read-only block device served from a Python reader through the kernel's NBD (network block device) driver
+
+Sources that only exist as a byte stream to us (an ISO on a web server, a compressed ISO) are exported as
+/dev/nbdN, so they are mounted like any other source.  The device is configured with ioctls on a socketpair, no
+nbd-client or server process is needed: the kernel sends read requests into one end, a thread answers them from
+the reader, several of them in parallel so kernel readahead turns into parallel fetches.
+
+Readers provide a size attribute and read(offset, length) returning up to length bytes, safe to call from several
+threads at once.  BlockReader implements this for sources read in blocks (ranges of a remote file, frames of a
+compressed file).
+"""
+
+import os
+import errno
+import fcntl
+import bisect
+import socket
+import struct
+import threading
+import subprocess
+import collections
+import concurrent.futures
+
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+#: ioctls of <linux/nbd.h>
+NBD_SET_SOCK = 0xab00
+NBD_SET_BLKSIZE = 0xab01
+NBD_DO_IT = 0xab03
+NBD_CLEAR_SOCK = 0xab04
+NBD_CLEAR_QUE = 0xab05
+NBD_SET_SIZE_BLOCKS = 0xab07
+NBD_DISCONNECT = 0xab08
+NBD_SET_FLAGS = 0xab0a
+
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_READ_ONLY = 1 << 1
+
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+NBD_CMD_READ = 0
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+
+#: magic, type, handle, offset, length
+_REQUEST = struct.Struct(">II8sQI")
+#: magic, error, handle
+_REPLY = struct.Struct(">II8s")
+
+BLOCK_SIZE = 512
+
+
+class BlockReader:
+    """
+    Reader of a source made of blocks, each loaded once on demand, see load_block()
+
+    Blocks are loaded by a pool of threads into a bounded cache, least recently used blocks are dropped.  A read
+    continuing a sequential stream loads the blocks following it ahead of time.
+    """
+
+    def __init__(self, size, block_offsets, cache_blocks, prefetch_blocks, workers):
+        """
+        :param size: Size of the source
+        :param block_offsets: Ascending start offsets of the blocks, the first one is 0 (a sequence, e.g. a range)
+        :param cache_blocks: Blocks kept in memory, at least prefetch_blocks
+        :param prefetch_blocks: Blocks loaded ahead of a sequential read, 0 disables prefetch
+        :param workers: Blocks loaded in parallel
+        """
+        self.size = size
+        self.block_offsets = block_offsets
+        self.cache_blocks = max(cache_blocks, prefetch_blocks + 1)
+        self.prefetch_blocks = prefetch_blocks
+        self.workers = workers
+
+        self._lock = threading.Lock()
+        #: Block index -> data, least recently used first
+        self._cache = collections.OrderedDict()
+        #: Block index -> Future of a load in flight
+        self._pending = {}
+        #: Block a sequential read would continue with
+        self._next_block = 0
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def load_block(self, index):
+        """
+        :return: Data of block index, called from the threads of the pool
+        :raise OSError: Block can't be loaded
+        """
+        raise NotImplementedError
+
+    def read(self, offset, length):
+        """
+        :return: Up to length bytes at offset, less only at the end of the source
+        :raise OSError: Block can't be loaded
+        """
+        length = max(0, min(length, self.size - offset))
+        if length == 0:
+            return b""
+
+        first = bisect.bisect_right(self.block_offsets, offset) - 1
+        last = bisect.bisect_right(self.block_offsets, offset + length - 1) - 1
+        futures = [self._block(index) for index in range(first, last + 1)]
+
+        # Readers run in parallel, a read slightly behind the stream still continues it
+        with self._lock:
+            sequential = self._next_block - self.prefetch_blocks <= first <= self._next_block
+            self._next_block = max(self._next_block, last + 1) if sequential else last + 1
+        if sequential:
+            for index in range(last + 1, min(last + 1 + self.prefetch_blocks, len(self.block_offsets))):
+                self._block(index)
+
+        data = b"".join(future.result() for future in futures)
+        start = offset - self.block_offsets[first]
+        return data[start:start + length]
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            self._cache.clear()
+
+    def _block(self, index):
+        """
+        :return: Future of the data of a block, loaded unless cached or in flight already
+        """
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                future = concurrent.futures.Future()
+                future.set_result(self._cache[index])
+                return future
+
+            if index not in self._pending:
+                self._pending[index] = self._pool.submit(self._load, index)
+            return self._pending[index]
+
+    def _load(self, index):
+        try:
+            data = self.load_block(index)
+        except Exception:
+            with self._lock:
+                del self._pending[index]
+            raise
+
+        with self._lock:
+            del self._pending[index]
+            self._cache[index] = data
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return data
+
+
+class BlockExport:
+    """
+    A reader exported as a read-only NBD device
+    """
+
+    def __init__(self, reader, workers=4):
+        """
+        :param reader: Object with size and read(offset, length), see module documentation
+        :param workers: Read requests served in parallel
+        """
+        self.reader = reader
+        self.workers = workers
+
+        #: Path of the device, set by attach()
+        self.device = None
+
+        self._fd = None
+        self._sockets = None
+        self._threads = []
+        self._send_lock = threading.Lock()
+
+    def attach(self):
+        """
+        Export the reader through a free NBD device
+
+        :return: Path of the device
+        :raise OSError: NBD isn't available or the device can't be configured
+        """
+        device = _free_device()
+        fd = os.open(device, os.O_RDWR)
+        kernel_socket, server_socket = socket.socketpair()
+
+        try:
+            fcntl.ioctl(fd, NBD_CLEAR_SOCK)
+            fcntl.ioctl(fd, NBD_SET_BLKSIZE, BLOCK_SIZE)
+            fcntl.ioctl(fd, NBD_SET_SIZE_BLOCKS, (self.reader.size + BLOCK_SIZE - 1) // BLOCK_SIZE)
+            fcntl.ioctl(fd, NBD_SET_FLAGS, NBD_FLAG_HAS_FLAGS | NBD_FLAG_READ_ONLY)
+            fcntl.ioctl(fd, NBD_SET_SOCK, kernel_socket.fileno())
+        except OSError:
+            os.close(fd)
+            kernel_socket.close()
+            server_socket.close()
+            raise
+
+        self.device = device
+        self._fd = fd
+        self._sockets = (kernel_socket, server_socket)
+
+        self._threads = [threading.Thread(target=self._do_it, daemon=True),
+                         threading.Thread(target=self.serve, args=(server_socket,), daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return device
+
+    def detach(self):
+        """
+        Disconnect the device, it must not be mounted anymore
+        """
+        if self._fd is None:
+            return
+
+        try:
+            fcntl.ioctl(self._fd, NBD_DISCONNECT)
+        except OSError:
+            pass
+        for thread in self._threads:
+            thread.join(timeout=10)
+
+        try:
+            fcntl.ioctl(self._fd, NBD_CLEAR_QUE)
+            fcntl.ioctl(self._fd, NBD_CLEAR_SOCK)
+        except OSError:
+            pass
+
+        os.close(self._fd)
+        for sock in self._sockets:
+            sock.close()
+        self._fd = None
+        self._threads = []
+
+    def serve(self, sock):
+        """
+        Answer the kernel's requests arriving on sock until it disconnects
+
+        :param sock: Server end of the socket handed to the kernel
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            while True:
+                header = _receive(sock, _REQUEST.size)
+                if header is None:
+                    break
+
+                magic, request_type, handle, offset, length = _REQUEST.unpack(header)
+                if magic != NBD_REQUEST_MAGIC:
+                    break
+
+                command = request_type & 0xffff
+                if command == NBD_CMD_READ:
+                    pool.submit(self._read, sock, handle, offset, length)
+                elif command == NBD_CMD_DISC:
+                    break
+                elif command == NBD_CMD_FLUSH:
+                    self._reply(sock, handle, 0)
+                else:
+                    self._reply(sock, handle, errno.EPERM)  # Read-only
+
+    def _read(self, sock, handle, offset, length):
+        try:
+            data = self.reader.read(offset, length)
+        except Exception:
+            self._reply(sock, handle, errno.EIO)
+            return
+
+        # The device is rounded up to whole blocks, the reader ends before it
+        self._reply(sock, handle, 0, data + bytes(length - len(data)))
+
+    def _reply(self, sock, handle, error, data=b""):
+        with self._send_lock:
+            try:
+                sock.sendall(_REPLY.pack(NBD_REPLY_MAGIC, error, handle) + data)
+            except OSError:
+                pass  # Disconnected
+
+    def _do_it(self):
+        try:
+            fcntl.ioctl(self._fd, NBD_DO_IT)
+        except OSError:
+            pass  # Ends with an error once disconnected
+
+
+def _receive(sock, length):
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _free_device():
+    """
+    :return: Path of an NBD device without a connection, loading the nbd kernel module if needed
+    :raise OSError: No device is free
+    """
+    if not os.path.exists("/sys/block/nbd0"):
+        subprocess.run(["modprobe", "nbd"], stderr=subprocess.DEVNULL)
+
+    index = 0
+    while os.path.exists("/sys/block/nbd" + str(index)):
+        if not os.path.exists("/sys/block/nbd" + str(index) + "/pid"):
+            return "/dev/nbd" + str(index)
+        index += 1
+
+    raise OSError(errno.ENODEV, _("No free NBD device, is the nbd kernel module available?"))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+Quick check that a target device really stores what it advertises
+
+Counterfeit sticks report a capacity much larger than the flash they contain, writes beyond the real capacity are
+silently dropped or wrap around onto lower addresses.  Such a stick only fails after a full copy, or worse, when
+Windows Setup reads a corrupted file.  This samples the whole advertised capacity instead: unique tagged samples
+are written at offsets spread over the device (including its very end) bypassing the page cache, then all of them
+are read back.  A sample overwritten through wrap-around holds the tag of the sample that overwrote it.  The real
+capacity of fakes is a power of two, so samples are a power of two apart: whatever the real capacity, the samples
+beyond it wrap onto samples below it.  Read-only sticks (write protect switch, worn out flash in read-only mode)
+are caught by the same writes.
+
+The controller of a stick caches writes, so a few hundred KiB of samples could all be read back from its cache
+even though the flash behind it dropped them.  At least MINIMAL_CHECKED_SIZE of samples are written, more than
+such caches hold, and read back in the order they were written, the oldest ones first, which are the least likely
+to be cached.  Samples are as big as the write granularity of the device (see sample_size()), a smaller write costs
+a slow stick as much time anyway.  Writes stop at TIME_BUDGET, the samples are written coarse to fine (see
+write_order()) so that those written by then still cover the whole device a power of two apart.
+"""
+
+import os
+import mmap
+import time
+import random
+import struct
+import hashlib
+
+#: Minimal amount of samples spread over the device, see sample_offsets()
+SAMPLES = 64
+
+#: Size of one sample when the device gives no hint of its write granularity, see sample_size()
+SAMPLE_SIZE = 128 * 1024
+MINIMAL_SAMPLE_SIZE = 64 * 1024
+MAXIMAL_SAMPLE_SIZE = 1024 * 1024
+
+#: Samples written before TIME_BUDGET may end the writes, more than the write cache of USB flash controllers
+MINIMAL_CHECKED_SIZE = 4 * 1024 * 1024
+
+#: Seconds spent writing samples, 2 MiB/s sticks need about as long for MINIMAL_CHECKED_SIZE
+TIME_BUDGET = 3.0
+
+#: Alignment of samples, a multiple of any logical block size (and of the page size, for O_DIRECT)
+BLOCK_SIZE = 4096
+
+#: Start of every sample
+MAGIC = b"WoeUSB capacity check\0"
+
+
+class CapacityError:
+    """
+    First sample that didn't read back as written
+    """
+
+    def __init__(self, offset, reason, found_offset=None):
+        """
+        :param offset: Offset of the sample in bytes
+        :param reason: "write", "read" (I/O error) or "mismatch"
+        :param found_offset: Offset of the sample found in its place instead, if any
+        """
+        self.offset = offset
+        self.reason = reason
+        self.found_offset = found_offset
+
+
+def read_only(device):
+    """
+    :param device: Block device, e.g. /dev/sdb
+    :return: Whether the kernel knows the device as read-only
+    """
+    try:
+        with open("/sys/class/block/" + os.path.basename(device) + "/ro") as ro:
+            return ro.read().strip() == "1"
+    except OSError:
+        return False
+
+
+def sample_size(granularity):
+    """
+    :param granularity: Write granularity (erase block size) the device hints at in bytes, 0 if none
+    :return: Size of the samples, a power of two
+    """
+    if not granularity:
+        return SAMPLE_SIZE
+
+    size = MINIMAL_SAMPLE_SIZE
+    while size < min(granularity, MAXIMAL_SAMPLE_SIZE):
+        size *= 2
+    return size
+
+
+def sample_offsets(capacity, samples=SAMPLES, size=SAMPLE_SIZE):
+    """
+    :param capacity: Size of the device in bytes
+    :param samples: Minimal amount of offsets, there are at most twice as many plus the last one
+    :param size: Size of the samples, a power of two multiple of BLOCK_SIZE, see sample_size()
+    :return: Ascending offsets of samples a power of two apart from a random start, plus the last block aligned
+             sample, none of the samples overlap
+    """
+    step = size
+    while capacity // (step * 2) >= samples:
+        step *= 2
+
+    last = capacity // BLOCK_SIZE * BLOCK_SIZE - size
+    start = random.randrange(step // size) * size
+    offsets = list(range(start, last - size + 1, step))
+    offsets.append(last)
+    return offsets
+
+
+def write_order(offsets):
+    """
+    :param offsets: Ascending offsets, see sample_offsets()
+    :return: offsets starting with the last one, then every first of their power of two spaced ones in bit
+             reversed order: every prefix holds samples evenly spaced over the device
+    """
+    spaced = offsets[:-1]
+    bits = max(len(spaced) - 1, 0).bit_length()
+    order = sorted(range(len(spaced)), key=lambda index: _bit_reversed(index, bits))
+    return offsets[-1:] + [spaced[index] for index in order]
+
+
+def _bit_reversed(number, bits):
+    return int(format(number, "0{0}b".format(bits))[::-1], 2) if bits else 0
+
+
+def check(device, capacity, samples=SAMPLES, granularity=0, time_budget=TIME_BUDGET):
+    """
+    Write and read back tagged samples, destroys the data at their offsets
+
+    :param device: Block device, e.g. /dev/sdb
+    :param capacity: Advertised size of the device in bytes
+    :param samples: Minimal amount of samples, see sample_offsets()
+    :param granularity: Write granularity of the device in bytes, 0 if unknown, see sample_size()
+    :param time_budget: Seconds after which no more samples are written, once MINIMAL_CHECKED_SIZE of them are
+    :return: CapacityError of the lowest failing sample, None if all of them are fine
+    :raise OSError: Device can't be opened
+    """
+    nonce = os.urandom(16)
+    size = sample_size(granularity)
+    offsets = write_order(sample_offsets(capacity, samples, size))
+    expected = {}
+
+    buffer = mmap.mmap(-1, size)
+    fd = os.open(device, os.O_RDWR | os.O_DIRECT | os.O_DSYNC)
+    try:
+        errors = []
+        deadline = time.monotonic() + time_budget
+        for offset in offsets:
+            if len(expected) * size >= MINIMAL_CHECKED_SIZE and time.monotonic() >= deadline:
+                break
+
+            header = MAGIC + nonce + struct.pack("<Q", offset)
+            buffer.seek(0)
+            buffer.write(header + os.urandom(size - len(header)))
+            expected[offset] = hashlib.sha256(buffer).digest()
+            try:
+                os.pwritev(fd, [buffer], offset)
+            except OSError:
+                errors.append(CapacityError(offset, "write"))
+
+        if not errors:
+            os.fsync(fd)
+
+            # Dicts keep the order the samples were written in
+            for offset in expected:
+                try:
+                    os.preadv(fd, [buffer], offset)
+                except OSError:
+                    errors.append(CapacityError(offset, "read"))
+                    continue
+
+                if hashlib.sha256(buffer).digest() != expected[offset]:
+                    found_offset = None
+                    header = MAGIC + nonce
+                    if buffer[:len(header)] == header:
+                        found_offset = struct.unpack("<Q", buffer[len(header):len(header) + 8])[0]
+                    errors.append(CapacityError(offset, "mismatch", found_offset))
+    finally:
+        os.close(fd)
+        buffer.close()
+
+    if not errors:
+        return None
+    return min(errors, key=lambda error: error.offset)
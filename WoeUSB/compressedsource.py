@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+"""
+Source ISO read straight from an xz or zstd compressed image (.iso.xz, .iso.zst), without decompressing it first
+
+Both formats consist of independently compressed frames: the blocks of an xz file (xz -T0 writes several), the
+frames of a zstd file (pzstd, zstd --seekable and other parallel compressors write several).  An index of the
+frames, where each of them starts in the compressed file and how much it decompresses to, is built on first use
+and cached, for xz it is read from the index the format ends with, for zstd it takes one pass over the frame and
+block headers.  Frames are then decompressed on demand on all cores into a bounded cache, see
+blockexport.BlockReader, and the reader is exported as a block device (see WoeUSB.blockexport) mounted as any
+other source: only the frames holding data the installation reads are decompressed, the next ones while the
+current ones are copied.
+
+An image compressed as one large frame (plain xz or zstd of older versions) can't be read on demand, it has to be
+recompressed, or decompressed before use.
+"""
+
+import os
+import json
+import lzma
+import zlib
+import struct
+import shutil
+import hashlib
+import threading
+import subprocess
+
+import WoeUSB.utils as utils
+import WoeUSB.blockexport as blockexport
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+DEFAULT_INDEX_DIRECTORY = "/var/cache/woeusb/indexes"
+
+#: Decompressed frames kept in memory, in bytes
+CACHE_SIZE = 256 * 1024 * 1024
+#: Largest frame decompressed on demand
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+XZ_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+ZSTD_MAGIC = 0xfd2fb528
+#: Skippable zstd frames (e.g. the seek table of zstd --seekable) have magics 0x184d2a50 to 0x184d2a5f
+ZSTD_SKIPPABLE_MAGIC = 0x184d2a50
+
+
+def compression(source_media):
+    """
+    :param source_media: Source given by the user
+    :return: "xz" or "zstd" when source_media is a file compressed with either, None otherwise
+    """
+    if not os.path.isfile(source_media):
+        return None
+
+    with open(source_media, "rb") as source:
+        magic = source.read(8)
+        if magic[:6] == XZ_MAGIC:
+            return "xz"
+
+        # pzstd and zstd --seekable start with skippable frames
+        while len(magic) == 8 and struct.unpack("<I", magic[:4])[0] & 0xfffffff0 == ZSTD_SKIPPABLE_MAGIC:
+            source.seek(struct.unpack("<I", magic[4:8])[0], os.SEEK_CUR)
+            magic = source.read(8)
+        if len(magic) >= 4 and struct.unpack("<I", magic[:4])[0] == ZSTD_MAGIC:
+            return "zstd"
+    return None
+
+
+def load_index(path, compression_format, directory=DEFAULT_INDEX_DIRECTORY):
+    """
+    :param path: Compressed file
+    :param compression_format: "xz" or "zstd", see compression()
+    :param directory: Directory of cached indexes, None doesn't cache
+    :return: Frames of the file as [compressed offset, compressed size, decompressed size, stream flags (xz)]
+    :raise OSError: File is corrupted or can't be read
+    """
+    status = os.stat(path)
+    key = hashlib.sha256(json.dumps([os.path.realpath(path), status.st_size, status.st_mtime_ns]).encode())
+    cached = None if directory is None else os.path.join(directory, key.hexdigest()[:32] + ".json")
+
+    if cached is not None:
+        try:
+            with open(cached) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    utils.print_with_color(_("Indexing compressed source {0}...").format(path), "green")
+    with open(path, "rb") as file:
+        if compression_format == "xz":
+            frames = _xz_frames(file, status.st_size)
+        else:
+            frames = _zstd_frames(file, status.st_size)
+
+    if cached is not None:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(cached + ".tmp", "w") as file:
+                json.dump(frames, file)
+            os.replace(cached + ".tmp", cached)
+        except OSError:
+            pass  # Built again next time
+
+    return frames
+
+
+class CompressedReader(blockexport.BlockReader):
+    """
+    Random access to the decompressed content of an xz or zstd file, see module documentation
+    """
+
+    def __init__(self, path, index_directory=DEFAULT_INDEX_DIRECTORY, workers=None):
+        """
+        :param path: Compressed file
+        :param index_directory: Directory of cached indexes, None doesn't cache
+        :param workers: Frames decompressed in parallel, None uses all cores
+        :raise OSError: File can't be read on demand
+        """
+        self.path = path
+        self.compression = compression(path)
+        if self.compression is None:
+            raise OSError(_("{0} isn't compressed with xz or zstd").format(path))
+        if self.compression == "zstd" and shutil.which("zstd") is None:
+            raise OSError(_("zstd command is required to read {0}").format(path))
+
+        # Empty frames hold nothing to read
+        self.frames = [frame for frame in load_index(path, self.compression, index_directory) if frame[2] > 0]
+
+        largest = max([frame[2] for frame in self.frames] or [0])
+        if largest > MAX_FRAME_SIZE:
+            raise OSError(_("{0} is compressed as frames of over {1}, too large to be read on demand, recompress "
+                            "it with xz -T0 --block-size=16MiB or pzstd").format(
+                path, utils.convert_to_human_readable_format(MAX_FRAME_SIZE)))
+
+        offsets = []
+        size = 0
+        for frame in self.frames:
+            offsets.append(size)
+            size += frame[2]
+
+        cache_frames = max(2, CACHE_SIZE // max(largest, 1))
+        workers = min(workers or os.cpu_count() or 1, cache_frames)
+        self._fd = os.open(path, os.O_RDONLY)
+        blockexport.BlockReader.__init__(self, size, offsets, cache_frames, min(workers, cache_frames - 1), workers)
+
+    def load_block(self, index):
+        offset, compressed_size, size, flags = self.frames[index]
+
+        if self.compression == "xz":
+            data = os.pread(self._fd, (compressed_size + 3) // 4 * 4, offset)
+            data = _xz_decompress_block(data, compressed_size, size, flags)
+        else:
+            data = os.pread(self._fd, compressed_size, offset)
+            result = subprocess.run(["zstd", "--decompress", "--stdout", "--quiet"], input=data,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                raise OSError(result.stderr.decode("utf-8", "replace").strip())
+            data = result.stdout
+
+        if len(data) != size:
+            raise OSError(_("Frame at {0} of {1} is corrupted").format(offset, self.path))
+        return data
+
+    def close(self):
+        blockexport.BlockReader.close(self)
+        os.close(self._fd)
+
+
+def _xz_frames(file, size):
+    """
+    Blocks of all streams of an xz file, from the index at the end of every stream
+    """
+    frames = []
+    end = size
+    while end > 0:
+        # Stream padding, null bytes in multiples of four
+        file.seek(end - 4)
+        while end > 12 and file.read(4) == bytes(4):
+            end -= 4
+            file.seek(end - 4)
+
+        file.seek(end - 12)
+        footer = file.read(12)
+        if len(footer) != 12 or footer[10:12] != XZ_FOOTER_MAGIC:
+            raise OSError(_("Corrupted xz stream footer at {0}").format(end - 12))
+        index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+        flags = struct.unpack("<H", footer[8:10])[0]
+
+        index_start = end - 12 - index_size
+        file.seek(index_start)
+        index = file.read(index_size)
+        if not index or index[0] != 0:
+            raise OSError(_("Corrupted xz index at {0}").format(index_start))
+
+        count, position = _read_varint(index, 1)
+        records = []
+        for __ in range(count):
+            unpadded, position = _read_varint(index, position)
+            uncompressed, position = _read_varint(index, position)
+            records.append((unpadded, uncompressed))
+
+        stream_start = index_start - sum((unpadded + 3) // 4 * 4 for unpadded, __ in records) - 12
+        file.seek(max(stream_start, 0))
+        if stream_start < 0 or file.read(6) != XZ_MAGIC:
+            raise OSError(_("Corrupted xz stream header at {0}").format(stream_start))
+
+        offset = stream_start + 12
+        stream_frames = []
+        for unpadded, uncompressed in records:
+            stream_frames.append([offset, unpadded, uncompressed, flags])
+            offset += (unpadded + 3) // 4 * 4
+        frames = stream_frames + frames
+        end = stream_start
+
+    return frames
+
+
+def _xz_decompress_block(data, unpadded, uncompressed, flags):
+    """
+    Decompress one xz block by wrapping it into a stream of its own
+
+    :param data: Block with its padding
+    """
+    flags = struct.pack("<H", flags)
+    header = XZ_MAGIC + flags + struct.pack("<I", zlib.crc32(flags))
+
+    index = b"\0" + _write_varint(1) + _write_varint(unpadded) + _write_varint(uncompressed)
+    index += bytes(-len(index) % 4)
+    index += struct.pack("<I", zlib.crc32(index))
+
+    footer = struct.pack("<I", len(index) // 4 - 1) + flags
+    footer = struct.pack("<I", zlib.crc32(footer)) + footer + XZ_FOOTER_MAGIC
+
+    try:
+        return lzma.decompress(header + data + index + footer, format=lzma.FORMAT_XZ)
+    except lzma.LZMAError as error:
+        raise OSError(str(error))
+
+
+def _zstd_frames(file, size):
+    """
+    Frames of a zstd file, from their frame and block headers, frames without a content size are decompressed to
+    learn it
+    """
+    frames = []
+    offset = 0
+    while offset < size:
+        file.seek(offset)
+        header = file.read(18)
+        if len(header) < 8:
+            raise OSError(_("Truncated zstd frame at {0}").format(offset))
+        magic = struct.unpack("<I", header[:4])[0]
+
+        if magic & 0xfffffff0 == ZSTD_SKIPPABLE_MAGIC:
+            offset += 8 + struct.unpack("<I", header[4:8])[0]
+            continue
+        if magic != ZSTD_MAGIC:
+            raise OSError(_("Corrupted zstd frame at {0}").format(offset))
+
+        descriptor = header[4]
+        single_segment = descriptor >> 5 & 1
+        content_size_length = [single_segment, 2, 4, 8][descriptor >> 6]
+        position = 5 + (0 if single_segment else 1) + [0, 1, 2, 4][descriptor & 3]
+
+        content_size = None
+        if content_size_length:
+            content_size = int.from_bytes(header[position:position + content_size_length], "little")
+            if content_size_length == 2:
+                content_size += 256
+        position += content_size_length
+
+        # Blocks: 3 byte header (last block flag, type, size), RLE blocks hold a single byte
+        while True:
+            file.seek(offset + position)
+            block = file.read(3)
+            if len(block) < 3:
+                raise OSError(_("Truncated zstd frame at {0}").format(offset))
+            block = int.from_bytes(block, "little")
+            position += 3 + (1 if block >> 1 & 3 == 1 else block >> 3)
+            if block & 1:
+                break
+        if descriptor >> 2 & 1:
+            position += 4  # Content checksum
+
+        if content_size is None:
+            content_size = _zstd_content_size(file, offset, position)
+
+        frames.append([offset, position, content_size, 0])
+        offset += position
+
+    return frames
+
+
+def _zstd_content_size(file, offset, size):
+    """
+    Size of a zstd frame written without its content size (e.g. compressed from a pipe), decompressed as a
+    stream that is counted, not kept, and abandoned once it exceeds MAX_FRAME_SIZE
+
+    :return: Size of the content, only known to exceed MAX_FRAME_SIZE for a frame too large to be read on demand
+    """
+    file.seek(offset)
+    frame = file.read(size)
+
+    process = subprocess.Popen(["zstd", "--decompress", "--stdout", "--quiet"], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def feed():
+        try:
+            process.stdin.write(frame)
+            process.stdin.close()
+        except OSError:
+            pass  # Stopped reading, the frame is too large
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    content_size = 0
+    while content_size <= MAX_FRAME_SIZE:
+        chunk = process.stdout.read(1024 * 1024)
+        if not chunk:
+            break
+        content_size += len(chunk)
+
+    if content_size > MAX_FRAME_SIZE:
+        process.kill()
+        process.wait()
+        feeder.join()
+        process.stdout.close()
+        return content_size
+
+    process.stdout.close()
+    feeder.join()
+    if process.wait() != 0:
+        raise OSError(_("Corrupted zstd frame at {0}").format(offset))
+    return content_size
+
+
+def _read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def _write_varint(value):
+    data = b""
+    while value >= 0x80:
+        data += bytes([value & 0x7f | 0x80])
+        value >>= 7
+    return data + bytes([value])
@@ -1,18 +1,15 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import time
-import shutil
-import argparse
-import tempfile
-import traceback
+import itertools
 import threading
 import subprocess
-import urllib.request
-import urllib.error
 from datetime import datetime
 
 import WoeUSB.utils as utils
+import WoeUSB.progress as progress
 import WoeUSB.workaround as workaround
 import WoeUSB.miscellaneous as miscellaneous
 
@@ -22,100 +19,144 @@ application_name = 'WoeUSB'
 application_version = miscellaneous.__version__
 DEFAULT_NEW_FS_LABEL = 'Windows USB'
 
-application_site_url = 'https://github.com/slacka/WoeUSB'
-application_copyright_declaration = "Copyright © Colin GILLE / congelli501 2013\\nCopyright © slacka et.al. 2017"
-application_copyright_notice = application_name + " is free software licensed under the GNU General Public License version 3(or any later version of your preference) that gives you THE 4 ESSENTIAL FREEDOMS\\nhttps://www.gnu.org/philosophy/"
+#: Readahead of the source device in 512 byte sectors, the source is read sequentially in large chunks
+SOURCE_READAHEAD_SECTORS = 4096
 
-#: Increase verboseness, provide more information when required
-verbose = False
+#: Loop devices set up by mount_source_filesystem(), by mountpoint, cleanup_mountpoint() detaches them
+_source_loop_devices = {}
 
-debug = False
+#: Block device ioctls of <linux/fs.h>, see discard_target_device()
+BLKDISCARD = 0x1277
+BLKSECDISCARD = 0x127d
+BLKZEROOUT = 0x127f
 
-CopyFiles_handle = threading.Thread()
+#: Loop device ioctls of <linux/loop.h>, see setup_source_loop_device()
+LOOP_SET_FD = 0x4c00
+LOOP_SET_DIRECT_IO = 0x4c08
+LOOP_CTL_GET_FREE = 0x4c82
 
-#: Execution state for cleanup functions to determine if clean up is required
-current_state = 'pre-init'
+#: Bytes discarded by one ioctl, so that progress can be reported and cancellation checked in between
+DISCARD_STEP = 1024 * 1024 * 1024
 
-gui = None
+application_site_url = 'https://github.com/slacka/WoeUSB'
+application_copyright_declaration = "Copyright © Colin GILLE / congelli501 2013\\nCopyright © slacka et.al. 2017"
+application_copyright_notice = application_name + " is free software licensed under the GNU General Public License version 3(or any later version of your preference) that gives you THE 4 ESSENTIAL FREEDOMS\\nhttps://www.gnu.org/philosophy/"
 
 
-def init(from_cli=True, install_mode=None, source_media=None, target_media=None, workaround_bios_boot_flag=False,
-         target_filesystem_type="FAT", filesystem_label=DEFAULT_NEW_FS_LABEL):
+def init(argv=None):
     """
-    :param from_cli:
-    :type from_cli: bool
-    :param install_mode:
-    :param source_media:
-    :param target_media:
-    :param workaround_bios_boot_flag:
-    :param target_filesystem_type:
-    :param filesystem_label:
-    :return: List
-    """
-    source_fs_mountpoint = "/media/woeusb_source_" + str(
-        round((datetime.today() - datetime.fromtimestamp(0)).total_seconds())) + "_" + str(os.getpid())
-    target_fs_mountpoint = "/media/woeusb_target_" + str(
-        round((datetime.today() - datetime.fromtimestamp(0)).total_seconds())) + "_" + str(os.getpid())
-
-    temp_directory = tempfile.mkdtemp(prefix="WoeUSB.")
+    Parse command line arguments into an Installer
 
-    verbose = False
+    :param argv: Command line arguments, sys.argv[1:] when None
+    :return: Installer (fanout.FanOut for several targets), or exit code when there is nothing to install
+             (--about, invalid arguments)
+    """
+    parser = setup_arguments()
+    args = parser.parse_args(argv)
 
-    no_color = True
+    if args.about:
+        print_application_info()
+        return 0
 
-    debug = False
+    if args.source is None or not args.target:
+        parser.error(_("the following arguments are required: source, target"))
 
-    parser = None
+    if not args.device and not args.partition:
+        utils.print_with_color(_("You need to specify installation type (--device or --partition)"))
+        return 1
 
-    if from_cli:
-        parser = setup_arguments()
-        args = parser.parse_args()
+    progress_reporter = None
+    if args.json_progress and args.progress_fd is None:
+        args.progress_fd = 2  # stderr
+    if args.progress_fd is not None:
+        try:
+            progress_reporter = progress.JSONProgressReporter(args.progress_fd)
+        except OSError:
+            utils.print_with_color(_("Error: Unable to write progress into file descriptor {0}").format(
+                args.progress_fd), "red")
+            return 1
 
-        if args.about:
-            print_application_info()
-            return 0
+    bandwidth_scheduler = None
+    if len(args.target) > 1 or args.controller_bandwidth is not None or args.job_bandwidth is not None:
+        import WoeUSB.bandwidth as bandwidth
 
-        if args.device:
-            install_mode = "device"
-        elif args.partition:
-            install_mode = "partition"
-        else:
-            utils.print_with_color(_("You need to specify installation type (--device or --partition)"))
-            return 1
+        bandwidth_scheduler = bandwidth.BandwidthScheduler(args.controller_bandwidth, args.job_bandwidth)
 
-        #: source_media may be a optical disk drive or a disk image
-        source_media = args.source
-        #: target_media may be an entire usb storage device or just a partition
-        target_media = args.target
+    if len(args.target) > 1:
+        import WoeUSB.fanout as fanout
 
-        workaround_bios_boot_flag = args.workaround_bios_boot_flag
-        
-        skip_legacy_bootloader = args.workaround_skip_grub
+        return fanout.FanOut(args.source, args.target, progress_reporter=progress_reporter,
+                             bandwidth_scheduler=bandwidth_scheduler, **installer_settings(args))
 
-        target_filesystem_type = args.target_filesystem
+    installer = create_installer(args, progress_reporter=progress_reporter,
+                                 bandwidth_scheduler=bandwidth_scheduler)
+    installer.parser = parser
 
-        filesystem_label = args.label
+    return installer
 
-        verbose = args.verbose
 
-        no_color = args.no_color
+def installer_settings(args):
+    """
+    Installer keyword arguments given on command line, except source and target
 
-        debug = args.debug
+    :param args: Namespace returned by the parser from setup_arguments()
+    :return: dict
+    """
+    nice, io_priority = None, None
+    if args.background:
+        import WoeUSB.priority as priority
+
+        nice, io_priority = priority.BACKGROUND
+    if args.nice is not None:
+        nice = args.nice
+    if args.ionice is not None:
+        io_priority = args.ionice
+
+    return dict(
+        install_mode="device" if args.device else "partition",
+        target_filesystem_type=args.target_filesystem,
+        filesystem_label=args.label,
+        workaround_bios_boot_flag=args.workaround_bios_boot_flag,
+        skip_legacy_bootloader=args.workaround_skip_grub,
+        verbose=args.verbose,
+        no_color=args.no_color,
+        debug=args.debug,
+        nice=nice,
+        io_priority=io_priority,
+        write_mode=args.write_mode,
+        partition_alignment=args.partition_alignment,
+        cluster_size=args.cluster_size,
+        chunk_size=args.chunk_size,
+        discard=args.discard,
+        capacity_check=not args.skip_capacity_check,
+        target_image=args.target_image,
+        image_size=args.image_size,
+        image_cache=args.image_cache,
+        image_cache_size=args.image_cache_size,
+        disc_cache=args.disc_cache,
+        source_backend=args.source_backend,
+        grub_cache=args.grub_cache)
+
+
+def create_installer(args, **overrides):
+    """
+    Create Installer from command line arguments
 
-    utils.no_color = no_color
-    utils.verbose = verbose
-    utils.gui = gui
+    :param args: Namespace returned by the parser from setup_arguments()
+    :param overrides: Installer keyword arguments that take precedence over args
+    :return: Installer
+    """
+    settings = installer_settings(args)
+    settings.update(overrides)
 
-    if from_cli:
-        return [source_fs_mountpoint, target_fs_mountpoint, temp_directory, install_mode, source_media, target_media,
-                workaround_bios_boot_flag, skip_legacy_bootloader, target_filesystem_type, filesystem_label, verbose, debug, parser]
-    else:
-        return [source_fs_mountpoint, target_fs_mountpoint, temp_directory, target_media]
+    return Installer(args.source, args.target[0], **settings)
 
 
 def main(source_fs_mountpoint, target_fs_mountpoint, source_media, target_media, install_mode, temp_directory,
          target_filesystem_type, workaround_bios_boot_flag, parser=None, skip_legacy_bootloader=False):
     """
+    Thin wrapper running the installation steps of an Installer in the calling thread, see Installer.main()
+
     :param parser:
     :param source_fs_mountpoint:
     :param target_fs_mountpoint:
@@ -127,103 +168,114 @@ def main(source_fs_mountpoint, target_fs_mountpoint, source_media, target_media,
     :param workaround_bios_boot_flag:
     :return: 0 - succes; 1 - failure
     """
-    global debug
-    global verbose
-    global no_color
-    global current_state
-    global target_device
+    installer = Installer(source_media, target_media, install_mode, target_filesystem_type,
+                          workaround_bios_boot_flag=workaround_bios_boot_flag,
+                          skip_legacy_bootloader=skip_legacy_bootloader)
+    installer.source_fs_mountpoint = source_fs_mountpoint
+    installer.target_fs_mountpoint = target_fs_mountpoint
+    installer.temp_directory = temp_directory
+    installer.parser = parser
 
-    current_state = 'enter-init'
+    # Stays bound, so that cleanup() called afterwards in this thread finds it
+    utils.bind_job(installer)
 
-    command_mkdosfs, command_mkntfs, command_grubinstall = utils.check_runtime_dependencies(application_name)
-    if command_grubinstall == "grub-install":
-        name_grub_prefix = "grub"
-    else:
-        name_grub_prefix = "grub2"
-
-    utils.print_with_color(application_name + " v" + application_version)
-    utils.print_with_color("==============================")
+    return installer.main()
 
-    if os.getuid() != 0:
-        utils.print_with_color(_("Warning: You are not running {0} as root!").format(application_name), "yellow")
-        utils.print_with_color(_("Warning: This might be the reason of the following failure."), "yellow")
-
-    if utils.check_runtime_parameters(install_mode, source_media, target_media):
-        parser.print_help()
-        return 1
 
-    target_device, target_partition = utils.determine_target_parameters(install_mode, target_media)
+def print_application_info():
+    utils.print_with_color(application_name + " " + application_version)
+    utils.print_with_color(application_site_url)
+    utils.print_with_color(application_copyright_declaration)
+    utils.print_with_color(application_copyright_notice)
 
-    if utils.check_source_and_target_not_busy(install_mode, source_media, target_device, target_partition):
-        return 1
 
-    current_state = "start-mounting"
+def wipe_existing_partition_table_and_filesystem_signatures(target_device):
+    """
+    :param target_device:
+    :return: None
+    """
+    utils.report_stage("wiping")
+    utils.print_with_color(_("Wiping all existing partition table and filesystem signatures in {0}").format(target_device), "green")
+    subprocess.run(["wipefs", "--all", target_device])
+    check_if_the_drive_is_really_wiped(target_device)
 
-    if mount_source_filesystem(source_media, source_fs_mountpoint):
-        utils.print_with_color(_("Error: Unable to mount source filesystem"), "red")
-        return 1
 
-    if target_filesystem_type == "FAT":
-        if utils.check_fat32_filesize_limitation(source_fs_mountpoint):
-            target_filesystem_type = "NTFS"
+def discard_target_device(target_device):
+    """
+    Tell the flash translation layer that the whole device is unused (BLKDISCARD), so that a reused stick writes as
+    fast as a new one.  Devices that report discard support but refuse BLKDISCARD get BLKSECDISCARD, and devices
+    that offload zeroing get BLKZEROOUT when neither works or discard isn't supported at all.  Support is read from
+    the discard and write zeroes limits in sysfs.
 
-    if install_mode == "device":
-        wipe_existing_partition_table_and_filesystem_signatures(target_device)
-        create_target_partition_table(target_device, "legacy")
-        create_target_partition(target_device, target_partition, target_filesystem_type, target_filesystem_type,
-                                command_mkdosfs,
-                                command_mkntfs)
+    :param target_device: The target device file, for example /dev/sdX
+    :return: 0 - success or not supported; 1 - failure
+    """
+    import fcntl
+    import struct
 
-        if target_filesystem_type == "NTFS":
-            create_uefi_ntfs_support_partition(target_device)
-            install_uefi_ntfs_support_partition(target_device + "2", temp_directory)
+    utils.check_kill_signal()
 
-    if install_mode == "partition":
-        utils.check_target_partition(target_partition, target_device)
-        utils.check_target_partition(target_partition, target_device)
+    utils.report_stage("discarding")
 
-    if mount_target_filesystem(target_partition, target_fs_mountpoint):
-        utils.print_with_color(_("Error: Unable to mount target filesystem"), "red")
-        return 1
+    queue = "/sys/class/block/" + os.path.basename(target_device) + "/queue/"
 
-    if utils.check_target_filesystem_free_space(target_fs_mountpoint, source_fs_mountpoint, target_partition):
-        return 1
+    def read_limit(name):
+        try:
+            with open(queue + name) as limit:
+                return int(limit.read())
+        except (OSError, ValueError):
+            return 0
 
-    current_state = "copying-filesystem"
+    requests = []
+    if read_limit("discard_max_bytes"):
+        requests = [BLKDISCARD, BLKSECDISCARD]
+    if read_limit("write_zeroes_max_bytes"):
+        requests.append(BLKZEROOUT)
 
-    copy_filesystem_files(source_fs_mountpoint, target_fs_mountpoint)
+    if not requests:
+        utils.print_with_color(_("Info: {0} doesn't support discard, skipping").format(target_device))
+        return 0
 
-    workaround.support_windows_7_uefi_boot(source_fs_mountpoint, target_fs_mountpoint)
-    if not skip_legacy_bootloader:
-        install_legacy_pc_bootloader_grub(target_fs_mountpoint, target_device, command_grubinstall)
+    utils.print_with_color(_("Discarding all data on {0}...").format(target_device), "green")
 
-        install_legacy_pc_bootloader_grub_config(target_fs_mountpoint, target_device, command_grubinstall, name_grub_prefix)
+    reporter = utils.job_setting("progress_reporter")
+    start = time.monotonic()
 
-    if workaround_bios_boot_flag:
-        workaround.buggy_motherboards_that_ignore_disks_without_boot_flag_toggled(target_device)
+    try:
+        fd = os.open(target_device, os.O_WRONLY)
+    except OSError:
+        utils.print_with_color(_("Error: Unable to open {0} for discarding").format(target_device), "red")
+        return 1
 
-    current_state = "finished"
+    try:
+        size = fcntl.ioctl(fd, 0x80081272, struct.pack("Q", 0))  # BLKGETSIZE64
+        size = struct.unpack("Q", size)[0]
+
+        for request in requests:
+            try:
+                for offset in range(0, size, DISCARD_STEP):
+                    utils.check_kill_signal()
+                    fcntl.ioctl(fd, request, struct.pack("QQ", offset, min(DISCARD_STEP, size - offset)))
+                    if reporter is not None:
+                        reporter.progress(offset + min(DISCARD_STEP, size - offset), size)
+                break
+            except OSError:
+                continue  # Not supported after all, try the next method
+        else:
+            utils.print_with_color(_("Warning: Unable to discard {0}, continuing without").format(target_device),
+                                   "yellow")
+            return 0
+    except OSError:
+        utils.print_with_color(_("Error: Unable to determine size of {0}").format(target_device), "red")
+        return 1
+    finally:
+        os.close(fd)
 
+    utils.print_with_color(_("Discarded {0} in {1:.1f} seconds").format(utils.convert_to_human_readable_format(size),
+                                                                        time.monotonic() - start), "green")
     return 0
 
 
-def print_application_info():
-    utils.print_with_color(application_name + " " + application_version)
-    utils.print_with_color(application_site_url)
-    utils.print_with_color(application_copyright_declaration)
-    utils.print_with_color(application_copyright_notice)
-
-
-def wipe_existing_partition_table_and_filesystem_signatures(target_device):
-    """
-    :param target_device:
-    :return: None
-    """
-    utils.print_with_color(_("Wiping all existing partition table and filesystem signatures in {0}").format(target_device), "green")
-    subprocess.run(["wipefs", "--all", target_device])
-    check_if_the_drive_is_really_wiped(target_device)
-
-
 def check_if_the_drive_is_really_wiped(target_device):
     """
     Some broken locked-down flash drive will appears to be successfully wiped but actually nothing is written into it and will shown previous partition scheme afterwards.  This is the detection of the case and will bail out if such things happened
@@ -246,6 +298,64 @@ def check_if_the_drive_is_really_wiped(target_device):
     return 0
 
 
+def check_target_capacity(target_device):
+    """
+    Reject read-only and counterfeit (fake capacity) target devices before anything is copied, see WoeUSB.capacity
+
+    :param target_device: The wiped target device file, for example /dev/sdX
+    :return: 0 - success; 1 - failure
+    """
+    import WoeUSB.capacity as capacity
+    import WoeUSB.geometry as geometry
+
+    utils.check_kill_signal()
+
+    if capacity.read_only(target_device):
+        utils.print_with_color(_("Error: Target device {0} is read-only, check its write protect switch").format(
+            target_device), "red")
+        return 1
+
+    try:
+        with open("/sys/class/block/" + os.path.basename(target_device) + "/size") as size:
+            device_size = int(size.read()) * 512
+    except (OSError, ValueError):
+        utils.print_with_color(_("Warning: Unable to determine size of {0}, capacity check skipped").format(
+            target_device), "yellow")
+        return 0
+
+    utils.print_with_color(_("Checking capacity of the target device..."), "green")
+
+    start = time.monotonic()
+    try:
+        error = capacity.check(target_device, device_size, granularity=geometry.detect(target_device, "FAT").io_hint)
+    except OSError:
+        utils.print_with_color(_("Warning: Unable to open {0} for direct I/O, capacity check skipped").format(
+            target_device), "yellow")
+        return 0
+
+    if error is None:
+        utils.print_with_color(_("Capacity check passed: samples over {0} read back intact in {1:.1f} seconds").format(
+            utils.convert_to_human_readable_format(device_size), time.monotonic() - start))
+        return 0
+
+    if error.reason == "write":
+        reason = _("it refused to write")
+    elif error.reason == "read":
+        reason = _("it failed to read back")
+    elif error.found_offset is not None:
+        reason = _("data written at {0} was found there instead").format(
+            utils.convert_to_human_readable_format(error.found_offset))
+    else:
+        reason = _("what it read back differs from what was written")
+
+    utils.print_with_color(_("Error: Target device {0} failed the capacity check at {1}: {2}").format(
+        target_device, utils.convert_to_human_readable_format(error.offset), reason), "red")
+    utils.print_with_color(
+        _("Error: The device is read-only, failing, or counterfeit with less capacity than the {0} it advertises, files copied to it would be lost").format(
+            utils.convert_to_human_readable_format(device_size)), "red")
+    return 1
+
+
 def create_target_partition_table(target_device, partition_table_type):
     """
     :param target_device:
@@ -254,6 +364,7 @@ def create_target_partition_table(target_device, partition_table_type):
     """
     utils.check_kill_signal()
 
+    utils.report_stage("partitioning")
     utils.print_with_color(_("Creating new partition table on {0}...").format(target_device), "green")
 
     if partition_table_type in ["legacy", "msdos", "mbr", "pc"]:
@@ -272,7 +383,7 @@ def create_target_partition_table(target_device, partition_table_type):
 
 
 def create_target_partition(target_device, target_partition, filesystem_type, filesystem_label, command_mkdosfs,
-                            command_mkntfs):
+                            command_mkntfs, target_geometry=None, command_mkexfat="mkfs.exfat"):
     """
     :param target_device:
     :param target_partition:
@@ -280,13 +391,17 @@ def create_target_partition(target_device, target_partition, filesystem_type, fi
     :param filesystem_label:
     :param command_mkdosfs:
     :param command_mkntfs:
+    :param target_geometry: geometry.Geometry with partition start and cluster size, None keeps the defaults
+        (4MiB start, cluster size chosen by mkdosfs/mkntfs/mkfs.exfat)
+    :param command_mkexfat:
     :return: 1,2 - failure
     """
     utils.check_kill_signal()
 
     if filesystem_type in ["FAT", "vfat"]:
         parted_mkpart_fs_type = "fat32"
-    elif filesystem_type in ["NTFS", "ntfs"]:
+    elif filesystem_type in ["NTFS", "ntfs", "EXFAT", "exfat"]:
+        # exFAT shares the MBR partition type of NTFS (0x07) and the UEFI:NTFS partition, which can boot both
         parted_mkpart_fs_type = "ntfs"
     else:
         utils.print_with_color(_("Error: Filesystem not supported"), "red")
@@ -300,6 +415,10 @@ def create_target_partition(target_device, target_partition, filesystem_type, fi
     # http://www.gnu.org/software/grub/manual/grub.html#BIOS-installation and http://lwn.net/Articles/428584/
     # If NTFS filesystem is used we leave a 512KiB partition
     # at the end for installing UEFI:NTFS partition for NTFS support
+    partition_start = "4MiB"
+    if target_geometry is not None:
+        partition_start = str(target_geometry.alignment // 1024) + "KiB"
+
     if parted_mkpart_fs_type == "fat32":
         subprocess.run(["parted",
                         "--script",
@@ -307,7 +426,7 @@ def create_target_partition(target_device, target_partition, filesystem_type, fi
                         "mkpart",
                         "primary",
                         parted_mkpart_fs_type,
-                        "4MiB",
+                        partition_start,
                         "100%"])  # last sector of the disk
     elif parted_mkpart_fs_type == "ntfs":
         # Major partition for storing user files
@@ -318,7 +437,7 @@ def create_target_partition(target_device, target_partition, filesystem_type, fi
                         "mkpart",
                         "primary",
                         parted_mkpart_fs_type,
-                        "4MiB",
+                        partition_start,
                         "--",
                         "-2049s"])  # Leave 512KiB==1024sector in traditional 512bytes/sector disk, disks with sector with more than 512bytes only result in partition size greater than 512KiB and is intentionally let-it-be.
     # FIXME: Leave exact 512KiB in all circumstances is better, but the algorithm to do so is quite brainkilling.
@@ -330,10 +449,22 @@ def create_target_partition(target_device, target_partition, filesystem_type, fi
     workaround.make_system_realize_partition_table_changed(target_device)
 
     # Format target partition's filesystem
+    utils.report_stage("formatting")
     if filesystem_type in ["FAT", "vfat"]:
-        subprocess.run([command_mkdosfs, "-F", "32", target_partition])
+        cluster_options = []
+        if target_geometry is not None:
+            cluster_options = ["-s", str(target_geometry.cluster_size // target_geometry.sector_size)]
+        subprocess.run([command_mkdosfs, "-F", "32"] + cluster_options + [target_partition])
     elif filesystem_type in ["NTFS", "ntfs"]:
-        subprocess.run([command_mkntfs, "--quick", "--label", filesystem_label, target_partition])
+        cluster_options = []
+        if target_geometry is not None:
+            cluster_options = ["--cluster-size", str(target_geometry.cluster_size)]
+        subprocess.run([command_mkntfs, "--quick", "--label", filesystem_label] + cluster_options + [target_partition])
+    elif filesystem_type in ["EXFAT", "exfat"]:
+        cluster_options = []
+        if target_geometry is not None:
+            cluster_options = ["--cluster-size", str(target_geometry.cluster_size)]
+        subprocess.run([command_mkexfat, "--volume-label", filesystem_label] + cluster_options + [target_partition])
     else:
         utils.print_with_color(_("FATAL: Shouldn't be here"), "red")
         return 1
@@ -371,6 +502,10 @@ def install_uefi_ntfs_support_partition(uefi_ntfs_partition, download_directory)
     """
     utils.check_kill_signal()
 
+    import shutil
+    import urllib.error
+    import urllib.request
+
     try:
         fileName = urllib.request.urlretrieve("https://github.com/pbatard/rufus/raw/master/res/uefi/uefi-ntfs.img", "uefi-ntfs.img")[0] #[local_filename, headers]
     except (urllib.error.ContentTooShortError, urllib.error.HTTPError, urllib.error.URLError):
@@ -383,6 +518,57 @@ def install_uefi_ntfs_support_partition(uefi_ntfs_partition, download_directory)
     shutil.copy2(download_directory + "/uefi-ntfs.img", uefi_ntfs_partition)
 
 
+def grow_target_partition(target_device, target_partition, filesystem_type, image_size):
+    """
+    Grow the target partition of a flashed disk image to the end of the device, moving the UEFI:NTFS partition of
+    NTFS layouts along, see Installer.flash_image()
+
+    :param target_device: The target device file, for example /dev/sdX
+    :param target_partition: Its first partition, holding the target filesystem
+    :param filesystem_type: "FAT", "NTFS" or "EXFAT"
+    :param image_size: Size of the flashed image in bytes
+    :return: None
+    """
+    import shutil
+
+    utils.check_kill_signal()
+
+    device_size = subprocess.run(["blockdev", "--getsize64", target_device], stdout=subprocess.PIPE).stdout
+    device_size = int(device_size.decode("utf-8").strip() or 0)
+    if device_size - image_size < 8 * 1024 * 1024:
+        return  # Nothing worth growing
+
+    resize_command = {"FAT": "fatresize", "NTFS": "ntfsresize"}.get(filesystem_type)
+    if resize_command is None or shutil.which(resize_command) is None:
+        utils.print_with_color(
+            _("Info: Target filesystem can't be grown, it keeps the size of the image ({0})").format(
+                utils.convert_to_human_readable_format(image_size)))
+        return
+
+    utils.report_stage("partitioning")
+    utils.print_with_color(_("Growing target partition to the size of the device..."), "green")
+
+    if filesystem_type == "FAT":
+        # fatresize grows the partition along with the filesystem
+        subprocess.run(["fatresize", "--size", "max", target_partition])
+        return
+
+    uefi_ntfs_partition = utils.partition_path(target_device, 2)
+    with open(uefi_ntfs_partition, "rb") as partition:
+        uefi_ntfs_image = partition.read()
+
+    subprocess.run(["parted", "--script", target_device, "rm", "2"])
+    subprocess.run(["parted", "--script", target_device, "resizepart", "1", "--", "-2049s"])
+    create_uefi_ntfs_support_partition(target_device)
+    workaround.make_system_realize_partition_table_changed(target_device)
+
+    with open(uefi_ntfs_partition, "wb") as partition:
+        partition.write(uefi_ntfs_image)
+
+    # Without a size ntfsresize fills the partition, it asks for confirmation
+    subprocess.run(["ntfsresize", "--force", target_partition], input=b"y\n")
+
+
 def mount_source_filesystem(source_media, source_fs_mountpoint):
     """
     :param source_media:
@@ -391,6 +577,7 @@ def mount_source_filesystem(source_media, source_fs_mountpoint):
     """
     utils.check_kill_signal()
 
+    utils.report_stage("mounting")
     utils.print_with_color(_("Mounting source filesystem..."), "green")
 
     # os.makedirs(source_fs_mountpoint, exist_ok=True)
@@ -400,11 +587,31 @@ def mount_source_filesystem(source_media, source_fs_mountpoint):
         return 1
 
     if os.path.isfile(source_media):
-        if subprocess.run(["mount",
-                           "--options", "loop,ro",
-                           "--types", "udf,iso9660",
-                           source_media,
-                           source_fs_mountpoint]).returncode != 0:
+        loop_device = setup_source_loop_device(source_media)
+
+        if loop_device is None and source_media.startswith("/proc/"):
+            # mount would resolve the descriptor of a daemon job (see daemon.check_unprivileged_job()) to the path
+            # it had when it was opened, which may lead elsewhere by now
+            returncode = 1
+        elif loop_device is None:
+            # No loop device could be set up, let mount set up an ordinary one
+            returncode = subprocess.run(["mount",
+                                         "--options", "loop,ro",
+                                         "--types", "udf,iso9660",
+                                         source_media,
+                                         source_fs_mountpoint]).returncode
+        else:
+            returncode = subprocess.run(["mount",
+                                         "--options", "ro",
+                                         "--types", "udf,iso9660",
+                                         loop_device,
+                                         source_fs_mountpoint]).returncode
+            if returncode == 0:
+                _source_loop_devices[source_fs_mountpoint] = loop_device
+            else:
+                subprocess.run(["losetup", "--detach", loop_device])
+
+        if returncode != 0:
             utils.print_with_color(_("Error: Unable to mount source media"), "red")
             return 1
     else:
@@ -415,6 +622,146 @@ def mount_source_filesystem(source_media, source_fs_mountpoint):
             utils.print_with_color(_("Error: Unable to mount source media"), "red")
             return 1
 
+        subprocess.run(["blockdev", "--setra", str(SOURCE_READAHEAD_SECTORS), source_media])
+
+
+def setup_source_loop_device(image):
+    """
+    Set up read-only loop device for a disk image, with direct I/O so that the image isn't cached a second time
+    under the loop device's own cache, and with readahead suited to sequential copying
+
+    The loop device is attached to the image opened here rather than through losetup, which resolves the path on
+    its own, so that a /proc/<pid>/fd/<fd> link is backed by the very file that descriptor refers to
+
+    :param image: Path of the disk image
+    :return: Path of the loop device, None on failure
+    """
+    import fcntl
+
+    try:
+        image_fd = os.open(image, os.O_RDONLY | os.O_CLOEXEC)
+    except OSError:
+        return None
+
+    try:
+        control_fd = os.open("/dev/loop-control", os.O_RDWR | os.O_CLOEXEC)
+    except OSError:
+        os.close(image_fd)
+        return None
+
+    loop_device = None
+    try:
+        # Another process may grab the free device first
+        for __ in range(8):
+            number = fcntl.ioctl(control_fd, LOOP_CTL_GET_FREE)
+            try:
+                # Opened read-only, the loop device is read-only too
+                loop_fd = os.open("/dev/loop" + str(number), os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                break
+            try:
+                fcntl.ioctl(loop_fd, LOOP_SET_FD, image_fd)
+            except OSError:
+                os.close(loop_fd)
+                continue
+
+            try:
+                fcntl.ioctl(loop_fd, LOOP_SET_DIRECT_IO, 1)
+            except OSError:
+                pass  # Not supported by the image's filesystem
+            os.close(loop_fd)
+            loop_device = "/dev/loop" + str(number)
+            break
+    except OSError:
+        pass
+    finally:
+        os.close(control_fd)
+        os.close(image_fd)
+
+    if loop_device is not None:
+        subprocess.run(["blockdev", "--setra", str(SOURCE_READAHEAD_SECTORS), loop_device])
+
+    return loop_device
+
+
+def export_source(source_media):
+    """
+    Block device of a source that is neither a disk image nor a device: an http(s):// URL of a disk image (see
+    WoeUSB.httpsource) or an xz/zstd compressed disk image (see WoeUSB.compressedsource), exported through
+    WoeUSB.blockexport
+
+    :param source_media: Source given by the user
+    :return: Attached blockexport.BlockExport, None when source_media is used as it is
+    :raise OSError: Source can't be read or exported
+    """
+    import WoeUSB.httpsource as httpsource
+    import WoeUSB.compressedsource as compressedsource
+
+    if httpsource.is_url(source_media):
+        reader = httpsource.HTTPReader(source_media)
+    elif compressedsource.compression(source_media) is not None:
+        reader = compressedsource.CompressedReader(source_media)
+    else:
+        return None
+
+    import WoeUSB.blockexport as blockexport
+
+    export = blockexport.BlockExport(reader, workers=reader.workers)
+    try:
+        export.attach()
+    except OSError:
+        reader.close()
+        raise
+
+    utils.print_with_color(_("Reading {0} ({1}) through {2}").format(
+        source_media, utils.convert_to_human_readable_format(reader.size), export.device), "green")
+    return export
+
+
+def release_source_export(export):
+    """
+    Detach a block device of export_source(), once its filesystem is unmounted
+    """
+    export.detach()
+    export.reader.close()
+
+    if getattr(export.reader, "requests", None):
+        utils.print_with_color(_("Fetched {0} in {1} requests").format(
+            utils.convert_to_human_readable_format(export.reader.bytes_fetched), export.reader.requests))
+
+
+def open_source_image(source_media):
+    """
+    Parse the filesystem of a source without mounting it, see WoeUSB.isoimage; http(s):// URLs and compressed
+    images are parsed through their readers, without exporting a block device
+
+    :param source_media: Disk image, optical drive or block device, http(s):// URL or compressed disk image
+    :return: isoimage.ISOImage
+    :raise OSError: Source can't be read
+    :raise isoimage.FilesystemError: Source has no filesystem the parser supports
+    """
+    import WoeUSB.isoimage as isoimage
+    import WoeUSB.httpsource as httpsource
+    import WoeUSB.compressedsource as compressedsource
+
+    if httpsource.is_url(source_media):
+        reader = httpsource.HTTPReader(source_media)
+    elif compressedsource.compression(source_media) is not None:
+        reader = compressedsource.CompressedReader(source_media)
+    else:
+        reader = isoimage.ImageReader(source_media)
+
+    try:
+        source_image = isoimage.ISOImage(reader)
+    except (OSError, isoimage.FilesystemError):
+        reader.close()
+        raise
+
+    utils.print_with_color(_("Read {0} filesystem of {1}: {2} files, {3}").format(
+        source_image.filesystem, source_media, len(source_image.files),
+        utils.convert_to_human_readable_format(source_image.size)), "green")
+    return source_image
+
 
 def mount_target_filesystem(target_partition, target_fs_mountpoint):
     """
@@ -426,6 +773,7 @@ def mount_target_filesystem(target_partition, target_fs_mountpoint):
     """
     utils.check_kill_signal()
 
+    utils.report_stage("mounting")
     utils.print_with_color(_("Mounting target filesystem..."), "green")
 
     # os.makedirs(target_fs_mountpoint, exist_ok=True)
@@ -449,7 +797,9 @@ def copy_filesystem_files(source_fs_mountpoint, target_fs_mountpoint):
     :param target_fs_mountpoint:
     :return: None
     """
-    global CopyFiles_handle
+    import shutil
+
+    installer = current_installer()
 
     utils.check_kill_signal()
 
@@ -459,26 +809,143 @@ def copy_filesystem_files(source_fs_mountpoint, target_fs_mountpoint):
             path = os.path.join(dirpath, file)
             total_size += os.path.getsize(path)
 
+    installer.bytes_total = total_size
+    installer.bytes_copied = 0
+    installer.start_device_accounting()
+
+    utils.report_stage("copying")
     utils.print_with_color(_("Copying files from source media..."), "green")
 
-    CopyFiles_handle = ReportCopyProgress(source_fs_mountpoint, target_fs_mountpoint)
-    CopyFiles_handle.start()
+    installer.copy_progress = ReportCopyProgress(installer, source_fs_mountpoint)
+    installer.copy_progress.start()
 
-    for dirpath, __, filenames in os.walk(source_fs_mountpoint):
-        utils.check_kill_signal()
+    if installer.bandwidth_scheduler is not None:
+        installer.bandwidth = installer.bandwidth_scheduler.register(installer.name or installer.target_media,
+                                                                     installer.target_device)
 
-        if not os.path.isdir(target_fs_mountpoint + dirpath.replace(source_fs_mountpoint, "")):
-            os.mkdir(target_fs_mountpoint + dirpath.replace(source_fs_mountpoint, ""))
-        for file in filenames:
-            path = os.path.join(dirpath, file)
-            CopyFiles_handle.file = path
+    try:
+        for dirpath, __, filenames in os.walk(source_fs_mountpoint):
+            utils.check_kill_signal()
+
+            if not os.path.isdir(target_fs_mountpoint + dirpath.replace(source_fs_mountpoint, "")):
+                os.mkdir(target_fs_mountpoint + dirpath.replace(source_fs_mountpoint, ""))
+            for file in filenames:
+                path = os.path.join(dirpath, file)
+                if os.path.relpath(path, source_fs_mountpoint) in installer.split_wims:
+                    continue  # Split by split_source_wims() below
+
+                installer.current_file = path
+
+                # Files bigger than 5 MiB, a target backend, the bandwidth limit and direct I/O have to see every
+                # write so they always take this path
+                if os.path.getsize(path) > 5 * 1024 * 1024 or installer.target_backend is not None \
+                        or installer.bandwidth is not None or installer.write_mode == "direct":
+                    copy_large_file(path, target_fs_mountpoint + path.replace(source_fs_mountpoint, ""))
+                else:
+                    shutil.copy2(path, target_fs_mountpoint + path.replace(source_fs_mountpoint, ""))
+                    drop_source_cache(path)
+                    installer.bytes_copied += os.path.getsize(path)
+                    if installer.write_mode == "paced" and installer.target_backend is None:
+                        installer.writeback_pacer().account(os.path.getsize(path))
+
+        installer.split_source_wims()
+
+        # Progress reaches the end once the data is on the stick, not when it's in the page cache
+        installer.close_target_files()
+    finally:
+        if installer.bandwidth is not None:
+            installer.bandwidth.release()
+            installer.bandwidth = None
+
+        installer.copy_progress.stop = True
+        installer.copy_progress.join()
+
+
+def copy_image_files(source_image, target_fs_mountpoint):
+    """
+    Copy all files of a source read without mounting it (see WoeUSB.isoimage) from their extents in the image,
+    with progress reporting
+
+    :param source_image: isoimage.ISOImage of the source
+    :param target_fs_mountpoint:
+    :return: None
+    """
+    import WoeUSB.isoimage as isoimage
+
+    installer = current_installer()
+
+    utils.check_kill_signal()
+
+    installer.bytes_total = source_image.size
+    installer.bytes_copied = 0
+    installer.start_device_accounting()
+
+    utils.report_stage("copying")
+    utils.print_with_color(_("Copying files from source media..."), "green")
+
+    installer.copy_progress = ReportCopyProgress(installer, "")
+    installer.copy_progress.start()
+
+    if installer.bandwidth_scheduler is not None:
+        installer.bandwidth = installer.bandwidth_scheduler.register(installer.name or installer.target_media,
+                                                                     installer.target_device)
+
+    reader = source_image.reader
+    chunk_size = installer.copy_chunk_size()
 
-            if os.path.getsize(path) > 5 * 1024 * 1024:  # Files bigger than 5 MiB
-                copy_large_file(path, target_fs_mountpoint + path.replace(source_fs_mountpoint, ""))
+    try:
+        for directory in source_image.directories:
+            os.makedirs(os.path.join(target_fs_mountpoint, directory), exist_ok=True)
+
+        for file in source_image.files:
+            utils.check_kill_signal()
+
+            if file.path in installer.split_wims:
+                continue  # Split by split_source_wims() below
+
+            installer.current_file = "/" + file.path
+            target_file = installer.open_target_file(os.path.join(target_fs_mountpoint, file.path))
+
+            # From an image file, paced writes copy in the kernel (copy_file_range), the data never reaches us
+            if getattr(reader, "regular", False) and hasattr(target_file, "copy_from") \
+                    and installer.bandwidth is None:
+                for offset, length in file.extents:
+                    for position in range(0, length, chunk_size):
+                        utils.check_kill_signal()
+
+                        size = min(chunk_size, length - position)
+                        if offset is None:
+                            target_file.write(bytes(size))
+                        else:
+                            target_file.copy_from(reader.fileno(), offset + position, size)
+                        installer.bytes_copied += size
+
+                for offset, length in file.extents:
+                    if offset is not None:
+                        os.posix_fadvise(reader.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
             else:
-                shutil.copy2(path, target_fs_mountpoint + path.replace(source_fs_mountpoint, ""))
+                for data in isoimage.read_chunks(reader, file.extents, chunk_size):
+                    utils.check_kill_signal()
+
+                    if installer.bandwidth is not None:
+                        installer.bandwidth.consume(len(data))
+
+                    target_file.write(data)
+                    installer.bytes_copied += len(data)
+
+            target_file.close()
 
-    CopyFiles_handle.stop = True
+        installer.split_source_wims()
+
+        # Progress reaches the end once the data is on the stick, not when it's in the page cache
+        installer.close_target_files()
+    finally:
+        if installer.bandwidth is not None:
+            installer.bandwidth.release()
+            installer.bandwidth = None
+
+        installer.copy_progress.stop = True
+        installer.copy_progress.join()
 
 
 def copy_large_file(source, target):
@@ -492,37 +959,112 @@ def copy_large_file(source, target):
     :param target:
     :return: None
     """
-    source_file = open(source, "rb")  # Open for reading in byte mode
-    target_file = open(target, "wb")  # Open for writing in byte mode
+    installer = current_installer()
+
+    target_file = installer.open_target_file(target)
 
-    while True:
+    for data in read_source_chunks(source, installer.copy_chunk_size()):
         utils.check_kill_signal()
 
-        data = source_file.read(5 * 1024 * 1024)  # Read 5 MiB, speeds of shitty pendrives can be as low as 2 MiB/s
-        if data == b"":
-            break
+        if installer.bandwidth is not None:
+            installer.bandwidth.consume(len(data))
 
         target_file.write(data)
+        installer.bytes_copied += len(data)
 
-    source_file.close()
     target_file.close()
 
 
-def install_legacy_pc_bootloader_grub(target_fs_mountpoint, target_device, command_grubinstall):
+def read_source_chunks(path, chunk_size, offset=0):
+    """
+    Read a source file chunk by chunk, keeping its page cache footprint flat whatever its size: the kernel reads
+    the next chunk ahead while the current one is written and drops each chunk once the caller is done with it
+
+    :param path: Path of the file
+    :param chunk_size: Size of the chunks in bytes
+    :param offset: Position to start reading at
+    :return: Iterator over the chunks
+    """
+    with open(path, "rb") as source_file:
+        fd = source_file.fileno()
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        source_file.seek(offset)
+
+        while True:
+            os.posix_fadvise(fd, offset + chunk_size, chunk_size, os.POSIX_FADV_WILLNEED)
+
+            data = source_file.read(chunk_size)
+            if data == b"":
+                break
+
+            yield data
+
+            os.posix_fadvise(fd, offset, len(data), os.POSIX_FADV_DONTNEED)
+            offset += len(data)
+
+
+def drop_source_cache(path):
+    """
+    Drop cached pages of a source file that has been copied
+
+    :param path: Path of the file
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def install_legacy_pc_bootloader_grub(target_fs_mountpoint, target_device, command_grubinstall,
+                                      target_partition=None, name_grub_prefix="grub", grub_cache=None):
     """
     :param target_fs_mountpoint:
     :param target_device:
     :param command_grubinstall:
+    :param target_partition: Partition of target_fs_mountpoint, required by grub_cache
+    :param name_grub_prefix: May be different between distributions (grub/grub2)
+    :param grub_cache: Directory of the GRUB cache (see WoeUSB.grubcache), None runs grub-install
     :return: None
     """
     utils.check_kill_signal()
 
+    utils.report_stage("bootloader")
     utils.print_with_color(_("Installing GRUB bootloader for legacy PC booting support..."), "green")
 
-    subprocess.run([command_grubinstall,
-                    "--target=i386-pc",
-                    "--boot-directory=" + target_fs_mountpoint,
-                    "--force", target_device])
+    cache = None
+    if grub_cache is not None and target_partition is not None:
+        import WoeUSB.grubcache as grubcache
+
+        try:
+            cache = grubcache.GRUBCache(grub_cache)
+            key = cache.key(command_grubinstall, target_device, target_partition, name_grub_prefix)
+        except OSError as error:
+            utils.print_with_color(_("Warning: Unable to use GRUB cache: {0}").format(error), "yellow")
+            cache = None
+
+    if cache is not None:
+        manifest = cache.lookup(key)
+        if manifest is not None:
+            if cache.replay(key, manifest, target_device, target_fs_mountpoint) == 0:
+                utils.print_with_color(_("Wrote cached GRUB bootloader {0}").format(cache.entry_path(key)), "green")
+                return
+            utils.print_with_color(_("Warning: Cached GRUB bootloader failed verification, running {0}").format(
+                command_grubinstall), "yellow")
+            cache.discard(key)
+
+    result = subprocess.run([command_grubinstall,
+                             "--target=i386-pc",
+                             "--boot-directory=" + target_fs_mountpoint,
+                             "--force", target_device])
+
+    if cache is not None and result.returncode == 0:
+        try:
+            reason = cache.store(key, target_device, target_partition, target_fs_mountpoint, name_grub_prefix)
+        except OSError as error:
+            reason = str(error)
+        if reason is not None:
+            utils.print_with_color(_("Warning: GRUB bootloader can't be cached: {0}").format(reason), "yellow")
 
 
 def install_legacy_pc_bootloader_grub_config(target_fs_mountpoint, target_device, command_grubinstall,
@@ -538,6 +1080,7 @@ def install_legacy_pc_bootloader_grub_config(target_fs_mountpoint, target_device
     """
     utils.check_kill_signal()
 
+    utils.report_stage("bootloader")
     utils.print_with_color(_("Installing custom GRUB config for legacy PC booting..."), "green")
 
     grub_cfg = target_fs_mountpoint + "/" + name_grub_prefix + "/grub.cfg"
@@ -562,6 +1105,10 @@ def cleanup_mountpoint(fs_mountpoint):
             utils.print_with_color(_("Warning: Unable to unmount filesystem."), "yellow")
             return 1
 
+        loop_device = _source_loop_devices.pop(fs_mountpoint, None)
+        if loop_device is not None:
+            subprocess.run(["losetup", "--detach", loop_device])
+
         try:
             os.rmdir(fs_mountpoint)
         except OSError:
@@ -573,62 +1120,38 @@ def cleanup_mountpoint(fs_mountpoint):
 
 def cleanup(source_fs_mountpoint, target_fs_mountpoint, temp_directory, target_media):
     """
+    Thin wrapper cleaning up after main() called earlier in this thread, see Installer.cleanup()
+
     :param source_fs_mountpoint:
     :param target_fs_mountpoint:
     :param temp_directory:
     :return: None
     """
-    if CopyFiles_handle.is_alive():
-        CopyFiles_handle.stop = True
+    installer = utils.current_job()
+    if installer is None:
+        installer = Installer(None, target_media)
+        installer.source_fs_mountpoint = source_fs_mountpoint
+        installer.target_fs_mountpoint = target_fs_mountpoint
+        installer.temp_directory = temp_directory
 
-    flag_unclean = False
-    flag_unsafe = False
-
-    cleanup_result = cleanup_mountpoint(source_fs_mountpoint)
-
-    if cleanup_result == 2:
-        flag_unclean = True
-
-    cleanup_result = cleanup_mountpoint(target_fs_mountpoint)
-
-    if cleanup_result == 1:
-        flag_unsafe = True
-    elif cleanup_result == 2:
-        flag_unclean = True
-
-    if flag_unclean:
-        utils.print_with_color(_("Some mountpoints are not unmount/cleaned successfully and must be done manually"),
-                               "yellow")
-
-    if flag_unsafe:
-        utils.print_with_color(
-            _("We were unable to unmount target filesystem for you, please make sure target filesystem is unmounted before detaching to prevent data corruption"),
-            "yellow")
-        utils.print_with_color(_("Some mountpoints are not unmount/cleaned successfully and must be done manually"),
-                               "yellow")
-
-    if utils.check_is_target_device_busy(target_media):
-        utils.print_with_color(
-            _("Target device is busy, please make sure you unmount all filesystems on target device or shutdown the computer before detaching it."),
-            "yellow")
-    else:
-        utils.print_with_color(_("You may now safely detach the target device"), "green")
-
-    shutil.rmtree(temp_directory)
-
-    if current_state == "finished":
-        utils.print_with_color(_("Done :)"), "green")
-        utils.print_with_color(_("The target device should be bootable now"), "green")
+    installer.cleanup()
 
 
 def setup_arguments():
     """
     :return: Setted up argparse.ArgumentParser object
     """
+    import argparse
+    import WoeUSB.rip as rip
+    import WoeUSB.grubcache as grubcache
+    import WoeUSB.imagecache as imagecache
+
     parser = argparse.ArgumentParser(
         description="WoeUSB can create a bootable Microsoft Windows(R) USB storage device from an existing Windows optical disk or an ISO disk image.")
-    parser.add_argument("source", help="Source")
-    parser.add_argument("target", help="Target")
+    # Optional only for --about, enforced in init()
+    parser.add_argument("source", nargs="?", help="Source: disk image (.iso, .iso.xz, .iso.zst), optical drive, or http(s):// URL of a disk image")
+    parser.add_argument("target", nargs="*",
+                        help="Target, several targets are written at once from a single read of the source")
     parser.add_argument("--device", "-d", action="store_true",
                         help="Completely WIPE the entire USB storage  device, then build a bootable Windows USB device from scratch.")
     parser.add_argument("--partition", "-p", action="store_true",
@@ -646,86 +1169,1249 @@ def setup_arguments():
                         help="Workaround BIOS bug that won't include the device in boot menu if non of the partition's boot flag is toggled")
     parser.add_argument("--workaround-skip-grub", action="store_true",
                         help="This will skip the legacy grub bootloader creation step.")
-    parser.add_argument("--target-filesystem", "--tgt-fs", choices=["FAT", "NTFS"], default="FAT", type=str.upper,
-                        help="Specify the filesystem to use as the target partition's filesystem.")
+    parser.add_argument("--target-filesystem", "--tgt-fs", choices=["AUTO", "FAT", "NTFS", "EXFAT"], default="FAT",
+                        type=str.upper,
+                        help="Specify the filesystem to use as the target partition's filesystem, FAT splits WIM images larger than 4GiB when wimlib-imagex is installed. AUTO formats the target with each viable filesystem, measures writing files into it and takes the layout predicted to be the fastest, which may be NTFS or exFAT, booted on UEFI through the UEFI:NTFS helper partition (default: FAT)")
+    parser.add_argument("--progress-fd", type=int, default=None, metavar="FD",
+                        help="Write machine-readable progress events as JSON lines into file descriptor FD")
+    parser.add_argument("--json-progress", action="store_true",
+                        help="Write machine-readable progress events as JSON lines into standard error")
+    parser.add_argument("--controller-bandwidth", type=utils.parse_size, default=None, metavar="SIZE",
+                        help="Write bandwidth per second shared by the targets on one USB controller (default: derived from the controller's speed)")
+    parser.add_argument("--job-bandwidth", type=utils.parse_size, default=None, metavar="SIZE",
+                        help="Maximal write bandwidth per second of every target (default: unlimited)")
+    parser.add_argument("--nice", type=int, default=None, choices=range(-20, 20), metavar="N",
+                        help="CPU niceness (-20..19) of the installation and the tools it runs")
+    parser.add_argument("--ionice", type=io_priority, default=None, metavar="CLASS[:LEVEL]",
+                        help="I/O priority of the installation and the tools it runs: realtime, best-effort or idle, with level 0 (highest) to 7")
+    parser.add_argument("--background", action="store_true",
+                        help="Keep the workstation responsive: shortcut for --nice 10 --ionice best-effort:7")
+    parser.add_argument("--write-mode", choices=["paced", "direct"], default="paced",
+                        help="paced: buffered writes flushed every few MiB, direct: O_DIRECT writes bypassing the page cache (default: paced)")
+    parser.add_argument("--partition-alignment", type=utils.parse_size, default=None, metavar="SIZE",
+                        help="Start of the target partition in --device creation method, a multiple of the sector size of at least 1MiB (default: derived from the device, at least 4MiB)")
+    parser.add_argument("--cluster-size", type=utils.parse_size, default=None, metavar="SIZE",
+                        help="Cluster size of the new target filesystem, a power of two up to 32KiB for FAT32, 64KiB for NTFS and 32MiB for exFAT (default: derived from the device's size and I/O hints)")
+    parser.add_argument("--chunk-size", type=utils.parse_size, default=None, metavar="SIZE",
+                        help="Size of the writes into the target (default: multiple of the partition alignment)")
+    parser.add_argument("--discard", action="store_true",
+                        help="Discard the whole target device before partitioning it in --device creation method, restores write speed of reused flash drives")
+    parser.add_argument("--skip-capacity-check", action="store_true",
+                        help="Don't check in --device creation method that the target device really stores what it advertises (catches counterfeit and read-only drives in seconds)")
+    parser.add_argument("--target-image", action="store_true",
+                        help="Build a raw disk image file named by target instead of writing a device, in --device creation method")
+    parser.add_argument("--image-size", type=utils.parse_size, default=None, metavar="SIZE",
+                        help="Size of the disk image built with --target-image (default: size of an existing image, or the size of the source with some headroom)")
+    parser.add_argument("--image-cache", nargs="?", const=imagecache.DEFAULT_DIRECTORY, default=None, metavar="DIR",
+                        help="Flash the target from a cached disk image of the same source and options, building it on a cache miss (default DIR: {0})".format(imagecache.DEFAULT_DIRECTORY))
+    parser.add_argument("--image-cache-size", type=utils.parse_size, default=None, metavar="SIZE",
+                        help="Size cap of the image cache, least recently used images are evicted beyond it (default: 32GiB)")
+    parser.add_argument("--disc-cache", nargs="?", const=rip.DEFAULT_DIRECTORY, default=None, metavar="DIR",
+                        help="Rip an optical source disc once into DIR and install from the ripped image, later runs reuse it (default DIR: {0})".format(rip.DEFAULT_DIRECTORY))
+    parser.add_argument("--source-backend", choices=["mount", "parse"], default="mount",
+                        help="mount: mount the source filesystem, parse: read its ISO9660/UDF filesystem straight from the image, without loop device, mount or root privileges for the source (default: mount)")
+    parser.add_argument("--grub-cache", nargs="?", const=grubcache.DEFAULT_DIRECTORY, default=None, metavar="DIR",
+                        help="Cache the legacy PC bootloader grub-install generates in DIR and write it directly on later runs with the same GRUB and target layout (default DIR: {0})".format(grubcache.DEFAULT_DIRECTORY))
     parser.add_argument('--for-gui', action="store_true", help=argparse.SUPPRESS)
 
     return parser
 
 
+def io_priority(value):
+    """
+    argparse type of --ionice, see priority.parse_io_priority()
+    """
+    import WoeUSB.priority as priority
+
+    return priority.parse_io_priority(value)
+
+
+class Installer:
+    """
+    A single installation: its configuration, execution state, progress counters and cancel token
+
+    Installers don't share any state, so several of them can run concurrently in threads of one process.  The
+    module level functions of core, utils and workaround find the installer they work for through
+    utils.current_job(), which Installer.run() binds to its thread.
+    """
+    _sequence = itertools.count()
+
+    def __init__(self, source_media, target_media, install_mode="device", target_filesystem_type="FAT",
+                 filesystem_label=DEFAULT_NEW_FS_LABEL, workaround_bios_boot_flag=False, skip_legacy_bootloader=False,
+                 verbose=None, no_color=None, debug=False, gui=None, progress_reporter=None, target_backend=None,
+                 name=None, bandwidth_scheduler=None, nice=None, io_priority=None, write_mode="paced",
+                 partition_alignment=None, cluster_size=None, chunk_size=None, discard=False, capacity_check=True,
+                 target_image=False, image_size=None, image_cache=None, image_cache_size=None, disc_cache=None,
+                 source_backend="mount", grub_cache=None):
+        """
+        :param source_media: Optical disk drive, disk image (optionally xz/zstd compressed), or http(s):// URL of a
+            disk image
+        :param target_media: Entire usb storage device or just a partition
+        :param install_mode: "device" or "partition"
+        :param target_filesystem_type: "FAT", "NTFS", "EXFAT", or "AUTO" to choose from a speed probe of the
+            target (see WoeUSB.layout)
+        :param filesystem_label: Label of the newly created filesystem in device mode
+        :param workaround_bios_boot_flag: Set boot flag of the first partition
+        :param skip_legacy_bootloader: Don't install GRUB for legacy PC booting
+        :param verbose: Provide more information, None inherits utils.verbose
+        :param no_color: Disable message coloring, None inherits utils.no_color
+        :param debug: Print tracebacks of errors
+        :param gui: Object receiving state, progress and error (see gui.WoeUSB_handler), None inherits utils.gui
+        :param progress_reporter: Structured progress output, None inherits utils.progress_reporter
+        :param target_backend: Pluggable target backend (see WoeUSB.simulated_device), None writes straight to
+            the target filesystem
+        :param name: Prefix of the messages of this installer, useful when several of them share one terminal
+        :param bandwidth_scheduler: bandwidth.BandwidthScheduler sharing write bandwidth with concurrent
+            installations, None doesn't limit writes
+        :param nice: CPU niceness of the installation's threads and the tools they run, None inherits
+        :param io_priority: I/O priority (class, level) of the same, see priority.parse_io_priority(), None inherits
+        :param write_mode: "paced" or "direct", how files are written into the target filesystem (see
+            WoeUSB.writeback), ignored with a target backend
+        :param partition_alignment: Start of the target partition in bytes, None derives it from the device
+        :param cluster_size: Cluster size of the target filesystem in bytes, None derives it from the device
+        :param chunk_size: Size of the writes of the copy engine in bytes, None derives it from the device
+        :param discard: Discard the whole target device before partitioning it
+        :param capacity_check: Reject read-only and counterfeit target devices by a sampled write and read back
+            before partitioning them, see WoeUSB.capacity
+        :param target_image: target_media is a disk image file to be built instead of a device, see WoeUSB.image
+        :param image_size: Size of the disk image in bytes, None keeps the size of an existing image or derives it
+            from the size of the source
+        :param image_cache: Directory of the cache of built disk images (see WoeUSB.imagecache), in device mode the
+            target is then flashed from the cached image, None doesn't cache
+        :param image_cache_size: Cap of the image cache in bytes, None uses the default
+        :param disc_cache: Directory of the cache optical discs are ripped into (see WoeUSB.rip), the installation
+            then reads the ripped image instead of the disc, None reads the disc
+        :param source_backend: "mount" mounts the source filesystem, "parse" reads it from the image without
+            mounting it (see WoeUSB.isoimage); a shared source is always mounted by its owner
+        :param grub_cache: Directory of the cache of GRUB legacy PC boot code (see WoeUSB.grubcache), None runs
+            grub-install every time
+        """
+        self.source_media = source_media
+        self.target_media = target_media
+        self.install_mode = install_mode
+        self.target_filesystem_type = target_filesystem_type
+        self.filesystem_label = filesystem_label
+        self.workaround_bios_boot_flag = workaround_bios_boot_flag
+        self.skip_legacy_bootloader = skip_legacy_bootloader
+        self.verbose = verbose
+        self.no_color = no_color
+        self.debug = debug
+        self.gui = gui
+        self.progress_reporter = progress_reporter
+        self.target_backend = target_backend
+        self.name = name
+        self.bandwidth_scheduler = bandwidth_scheduler
+        self.nice = nice
+        self.io_priority = io_priority
+        self.write_mode = write_mode
+        self.partition_alignment = partition_alignment
+        self.cluster_size = cluster_size
+        self.chunk_size = chunk_size
+        self.discard = discard
+        self.capacity_check = capacity_check
+        self.target_image = target_image
+        self.image_size = image_size
+        self.image_cache = image_cache
+        self.image_cache_size = image_cache_size
+        self.disc_cache = disc_cache
+        self.source_backend = source_backend
+        self.grub_cache = grub_cache
+
+        #: geometry.Geometry chosen for the target by prepare_target()
+        self.geometry = None
+        #: Device a disk image target is built for, its capacity and I/O hint choose the geometry, see
+        #: build_cached_image()
+        self.reference_device = None
+
+        #: Bytes written to the target device before the copy started, see bytes_on_device()
+        self.device_baseline = None
+
+        #: writeback.WritebackPacer and writeback.BufferPool of the running copy, see open_target_file()
+        self.pacer = None
+        self.buffer_pool = None
+
+        #: bandwidth.BandwidthShare of the running copy, None when writes aren't limited
+        self.bandwidth = None
+
+        #: Parser to print help from on invalid parameters
+        self.parser = None
+
+        #: Execution state for cleanup to determine if clean up is required
+        self.state = "pre-init"
+        self.result = None
+        self.cancel_event = threading.Event()
+
+        self.target_device = None
+        self.target_partition = None
+
+        #: Disk image file and the loop device it's built through, see attach_target_image()
+        self.image_path = None
+        self.image_loop_device = None
+
+        #: rip.Ripper reading the source disc while the target is prepared, see prepare_source()
+        self.ripper = None
+
+        #: blockexport.BlockExport the source is read through, see attach_source_export()
+        self.source_export = None
+        #: isoimage.ISOImage of the source with the parse backend, see open_source()
+        self.source_image = None
+
+        #: mkdosfs, mkntfs and grub-install commands, looked up by check_environment() unless given
+        self.commands = None
+
+        #: Source filesystem is mounted by someone else (see WoeUSB.fanout and WoeUSB.daemon), prepare_source() and
+        #: cleanup() leave it alone
+        self.shared_source = False
+        #: Total size of the source files, when known in advance
+        self.source_size = None
+        #: layout.SourceProfile of the source files, scanned by prepare_source() or given by the source's owner
+        self.source_profile = None
+        #: Source WIM images (paths relative to the source filesystem) split instead of copied, see choose_layout()
+        self.split_wims = []
+
+        #: Copy progress, in bytes
+        self.bytes_total = 0
+        self.bytes_copied = 0
+        self.current_file = ""
+        self.copy_progress = None
+
+        suffix = str(round((datetime.today() - datetime.fromtimestamp(0)).total_seconds())) + "_" + str(
+            os.getpid()) + "_" + str(next(Installer._sequence))
+        self.source_fs_mountpoint = "/media/woeusb_source_" + suffix
+        self.target_fs_mountpoint = "/media/woeusb_target_" + suffix
+        self.temp_directory = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        """
+        Ask the installation to stop, it stops at the next utils.check_kill_signal() and cleans up
+        """
+        self.cancel_event.set()
+
+    def run(self):
+        """
+        Run the whole installation in the calling thread, including clean up
+
+        :return: 0 - success; 1 - failure
+        """
+        import tempfile
+
+        utils.bind_job(self)
+        try:
+            self.temp_directory = tempfile.mkdtemp(prefix="WoeUSB.")
+
+            try:
+                self.result = self.main()
+            except (KeyboardInterrupt, SystemExit):
+                self.result = 1
+            except Exception as error:
+                self.result = 1
+                try:
+                    utils.print_with_color(str(error), "red")
+                except SystemExit:
+                    pass  # print_with_color exits when used by gui, error is reported already
+                if self.debug:
+                    import traceback
+                    traceback.print_exc()
+
+            try:
+                self.cleanup()
+            except SystemExit:
+                pass
+
+            if self.state != "finished":
+                self.result = 1
+
+            reporter = utils.job_setting("progress_reporter")
+            if reporter is not None:
+                reporter.finish(self.result)
+        finally:
+            utils.bind_job(None)
+
+        return self.result
+
+    def main(self):
+        """
+        Installation steps, expects to run in the thread the installer is bound to (see run())
+
+        :return: 0 - succes; 1 - failure
+        """
+        self.state = 'enter-init'
+
+        if self.check_environment():
+            return 1
+
+        if self.image_cache is not None and not self.target_image:
+            if self.install_mode == "device":
+                return self.install_from_image_cache()
+            utils.print_with_color(_("Warning: The image cache works in --device creation method only, ignoring it"),
+                                   "yellow")
+
+        self.state = "start-mounting"
+
+        if self.prepare_source():
+            return 1
+
+        if self.prepare_target():
+            return 1
+
+        self.state = "copying-filesystem"
+
+        if self.source_image is not None:
+            copy_image_files(self.source_image, self.target_fs_mountpoint)
+        else:
+            copy_filesystem_files(self.source_fs_mountpoint, self.target_fs_mountpoint)
+
+        self.finalize_target()
+
+        self.flush_target()
+
+        self.state = "finished"
+        utils.report_stage("finished")
+
+        return 0
+
+    def check_environment(self, announce=True):
+        """
+        Look up external commands and validate source and target media
+
+        :param announce: Print the version and the environment, see announce()
+        :return: 0 - success; 1 - failure
+        """
+        if self.commands is None:
+            self.commands = utils.check_runtime_dependencies(application_name)
+
+        if announce:
+            self.announce()
+
+        if self.shared_source or self.source_backend == "mount":
+            if not self.shared_source and self.attach_source_export():
+                return 1
+        elif self.open_source():
+            return 1
+
+        if self.target_image and self.attach_target_image():
+            return 1
+
+        # A parsed source has been checked by reading it, it isn't mounted and may be mounted elsewhere
+        parsed = not self.shared_source and self.source_backend == "parse"
+
+        if utils.check_runtime_parameters(self.install_mode, None if parsed else self.source_media,
+                                          self.target_media):
+            if self.parser is not None:
+                self.parser.print_help()
+            return 1
+
+        self.target_device, self.target_partition = utils.determine_target_parameters(self.install_mode,
+                                                                                      self.target_media)
+
+        if utils.check_source_and_target_not_busy(self.install_mode,
+                                                  None if self.shared_source or parsed else self.source_media,
+                                                  self.target_device, self.target_partition):
+            return 1
+
+        return 0
+
+    def announce(self):
+        """
+        Print the version, the priority and whether the installation runs as root
+        """
+        utils.print_with_color(application_name + " v" + application_version)
+        utils.print_with_color("==============================")
+
+        if self.nice is not None or self.io_priority is not None:
+            import WoeUSB.priority as priority
+
+            utils.print_with_color(_("Priority: {0}").format(priority.describe(self.nice, self.io_priority)))
+
+        if os.getuid() != 0:
+            utils.print_with_color(_("Warning: You are not running {0} as root!").format(application_name), "yellow")
+            utils.print_with_color(_("Warning: This might be the reason of the following failure."), "yellow")
+
+    def prepare_source(self):
+        """
+        Mount and scan source filesystem, a shared source is mounted and scanned by its owner
+
+        With a disc cache an optical source is used from its ripped image, a disc not ripped yet starts being ripped
+        and is mounted by wait_for_source() once the target has been prepared as far as possible without it
+
+        :return: 0 - success; 1 - failure
+        """
+        import WoeUSB.layout as layout
+
+        if self.shared_source:
+            return 0
+
+        if self.source_image is not None:
+            self.source_profile = layout.SourceProfile([(file.path, file.size) for file in self.source_image.files])
+            self.source_size = self.source_profile.size
+            return 0
+
+        if self.disc_cache is not None and self.start_rip():
+            return 1
+        if self.ripper is not None:
+            return 0
+
+        if mount_source_filesystem(self.source_media, self.source_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to mount source filesystem"), "red")
+            return 1
+
+        self.source_profile = layout.scan_source(self.source_fs_mountpoint)
+        self.source_size = self.source_profile.size
+
+        return 0
+
+    def start_rip(self):
+        """
+        Switch an optical source to its image in the disc cache, starting to rip it if it isn't there yet
+
+        :return: 0 - success; 1 - failure
+        """
+        import WoeUSB.rip as rip
+        import WoeUSB.imagecache as imagecache
+
+        if not rip.is_optical(self.source_media):
+            return 0
+
+        try:
+            volume, size = rip.disc_identity(self.source_media)
+        except OSError:
+            utils.print_with_color(_("Error: Unable to read the disc in {0}").format(self.source_media), "red")
+            return 1
+
+        cache = imagecache.ImageCache(self.disc_cache)
+        key = rip.cache_key(volume, size)
+        if cache.lookup(key) is not None:
+            utils.print_with_color(_("Using ripped image {0} of disc {1}").format(cache.image_path(key), volume),
+                                   "green")
+            self.source_media = cache.image_path(key)
+            return 0
+
+        utils.print_with_color(_("Ripping disc {0} ({1}) into {2} while the target is prepared...").format(
+            volume, utils.convert_to_human_readable_format(size), cache.image_path(key)), "green")
+        self.ripper = rip.Ripper(self.source_media, cache, key, size, self)
+        self.ripper.start()
+        return 0
+
+    def wait_for_source(self):
+        """
+        Wait for the rip started by prepare_source() and mount and scan its image
+
+        :return: 0 - success; 1 - failure
+        """
+        import WoeUSB.layout as layout
+
+        if self.ripper is None:
+            return 0
+
+        utils.report_stage("ripping")
+        reporter = utils.job_setting("progress_reporter")
+        gui = utils.job_setting("gui")
+        last_print = time.monotonic()
+
+        while self.ripper.is_alive():
+            self.ripper.join(0.25)
+            utils.check_kill_signal()
+
+            if reporter is not None:
+                reporter.progress(self.ripper.done, self.ripper.size)
+            string = _("Ripping: {0} of {1}").format(utils.convert_to_human_readable_format(self.ripper.done),
+                                                    utils.convert_to_human_readable_format(self.ripper.size))
+            if gui is not None:
+                gui.state = string
+                gui.progress = (self.ripper.done * 100) // self.ripper.size if self.ripper.size else 100
+            elif reporter is None and time.monotonic() - last_print >= 2:
+                last_print = time.monotonic()
+                utils.print_with_color(string)
+
+        if gui is not None:
+            gui.progress = False
+
+        ripper, self.ripper = self.ripper, None
+        if ripper.error is not None:
+            utils.print_with_color(ripper.error, "red")
+            return 1
+        self.source_media = ripper.path
+
+        if self.source_backend == "parse":
+            if self.open_source():
+                return 1
+            return self.prepare_source()
+
+        if mount_source_filesystem(self.source_media, self.source_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to mount source filesystem"), "red")
+            return 1
+
+        self.source_profile = layout.scan_source(self.source_fs_mountpoint)
+        self.source_size = self.source_profile.size
+        return 0
+
+    def prepare_target(self):
+        """
+        Create (in device mode) and mount target filesystem
+
+        :return: 0 - success; 1 - failure
+        """
+        import WoeUSB.geometry as geometry
+
+        command_mkdosfs, command_mkntfs, __ = self.commands
+
+        if self.install_mode == "device":
+            wipe_existing_partition_table_and_filesystem_signatures(self.target_device)
+            if self.discard and discard_target_device(self.target_device):
+                return 1
+            if self.capacity_check and not self.target_image and check_target_capacity(self.target_device):
+                return 1
+
+        if self.choose_layout():
+            return 1
+
+        self.geometry = geometry.detect(self.target_device, self.target_filesystem_type, self.partition_alignment,
+                                        self.cluster_size, self.chunk_size, self.reference_device)
+        if self.geometry is None:
+            return 1
+        utils.print_with_color(_("Target geometry: {0}").format(self.geometry.describe()))
+
+        if self.install_mode == "device":
+            create_target_partition_table(self.target_device, "legacy")
+            create_target_partition(self.target_device, self.target_partition, self.target_filesystem_type,
+                                    self.filesystem_label,
+                                    command_mkdosfs,
+                                    command_mkntfs,
+                                    self.geometry)
+
+            if self.target_filesystem_type in ["NTFS", "EXFAT"]:
+                create_uefi_ntfs_support_partition(self.target_device)
+                install_uefi_ntfs_support_partition(utils.partition_path(self.target_device, 2),
+                                                    self.temp_directory)
+
+        if self.install_mode == "partition":
+            utils.check_target_partition(self.target_partition, self.target_device)
+
+        if mount_target_filesystem(self.target_partition, self.target_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to mount target filesystem"), "red")
+            return 1
+
+        if utils.check_target_filesystem_free_space(self.target_fs_mountpoint, self.source_fs_mountpoint,
+                                                    self.target_partition, self.source_size):
+            return 1
+
+        return 0
+
+    def open_source(self):
+        """
+        Parse the source filesystem for the parse backend, see open_source_image(); an optical source ripped into
+        the disc cache is parsed from its image once ripped, see wait_for_source()
+
+        :return: 0 - success; 1 - failure
+        """
+        import WoeUSB.isoimage as isoimage
+
+        if self.disc_cache is not None and self.ripper is None:
+            import WoeUSB.rip as rip
+
+            if rip.is_optical(self.source_media):
+                return 0
+
+        try:
+            self.source_image = open_source_image(self.source_media)
+        except (OSError, isoimage.FilesystemError) as error:
+            utils.print_with_color(_("Error: Unable to read source {0}: {1}").format(self.source_media, error), "red")
+            return 1
+        return 0
+
+    def attach_source_export(self):
+        """
+        Make source_media the block device of a source that is read through one, see export_source()
+
+        :return: 0 - success; 1 - failure
+        """
+        try:
+            self.source_export = export_source(self.source_media)
+        except OSError as error:
+            utils.print_with_color(_("Error: Unable to read source {0}: {1}").format(self.source_media, error), "red")
+            return 1
+
+        if self.source_export is not None:
+            self.source_media = self.source_export.device
+        return 0
+
+    def attach_target_image(self):
+        """
+        Create the disk image file given as target_media and make target_media the loop device it's attached to
+
+        :return: 0 - success; 1 - failure
+        """
+        import WoeUSB.image as image
+        import WoeUSB.geometry as geometry
+
+        if self.install_mode != "device":
+            utils.print_with_color(_("Error: Disk image targets require the --device creation method"), "red")
+            return 1
+
+        size = self.image_size
+        if size is None and os.path.isfile(self.target_media):
+            size = os.path.getsize(self.target_media)
+        if size is None:
+            size = image.default_size(self.source_media,
+                                      None if self.source_image is None else self.source_image.reader.size)
+        if self.reference_device is not None and self.target_filesystem_type in ["FAT", "AUTO"]:
+            # Clusters sized for the reference device need room for a FAT32 volume's worth of them
+            reference_geometry = geometry.detect(None, "FAT", self.partition_alignment, self.cluster_size,
+                                                 self.chunk_size, self.reference_device)
+            if reference_geometry is not None:
+                size = max(size, geometry.minimal_size("FAT", reference_geometry))
+
+        try:
+            image.create(self.target_media, size)
+        except OSError as error:
+            utils.print_with_color(_("Error: Unable to create disk image {0}: {1}").format(self.target_media, error),
+                                   "red")
+            return 1
+
+        loop_device = image.attach(self.target_media)
+        if loop_device is None:
+            utils.print_with_color(_("Error: Unable to attach disk image {0} to a loop device").format(
+                self.target_media), "red")
+            return 1
+
+        utils.print_with_color(_("Building disk image {0} ({1}) through {2}").format(
+            self.target_media, utils.convert_to_human_readable_format(size), loop_device))
+
+        self.image_path = self.target_media
+        self.image_loop_device = loop_device
+        self.target_media = loop_device
+        return 0
+
+    def install_from_image_cache(self):
+        """
+        Flash the cached disk image built from the same source with the same options, building it on a miss
+
+        :return: 0 - success; 1 - failure
+        """
+        import WoeUSB.geometry as geometry
+        import WoeUSB.imagecache as imagecache
+
+        cache = imagecache.ImageCache(self.image_cache, self.image_cache_size)
+
+        # Growing the image onto the target keeps its clusters, the image is built for the target's capacity class
+        # (see geometry.detect()), one per class
+        target_geometry = {}
+        for filesystem_type in ["FAT", "NTFS", "EXFAT"] if self.target_filesystem_type == "AUTO" \
+                else [self.target_filesystem_type]:
+            chosen = geometry.detect(self.target_device, filesystem_type, self.partition_alignment, self.cluster_size)
+            if chosen is None:
+                return 1
+            target_geometry[filesystem_type] = [chosen.alignment, chosen.cluster_size]
+
+        # Readers of streamed and parsed sources know the file or URL behind them, see imagecache.fingerprint()
+        source = self.source_media
+        if self.source_image is not None:
+            source = self.source_image.reader
+        elif self.source_export is not None:
+            source = self.source_export.reader
+
+        utils.print_with_color(_("Looking up source media in image cache..."), "green")
+        key = cache.key(source,
+                        target_filesystem_type=self.target_filesystem_type,
+                        filesystem_label=self.filesystem_label,
+                        workaround_bios_boot_flag=self.workaround_bios_boot_flag,
+                        skip_legacy_bootloader=self.skip_legacy_bootloader,
+                        target_geometry=target_geometry,
+                        image_size=self.image_size,
+                        source_backend=self.source_backend,
+                        version=application_version)
+
+        with cache.lock(key):
+            metadata = cache.lookup(key)
+            if metadata is None:
+                utils.print_with_color(_("Image cache miss, building disk image {0} first").format(
+                    cache.image_path(key)))
+                if self.build_cached_image(cache.partial_path(key)):
+                    cache.discard(key)
+                    return 1
+                metadata = cache.store(key, filesystem_type=self.target_filesystem_type)
+            else:
+                utils.print_with_color(_("Image cache hit: {0}").format(cache.image_path(key)), "green")
+
+            # Opened under the lock, the image may be evicted meanwhile
+            image_file = open(cache.image_path(key), "rb")
+
+        with image_file:
+            return self.flash_image(image_file.fileno(), metadata)
+
+    def build_cached_image(self, path):
+        """
+        Build a disk image of this installation with an installer of its own, see attach_target_image(), laid out
+        for the target device
+
+        :param path: Path of the image
+        :return: 0 - success; 1 - failure
+        """
+        builder = Installer(self.source_media, path, "device", self.target_filesystem_type, self.filesystem_label,
+                            self.workaround_bios_boot_flag, self.skip_legacy_bootloader, verbose=self.verbose,
+                            no_color=self.no_color, debug=self.debug, gui=self.gui,
+                            progress_reporter=self.progress_reporter, name=self.name, nice=self.nice,
+                            io_priority=self.io_priority, write_mode=self.write_mode,
+                            partition_alignment=self.partition_alignment, cluster_size=self.cluster_size,
+                            chunk_size=self.chunk_size, target_image=True, image_size=self.image_size,
+                            disc_cache=self.disc_cache, source_backend=self.source_backend,
+                            grub_cache=self.grub_cache)
+        builder.reference_device = self.target_device
+        builder.commands = self.commands
+        builder.cancel_event = self.cancel_event
+        builder.temp_directory = self.temp_directory
+
+        utils.bind_job(builder)
+        try:
+            result = builder.main()
+        finally:
+            # Temporary directory is ours, and the installation isn't done yet
+            builder.temp_directory = None
+            builder.state = "built" if builder.state == "finished" else builder.state
+            builder.cleanup()
+            utils.bind_job(self)
+
+        self.target_filesystem_type = builder.target_filesystem_type
+        return result
+
+    def flash_image(self, image_fd, metadata):
+        """
+        Write a cached disk image onto the target device, verify it and grow its partition to the device's size
+
+        :param image_fd: File descriptor of the image
+        :param metadata: Metadata of the image in the cache, see imagecache.ImageCache.store()
+        :return: 0 - success; 1 - failure
+        """
+        import WoeUSB.imagecache as imagecache
+
+        self.state = "copying-filesystem"
+
+        wipe_existing_partition_table_and_filesystem_signatures(self.target_device)
+        if self.discard and discard_target_device(self.target_device):
+            return 1
+        if self.capacity_check and check_target_capacity(self.target_device):
+            return 1
+
+        device_size = subprocess.run(["blockdev", "--getsize64", self.target_device], stdout=subprocess.PIPE).stdout
+        device_size = int(device_size.decode("utf-8").strip() or 0)
+        if device_size < metadata["size"]:
+            utils.print_with_color(_("Error: Target device ({0}) is smaller than the disk image ({1})").format(
+                utils.convert_to_human_readable_format(device_size),
+                utils.convert_to_human_readable_format(metadata["size"])), "red")
+            return 1
+
+        gui = utils.job_setting("gui")
+        reporter = utils.job_setting("progress_reporter")
+        last_print = [time.monotonic()]
+
+        def progress(done, total):
+            utils.check_kill_signal()
+
+            self.bytes_copied, self.bytes_total = done, total
+            if reporter is not None:
+                reporter.progress(done, total)
+            if gui is not None:
+                gui.progress = (done * 100) // total if total else 100
+            elif reporter is None and time.monotonic() - last_print[0] >= 1:
+                last_print[0] = time.monotonic()
+                utils.print_with_color(_("{0} of {1}").format(utils.convert_to_human_readable_format(done),
+                                                              utils.convert_to_human_readable_format(total)))
+
+        chunk_size = self.copy_chunk_size()
+
+        utils.report_stage("flashing")
+        utils.print_with_color(_("Flashing disk image onto {0}...").format(self.target_device), "green")
+        start = time.monotonic()
+        extents = imagecache.flash(image_fd, self.target_device, chunk_size, progress)
+        utils.print_with_color(_("Flashed {0} in {1:.1f} seconds").format(
+            utils.convert_to_human_readable_format(self.bytes_total), time.monotonic() - start))
+
+        utils.report_stage("verifying")
+        utils.print_with_color(_("Verifying target device..."), "green")
+        mismatch = imagecache.verify(image_fd, self.target_device, extents, chunk_size, progress)
+        if gui is not None:
+            gui.progress = False
+        if mismatch is not None:
+            utils.print_with_color(_("Error: Target device doesn't hold what was flashed at {0}").format(
+                utils.convert_to_human_readable_format(mismatch)), "red")
+            return 1
+
+        workaround.make_system_realize_partition_table_changed(self.target_device)
+        grow_target_partition(self.target_device, self.target_partition, metadata["filesystem_type"],
+                              metadata["size"])
+
+        self.state = "finished"
+        utils.report_stage("finished")
+        return 0
+
+    def choose_layout(self):
+        """
+        Settle target_filesystem_type and split_wims: in device mode from the requested filesystem or, for "AUTO",
+        from speed probes of the wiped target formatted with each viable filesystem, in partition mode from the filesystem already on the partition
+
+        :return: 0 - success; 1 - failure
+        """
+        import WoeUSB.layout as layout
+
+        if self.wait_for_source():
+            return 1
+        if self.source_profile is None:
+            self.source_profile = layout.scan_source(self.source_fs_mountpoint)
+
+        requested = self.target_filesystem_type
+        speeds = None
+        if self.install_mode == "partition":
+            requested = layout.existing_filesystem(self.target_partition) or "FAT"
+        elif requested == "AUTO" and not self.target_image:
+            # An image file on local storage tells nothing about the sticks it will be flashed onto
+            speeds = {}
+            for candidate in layout.viable_layouts(self.source_profile):
+                if candidate.filesystem_type not in speeds:
+                    speeds[candidate.filesystem_type] = self.probe_filesystem(candidate.filesystem_type)
+            wipe_existing_partition_table_and_filesystem_signatures(self.target_device)
+
+        chosen = layout.choose(requested, self.source_profile, speeds)
+        if chosen is None:
+            return 1
+
+        self.target_filesystem_type = chosen.filesystem_type
+        self.split_wims = chosen.split_wims
+        utils.print_with_color(_("Target layout: {0}").format(chosen.describe()))
+
+        return 0
+
+    def probe_filesystem(self, filesystem_type):
+        """
+        Format the wiped target with filesystem_type and measure writing files into it, see layout.probe_filesystem()
+
+        :return: layout.Speeds, None if the filesystem couldn't be created or measured
+        """
+        import WoeUSB.layout as layout
+        import WoeUSB.geometry as geometry
+
+        command_mkdosfs, command_mkntfs, __ = self.commands
+
+        utils.print_with_color(_("Measuring the target device with {0}...").format(
+            layout.Layout(filesystem_type).describe()), "green")
+
+        target_geometry = geometry.detect(self.target_device, filesystem_type, self.partition_alignment,
+                                          self.cluster_size, self.chunk_size)
+        if target_geometry is None:
+            return None
+
+        if create_target_partition_table(self.target_device, "legacy") \
+                or create_target_partition(self.target_device, self.target_partition, filesystem_type,
+                                           self.filesystem_label, command_mkdosfs, command_mkntfs, target_geometry) \
+                or mount_target_filesystem(self.target_partition, self.target_fs_mountpoint):
+            cleanup_mountpoint(self.target_fs_mountpoint)
+            return None
+
+        try:
+            return layout.probe_filesystem(self.target_fs_mountpoint)
+        finally:
+            cleanup_mountpoint(self.target_fs_mountpoint)
+
+    def split_source_wims(self):
+        """
+        Write the WIM images in split_wims into the target as .swm parts, see layout.split_wim()
+        """
+        import WoeUSB.layout as layout
+
+        for path in self.split_wims:
+            utils.check_kill_signal()
+
+            if self.source_image is None:
+                source = os.path.join(self.source_fs_mountpoint, path)
+            else:
+                source = self.stage_source_file(path)
+            target = os.path.join(self.target_fs_mountpoint, os.path.splitext(path)[0] + ".swm")
+            self.current_file = source
+            utils.print_with_color(_("Splitting {0} into parts fitting into FAT32...").format(path), "green")
+
+            copied = self.bytes_copied
+
+            def progress(written):
+                self.bytes_copied = copied + written
+
+            try:
+                if layout.split_wim(source, target, progress):
+                    raise RuntimeError(_("Error: Unable to split {0}").format(path))
+                self.bytes_copied = copied + os.path.getsize(source)
+            finally:
+                if self.source_image is not None:
+                    os.remove(source)
+
+    def stage_source_file(self, path):
+        """
+        Copy a file of a parsed source (see WoeUSB.isoimage) into the temporary directory, for tools that need a
+        file to read, wimlib-imagex splitting a WIM image
+
+        :param path: Path of the file relative to the source filesystem
+        :return: Path of the copy
+        """
+        import shutil
+        import WoeUSB.isoimage as isoimage
+
+        source_file = next(file for file in self.source_image.files if file.path == path)
+
+        free = shutil.disk_usage(self.temp_directory).free
+        if free < source_file.size:
+            raise RuntimeError(
+                _("Error: {0} has to be copied into {1} to be split, which has only {2} free, set TMPDIR to a "
+                  "directory with {3} free, or use --source-backend mount").format(
+                    path, self.temp_directory, utils.convert_to_human_readable_format(free),
+                    utils.convert_to_human_readable_format(source_file.size)))
+
+        utils.print_with_color(_("Copying {0} into {1} to split it...").format(path, self.temp_directory), "green")
+
+        staged = os.path.join(self.temp_directory, os.path.basename(path))
+        with open(staged, "wb") as file:
+            for data in isoimage.read_chunks(self.source_image.reader, source_file.extents, self.copy_chunk_size()):
+                utils.check_kill_signal()
+                file.write(data)
+        return staged
+
+    def finalize_target(self):
+        """
+        Make the populated target filesystem bootable
+        """
+        command_grubinstall = self.commands[2]
+        if command_grubinstall == "grub-install":
+            name_grub_prefix = "grub"
+        else:
+            name_grub_prefix = "grub2"
+
+        # The target holds a copy of every source file the workaround reads
+        workaround.support_windows_7_uefi_boot(
+            self.source_fs_mountpoint if self.source_image is None else self.target_fs_mountpoint,
+            self.target_fs_mountpoint)
+        if not self.skip_legacy_bootloader:
+            install_legacy_pc_bootloader_grub(self.target_fs_mountpoint, self.target_device, command_grubinstall,
+                                              self.target_partition, name_grub_prefix, self.grub_cache)
+
+            install_legacy_pc_bootloader_grub_config(self.target_fs_mountpoint, self.target_device,
+                                                     command_grubinstall, name_grub_prefix)
+
+        if self.workaround_bios_boot_flag:
+            workaround.buggy_motherboards_that_ignore_disks_without_boot_flag_toggled(self.target_device)
+
+    def copy_chunk_size(self):
+        """
+        :return: Size of the writes of the copy engine in bytes
+        """
+        if self.geometry is not None:
+            return self.geometry.chunk_size
+        if self.chunk_size is not None:
+            return self.chunk_size
+        return 5 * 1024 * 1024  # Speeds of shitty pendrives can be as low as 2 MiB/s
+
+    def start_device_accounting(self):
+        """
+        Start counting what reaches the target device, see bytes_on_device()
+        """
+        import WoeUSB.devicestats as devicestats
+
+        self.device_baseline = devicestats.bytes_written(self.target_device)
+
+    def bytes_on_device(self):
+        """
+        Copy progress as seen by the target device: bytes copied, but no more than the device has written since
+        start_device_accounting(), so that data still sitting in the page cache doesn't count
+
+        :return: Bytes
+        """
+        if self.device_baseline is None:
+            return self.bytes_copied
+
+        import WoeUSB.devicestats as devicestats
+
+        written = devicestats.bytes_written(self.target_device)
+        if written is None:
+            return self.bytes_copied
+        return min(self.bytes_copied, written - self.device_baseline)
+
+    def flush_target(self):
+        """
+        Wait for the data the kernel still caches for the target filesystem, reporting how much of it the device
+        has written meanwhile, instead of leaving it to a silent umount
+        """
+        import WoeUSB.writeback as writeback
+
+        utils.check_kill_signal()
+
+        utils.report_stage("flushing")
+        utils.print_with_color(_("Flushing cached data to target device..."), "green")
+
+        flush_progress = ReportFlushProgress(self)
+        flush_progress.start()
+        try:
+            writeback.sync_filesystem(self.target_fs_mountpoint)
+        finally:
+            flush_progress.stop = True
+            flush_progress.join()
+
+    def open_target_file(self, path):
+        """
+        Create file on the target filesystem, written through the target backend or according to write_mode
+
+        :param path: Path of the file
+        :return: File object supporting write() and close()
+        """
+        if self.target_backend is not None:
+            return self.target_backend.open(path, "wb")
+
+        import WoeUSB.writeback as writeback
+
+        if self.write_mode == "direct":
+            if self.buffer_pool is None:
+                self.buffer_pool = writeback.BufferPool(writeback.optimal_io_size(self.target_device))
+            try:
+                return writeback.DirectFile(path, self.buffer_pool, self.writeback_pacer())
+            except OSError:
+                utils.print_with_color(
+                    _("Warning: Target filesystem doesn't support direct I/O, falling back to paced writeback"),
+                    "yellow")
+                self.write_mode = "paced"
+
+        return writeback.PacedFile(path, self.writeback_pacer())
+
+    def writeback_pacer(self):
+        """
+        :return: writeback.WritebackPacer of the target filesystem
+        """
+        if self.pacer is None:
+            import WoeUSB.writeback as writeback
+
+            self.pacer = writeback.WritebackPacer(self.target_fs_mountpoint)
+        return self.pacer
+
+    def close_target_files(self):
+        """
+        Flush what the paced writeback still holds and free the direct I/O buffers
+        """
+        if self.pacer is not None:
+            self.pacer.flush()
+            self.pacer = None
+        if self.buffer_pool is not None:
+            self.buffer_pool.close()
+            self.buffer_pool = None
+
+    def cleanup(self):
+        """
+        Unmount filesystems and remove mountpoints and temporary directory
+        """
+        if self.copy_progress is not None and self.copy_progress.is_alive():
+            self.copy_progress.stop = True
+
+        if self.ripper is not None:
+            self.ripper.stop = True
+            self.ripper.join()
+            self.ripper = None
+
+        flag_unclean = False
+        flag_unsafe = False
+
+        if not self.shared_source:
+            cleanup_result = cleanup_mountpoint(self.source_fs_mountpoint)
+
+            if cleanup_result == 2:
+                flag_unclean = True
+
+        if self.source_export is not None and not os.path.ismount(self.source_fs_mountpoint):
+            release_source_export(self.source_export)
+            self.source_export = None
+
+        if self.source_image is not None:
+            self.source_image.reader.close()
+            self.source_image = None
+
+        cleanup_result = cleanup_mountpoint(self.target_fs_mountpoint)
+
+        if cleanup_result == 1:
+            flag_unsafe = True
+        elif cleanup_result == 2:
+            flag_unclean = True
+
+        if flag_unclean:
+            utils.print_with_color(_("Some mountpoints are not unmount/cleaned successfully and must be done manually"),
+                                   "yellow")
+
+        if flag_unsafe:
+            utils.print_with_color(
+                _("We were unable to unmount target filesystem for you, please make sure target filesystem is unmounted before detaching to prevent data corruption"),
+                "yellow")
+            utils.print_with_color(_("Some mountpoints are not unmount/cleaned successfully and must be done manually"),
+                                   "yellow")
+
+        if self.image_loop_device is not None:
+            import WoeUSB.image as image
+
+            if image.detach(self.image_loop_device):
+                utils.print_with_color(_("Warning: Unable to detach loop device {0}").format(self.image_loop_device),
+                                       "yellow")
+            self.image_loop_device = None
+            if self.state == "finished":
+                utils.print_with_color(_("Disk image {0} is ready to be flashed").format(self.image_path), "green")
+        elif utils.check_is_target_device_busy(self.target_media):
+            utils.print_with_color(
+                _("Target device is busy, please make sure you unmount all filesystems on target device or shutdown the computer before detaching it."),
+                "yellow")
+        else:
+            utils.print_with_color(_("You may now safely detach the target device"), "green")
+
+        if self.temp_directory is not None:
+            import shutil
+            shutil.rmtree(self.temp_directory)
+
+        if self.state == "finished":
+            utils.print_with_color(_("Done :)"), "green")
+            utils.print_with_color(_("The target device should be bootable now"), "green")
+
+
+def current_installer():
+    """
+    Installer bound to the calling thread, functions called outside of Installer.run() get a throwaway one
+
+    :return: Installer
+    """
+    installer = utils.current_job()
+    if installer is None:
+        installer = Installer(None, None)
+        utils.bind_job(installer)
+    return installer
+
+
 class ReportCopyProgress(threading.Thread):
     """
-    Classes for threading module
+    Reports copy progress of an Installer, from its byte counters
     """
-    file = ""
     stop = False
 
-    def __init__(self, source, target):
+    def __init__(self, installer, source):
         threading.Thread.__init__(self)
+        self.installer = installer
         self.source = source
-        self.target = target
 
     def run(self):
-        source_size = utils.get_size(self.source)
+        utils.bind_job(self.installer)
+
+        gui = utils.job_setting("gui")
+        reporter = utils.job_setting("progress_reporter")
+
+        source_size = self.installer.bytes_total
         len_ = 0
         file_old = None
 
         while not self.stop:
-            target_size = utils.get_size(self.target)
+            target_size = self.installer.bytes_on_device()
+
+            if reporter is not None:
+                reporter.progress(target_size, source_size)
 
-            if len_ != 0 and gui is None:
+            if len_ != 0 and gui is None and reporter is None:
                 print('\033[3A')
                 print(" " * len_)
                 print(" " * 4)
                 print('\033[3A')
 
             # Prevent printing same filenames
-            if self.file != file_old:
-                file_old = self.file
-                utils.print_with_color(self.file.replace(self.source, ""))
+            if self.installer.current_file != file_old:
+                file_old = self.installer.current_file
+                utils.print_with_color(file_old.replace(self.source, ""))
 
             string = "Copied " + utils.convert_to_human_readable_format(
                 target_size) + " from a total of " + utils.convert_to_human_readable_format(source_size)
 
             len_ = len(string)
-            percentage = (target_size * 100) // source_size
+            percentage = (target_size * 100) // source_size if source_size else 100
 
             if gui is not None:
                 gui.state = string
                 gui.progress = percentage
-            else:
+            elif reporter is None:
                 print(string)
                 print(str(percentage) + "%")
 
             time.sleep(0.05)
         if gui is not None:
             gui.progress = False
+        if reporter is not None:
+            reporter.progress(self.installer.bytes_on_device(), source_size, force=True)
 
         return 0
 
 
-def run():
-    result = init()
-    if isinstance(result, list) is False:
-        return
+class ReportFlushProgress(threading.Thread):
+    """
+    Reports how much of the data cached for the target has been written by the device, see Installer.flush_target()
 
-    source_fs_mountpoint, target_fs_mountpoint, temp_directory, \
-        install_mode, source_media, target_media, \
-        workaround_bios_boot_flag, skip_legacy_bootloader, target_filesystem_type, \
-        new_file_system_label, verbose, debug, parser = result
+    The amount still to be written is taken from the system wide Dirty and Writeback counters, so the total grows
+    if other devices are being written at the same time.
+    """
+    stop = False
 
-    try:
-        main(source_fs_mountpoint, target_fs_mountpoint, source_media, target_media, install_mode, temp_directory,
-             target_filesystem_type, workaround_bios_boot_flag, parser, skip_legacy_bootloader)
-    except KeyboardInterrupt:
-        pass
-    except Exception as error:
-        utils.print_with_color(error, "red")
-        if debug:
-            traceback.print_exc()
+    def __init__(self, installer, interval=0.25):
+        threading.Thread.__init__(self)
+        self.installer = installer
+        self.interval = interval
+
+    def run(self):
+        import WoeUSB.devicestats as devicestats
+
+        utils.bind_job(self.installer)
+
+        gui = utils.job_setting("gui")
+        reporter = utils.job_setting("progress_reporter")
+
+        device = self.installer.target_device
+        start_written = devicestats.bytes_written(device)
+        start_unwritten = devicestats.unwritten_bytes() or 0
+        done = 0
+        last_print = time.monotonic()
+
+        while not self.stop:
+            time.sleep(self.interval)
+
+            unwritten = devicestats.unwritten_bytes() or 0
+            written = devicestats.bytes_written(device)
+            if written is not None and start_written is not None:
+                done = written - start_written
+            else:
+                done = max(0, start_unwritten - unwritten)
+            total = done + unwritten
+
+            if reporter is not None:
+                reporter.progress(done, total)
+
+            string = _("Flushing: {0} of {1} written to device").format(
+                utils.convert_to_human_readable_format(done), utils.convert_to_human_readable_format(total))
+
+            if gui is not None:
+                gui.state = string
+                gui.progress = (done * 100) // total if total else 100
+            elif reporter is None and time.monotonic() - last_print >= 1:
+                last_print = time.monotonic()
+                utils.print_with_color(string)
+
+        if gui is not None:
+            gui.progress = False
+        if reporter is not None:
+            reporter.progress(done, done, force=True)
+
+        return 0
+
+
+def run():
+    installer = init()
+    if isinstance(installer, int):
+        return installer
 
-    cleanup(source_fs_mountpoint, target_fs_mountpoint, temp_directory, target_media)
+    return installer.run()
 
 
 if __name__ == "__main__":
-    run()
+    sys.exit(run())
@@ -0,0 +1,712 @@
+#!/usr/bin/env python3
+
+"""
+Long running installation service
+
+The daemon accepts jobs (woeusb command line arguments) over a local Unix socket and runs them through
+core.Installer, one worker thread per target device and at most max_jobs installations at a time.  External
+tools are looked up once per daemon and every source is mounted (and scanned) once, then shared by all jobs
+writing it.
+
+The GUI starts it through pkexec as a privileged helper for its session (see helper_socket_path() and
+--exit-with-stdin), so that it authenticates once instead of once per installation.  Clients are identified by
+the credentials of their socket (SO_PEERCRED): root may submit any job, the user owning the socket only jobs of
+a fixed shape (see check_unprivileged_job()), other jobs of the user need one authentication each, as before.
+The user passes the source image as a file descriptor it opened itself (SCM_RIGHTS, see request()), the daemon
+never opens a path given by the user.
+
+Protocol: the client sends one JSON object per line and reads JSON lines back
+
+* {"command": "submit", "arguments": ["--device", "win.iso", "/dev/sdX"]} -> {"job": {...}}, a descriptor of the
+  source sent along with the request is used instead of opening the source path
+* {"command": "status"} -> {"jobs": [{...}, ...]}
+* {"command": "cancel", "job": 1} -> {"job": {...}}
+* {"command": "watch", "job": 1} -> progress events of the job (see WoeUSB.progress) until it finishes
+* {"command": "bandwidth"} -> {"bandwidth": {...}}, current limits and rates of the running jobs; setting
+  "controller_bandwidth" and/or "job_bandwidth" (bytes per second, null for default) changes the limits
+* Errors are answered by {"error": "..."}, with "refused": true for a job an unprivileged client may not submit
+"""
+
+import os
+import sys
+import json
+import stat
+import time
+import queue
+import socket
+import struct
+import itertools
+import threading
+import collections
+import socketserver
+
+import WoeUSB.core as core
+import WoeUSB.utils as utils
+import WoeUSB.progress as progress
+import WoeUSB.bandwidth as bandwidth
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+DEFAULT_SOCKET_PATH = "/run/woeusb.sock"
+
+#: Amount of events a job keeps for clients that start watching it late
+JOB_EVENT_BACKLOG = 200
+
+#: Maximal amount of file descriptors received with a request
+MAX_REQUEST_FDS = 4
+
+#: Options an unprivileged client may set, everything else keeps its default, see check_unprivileged_job()
+UNPRIVILEGED_OPTIONS = {"source", "target", "device", "verbose", "no_color", "debug", "label",
+                        "workaround_bios_boot_flag", "workaround_skip_grub", "target_filesystem", "json_progress",
+                        "background", "write_mode", "discard", "skip_capacity_check", "source_backend"}
+
+
+class RefusedError(ValueError):
+    """
+    Job an unprivileged client may not submit
+    """
+
+
+class Job:
+    """
+    Single installation submitted to the daemon, its state and progress events
+    """
+
+    def __init__(self, job_id, arguments, installer, target_device):
+        self.id = job_id
+        self.arguments = arguments
+        self.installer = installer
+        self.target_device = target_device
+
+        #: queued, running, succeeded, failed or cancelled
+        self.state = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        #: Descriptor of the source passed by the client, see check_unprivileged_job()
+        self.source_fd = None
+
+        self.events = collections.deque(maxlen=JOB_EVENT_BACKLOG)
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    def publish(self, line):
+        with self._lock:
+            self.events.append(line)
+            for subscriber in self._subscribers:
+                subscriber.put(line)
+
+    def subscribe(self):
+        """
+        :return: queue.Queue receiving the past and future events of the job, None marks the end
+        """
+        subscriber = queue.Queue()
+        with self._lock:
+            for line in self.events:
+                subscriber.put(line)
+
+            if self.done:
+                subscriber.put(None)
+            else:
+                self._subscribers.append(subscriber)
+        return subscriber
+
+    def close(self, state):
+        with self._lock:
+            self.state = state
+            self.finished = time.time()
+            for subscriber in self._subscribers:
+                subscriber.put(None)
+            self._subscribers = []
+
+            if self.source_fd is not None:
+                os.close(self.source_fd)
+                self.source_fd = None
+
+    def to_dict(self):
+        installer = self.installer
+        return dict(id=self.id, arguments=self.arguments, source=installer.source_media,
+                    target=installer.target_media, state=self.state, submitted=self.submitted,
+                    started=self.started, finished=self.finished, stage=installer.progress_reporter.current_stage,
+                    done=installer.bytes_copied, total=installer.bytes_total, nice=installer.nice,
+                    io_priority=installer.io_priority)
+
+
+class JobReporter(progress.JSONProgressReporter):
+    """
+    Progress reporter publishing the events of an Installer to its Job
+    """
+
+    def __init__(self, job):
+        progress.JSONProgressReporter.__init__(self, None)
+        self.job = job
+
+    def write(self, line):
+        self.job.publish(line)
+
+
+class SourceMounts:
+    """
+    Source filesystems mounted by the daemon, shared by all jobs using the same source
+
+    A source stays mounted while it is unused, the least recently used ones are unmounted once there are more
+    than max_idle of them, or when their image has been modified.
+    """
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self._mounts = collections.OrderedDict()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        #: Source key -> lock serializing mounting that source, other sources are mounted meanwhile
+        self._mounting = {}
+
+    def acquire(self, source_media):
+        """
+        Mount source_media unless it is mounted already, expects to run in a thread bound to an installer
+
+        :param source_media: Optical disk drive, disk image (optionally xz/zstd compressed), or http(s):// URL
+            of a disk image
+        :return: SourceMount, None if it couldn't be mounted
+        """
+        key = _source_key(source_media)
+        with self._lock:
+            mounting = self._mounting.setdefault(key, threading.Lock())
+
+        with mounting:
+            with self._lock:
+                mount = self._mounts.get(key)
+                if mount is not None and mount.users == 0 and mount.modified != _modification_time(key):
+                    self._unmount(key)
+                    mount = None
+                if mount is not None:
+                    mount.users += 1
+                    self._mounts.move_to_end(key)
+                    return mount
+
+            # Exporting, mounting and scanning take long, only jobs of the same source wait for them
+            try:
+                export = core.export_source(source_media)
+            except OSError as error:
+                utils.print_with_color(_("Error: Unable to read source {0}: {1}").format(source_media, error),
+                                       "red")
+                return None
+
+            mountpoint = "/media/woeusb_source_daemon_" + str(os.getpid()) + "_" + str(next(self._sequence))
+            if core.mount_source_filesystem(source_media if export is None else export.device, mountpoint):
+                core.cleanup_mountpoint(mountpoint)
+                if export is not None:
+                    core.release_source_export(export)
+                return None
+
+            mount = SourceMount(mountpoint, _modification_time(key), export)
+            with self._lock:
+                mount.users += 1
+                self._mounts[key] = mount
+            return mount
+
+    def release(self, source_media):
+        key = _source_key(source_media)
+        with self._lock:
+            self._mounts[key].users -= 1
+
+            # Descriptor numbers are reused by later jobs for other files
+            if _descriptor_source(key) and self._mounts[key].users == 0:
+                self._unmount(key)
+
+            idle = [idle_key for idle_key, mount in self._mounts.items() if mount.users == 0]
+            for idle_key in idle[:max(0, len(idle) - self.max_idle)]:
+                self._unmount(idle_key)
+
+    def unmount_all(self):
+        with self._lock:
+            for key in [key for key, mount in self._mounts.items() if mount.users == 0]:
+                self._unmount(key)
+
+    def _unmount(self, key):
+        mount = self._mounts.pop(key)
+        if not core.cleanup_mountpoint(mount.mountpoint) and mount.export is not None:
+            core.release_source_export(mount.export)
+
+
+class SourceMount:
+    """
+    Mounted source filesystem with the profile of its files (see layout.SourceProfile), scanned once
+    """
+
+    def __init__(self, mountpoint, modified, export=None):
+        import WoeUSB.layout as layout
+
+        self.mountpoint = mountpoint
+        self.modified = modified
+        self.users = 0
+        #: blockexport.BlockExport of a streamed source, see core.export_source()
+        self.export = export
+
+        self.profile = layout.scan_source(mountpoint)
+        self.size = self.profile.size
+
+
+def _source_key(source_media):
+    import WoeUSB.httpsource as httpsource
+
+    if httpsource.is_url(source_media) or _descriptor_source(source_media):
+        return source_media
+    return os.path.realpath(source_media)
+
+
+def _descriptor_source(source_media):
+    """
+    :return: Whether source_media is a descriptor passed by a client, see check_unprivileged_job()
+    """
+    return source_media.startswith("/proc/" + str(os.getpid()) + "/fd/")
+
+
+def _modification_time(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class DeviceWorker(threading.Thread):
+    """
+    Runs the jobs of one target device, one after another
+    """
+
+    def __init__(self, service):
+        threading.Thread.__init__(self, daemon=True)
+        self.service = service
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            self.service.run_job(job)
+
+
+class Daemon:
+    """
+    Job queue with a worker per target device and a cap on concurrently running installations
+    """
+
+    def __init__(self, max_jobs=2, history_size=100, controller_bandwidth=None, job_bandwidth=None):
+        """
+        :param max_jobs: Maximal amount of installations running at the same time
+        :param history_size: Amount of finished jobs kept for status queries
+        :param controller_bandwidth: See bandwidth.BandwidthScheduler
+        :param job_bandwidth: See bandwidth.BandwidthScheduler
+        """
+        self.history_size = history_size
+        self.commands = utils.check_runtime_dependencies(core.application_name)
+        self.sources = SourceMounts()
+        self.bandwidth = bandwidth.BandwidthScheduler(controller_bandwidth, job_bandwidth)
+
+        self.jobs = collections.OrderedDict()
+        self.workers = {}
+
+        self._slots = threading.BoundedSemaphore(max_jobs)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, arguments, client=None, source_fd=None):
+        """
+        Queue an installation
+
+        :param arguments: woeusb command line arguments, with a single target
+        :param client: (uid, gid) of an unprivileged client, the job is then checked by check_unprivileged_job()
+        :param source_fd: Descriptor of the source sent by the client, left open, the job uses a duplicate
+        :return: Job
+        :raise RefusedError: Job isn't allowed for the unprivileged client
+        """
+        parser = core.setup_arguments()
+        try:
+            args = parser.parse_args(arguments)
+        except SystemExit:
+            raise ValueError(_("Invalid arguments: {0}").format(" ".join(arguments)))
+
+        if args.source is None or len(args.target) != 1:
+            raise ValueError(_("A job needs a source and exactly one target"))
+        if not args.device and not args.partition:
+            raise ValueError(_("You need to specify installation type (--device or --partition)"))
+        job_source_fd = None
+        if client is not None:
+            job_source_fd = check_unprivileged_job(parser, args, source_fd)
+
+        try:
+            job_id = next(self._ids)
+            installer = core.create_installer(args, no_color=True, name="job-" + str(job_id),
+                                              bandwidth_scheduler=self.bandwidth)
+            installer.commands = self.commands
+            target_device, __ = utils.determine_target_parameters(installer.install_mode, installer.target_media)
+        except BaseException:
+            if job_source_fd is not None:
+                os.close(job_source_fd)
+            raise
+
+        job = Job(job_id, arguments, installer, target_device)
+        job.source_fd = job_source_fd
+        installer.progress_reporter = JobReporter(job)
+
+        with self._lock:
+            self.jobs[job_id] = job
+            self._trim_history()
+
+            worker = self.workers.get(target_device)
+            if worker is None:
+                worker = self.workers[target_device] = DeviceWorker(self)
+                worker.start()
+            worker.queue.put(job)
+
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        job.installer.cancel()
+        return job
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise ValueError(_("No such job: {0}").format(job_id))
+        return job
+
+    def status(self):
+        with self._lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def run_job(self, job):
+        installer = job.installer
+
+        with self._slots:
+            if installer.cancelled:
+                installer.progress_reporter.finish(1)
+                job.close("cancelled")
+                return
+
+            job.state = "running"
+            job.started = time.time()
+
+            source_media = installer.source_media
+            utils.bind_job(installer)
+            try:
+                source = self.sources.acquire(source_media)
+            finally:
+                utils.bind_job(None)
+
+            if source is None:
+                installer.progress_reporter.finish(1)
+                job.close("failed")
+                return
+
+            installer.source_fs_mountpoint = source.mountpoint
+            installer.shared_source = True
+            if source.export is not None:
+                installer.source_media = source.export.device
+            installer.source_size = source.size
+            installer.source_profile = source.profile
+
+            try:
+                result = installer.run()
+            finally:
+                self.sources.release(source_media)
+
+        if installer.cancelled:
+            job.close("cancelled")
+        else:
+            job.close("succeeded" if result == 0 else "failed")
+
+    def shutdown(self):
+        with self._lock:
+            for job in self.jobs.values():
+                job.installer.cancel()
+            workers = list(self.workers.values())
+            for worker in workers:
+                worker.queue.put(None)
+
+        for worker in workers:
+            worker.join()
+        self.sources.unmount_all()
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.history_size)]:
+            del self.jobs[job_id]
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serves the JSON lines protocol described in the module documentation
+    """
+
+    def handle(self):
+        uid, gid = _peer_credentials(self.request)
+        if uid != 0 and uid != self.server.owner:
+            self.reply(error=_("Permission denied"))
+            return
+        client = None if uid == 0 else (uid, gid)
+
+        for line, fds in _receive_requests(self.request):
+            try:
+                request = json.loads(line)
+                command = request.get("command")
+
+                if command == "submit":
+                    job = self.server.service.submit(list(request["arguments"]), client, fds[0] if fds else None)
+                    self.reply(job=job.to_dict())
+                elif command == "status":
+                    self.reply(jobs=self.server.service.status())
+                elif command == "cancel":
+                    self.reply(job=self.server.service.cancel(request["job"]).to_dict())
+                elif command == "watch":
+                    self.watch(self.server.service.get(request["job"]))
+                elif command == "bandwidth":
+                    scheduler = self.server.service.bandwidth
+                    if "controller_bandwidth" in request or "job_bandwidth" in request:
+                        scheduler.set_limits(request.get("controller_bandwidth", scheduler.controller_bandwidth),
+                                             request.get("job_bandwidth", scheduler.job_bandwidth))
+                    self.reply(bandwidth=scheduler.status())
+                else:
+                    raise ValueError(_("Unknown command: {0}").format(command))
+            except RefusedError as error:
+                self.reply(error=str(error), refused=True)
+            except (ValueError, KeyError, TypeError, AttributeError) as error:
+                self.reply(error=str(error))
+            except OSError:
+                break  # Client went away
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    def watch(self, job):
+        events = job.subscribe()
+        while True:
+            line = events.get()
+            if line is None:
+                break
+            self.wfile.write(line.encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+    def reply(self, **fields):
+        self.wfile.write(json.dumps(fields, separators=(",", ":"), default=str).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+def check_unprivileged_job(parser, args, source_fd):
+    """
+    Check that a job of an unprivileged client does no more than it could ask for through one authentication per
+    installation: a --device installation onto a removable drive, from a disk image the client opened itself, with
+    no option naming a file or directory the job would write as root
+
+    The source isn't opened by its path, which the client may point elsewhere at any time, but read through the
+    descriptor the client passed: args.source is replaced by its /proc/<pid>/fd/<fd> link.  Devices aren't
+    accepted as sources, the client could pass a descriptor of a device it may read but the daemon would mount it.
+
+    :param parser: Parser that parsed args, see core.setup_arguments()
+    :param args: Arguments of the job
+    :param source_fd: Descriptor of the source passed by the client, None if it didn't pass one
+    :return: Duplicate of source_fd the job reads from, to be closed once it finished; None for an http(s) source
+    :raise RefusedError: Job isn't allowed
+    """
+    import fcntl
+
+    for name, value in vars(args).items():
+        if name not in UNPRIVILEGED_OPTIONS and value != parser.get_default(name):
+            raise RefusedError(_("Option {0} needs authentication").format(name.replace("_", "-")))
+    if not args.device:
+        raise RefusedError(_("Only --device installations are allowed without authentication"))
+
+    target = os.path.realpath(args.target[0])
+    try:
+        block_device = stat.S_ISBLK(os.stat(target).st_mode)
+    except OSError:
+        block_device = False
+    if not block_device or utils.is_partition(target) or not _removable(target):
+        raise RefusedError(_("{0} isn't a removable drive, installing onto it needs authentication").format(
+            args.target[0]))
+
+    import WoeUSB.httpsource as httpsource
+
+    if httpsource.is_url(args.source):
+        return None
+
+    if source_fd is None:
+        raise RefusedError(_("{0} wasn't passed as an open file, installing from it needs authentication").format(
+            args.source))
+    try:
+        status = os.fstat(source_fd)
+        flags = fcntl.fcntl(source_fd, fcntl.F_GETFL)
+    except OSError:
+        raise RefusedError(_("Permission denied: {0}").format(args.source))
+    if not stat.S_ISREG(status.st_mode):
+        raise RefusedError(_("{0} isn't a disk image file, installing from it needs authentication").format(
+            args.source))
+    if flags & getattr(os, "O_PATH", 0) or flags & os.O_ACCMODE == os.O_WRONLY:
+        raise RefusedError(_("{0} wasn't opened for reading").format(args.source))
+
+    fd = os.dup(source_fd)
+    args.source = "/proc/" + str(os.getpid()) + "/fd/" + str(fd)
+    return fd
+
+
+def _removable(device):
+    """
+    :return: Whether device is a removable drive or a drive attached through USB
+    """
+    sysfs = "/sys/class/block/" + os.path.basename(device)
+    try:
+        with open(sysfs + "/removable") as removable:
+            if removable.read().strip() == "1":
+                return True
+    except OSError:
+        return False
+    return "/usb" in os.path.realpath(sysfs)
+
+
+def _receive_requests(connection):
+    """
+    Read request lines together with the file descriptors sent along with them (SCM_RIGHTS)
+
+    :param connection: Unix socket of the client
+    :return: Iterator over (line, list of descriptors), the receiver closes the descriptors
+    """
+    buffer = b""
+    fds = []
+    try:
+        while True:
+            data, received, __, __ = socket.recv_fds(connection, 65536, MAX_REQUEST_FDS)
+            fds.extend(received)
+            if not data:
+                break
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                line_fds, fds = fds, []
+                yield line, line_fds
+        if buffer.strip():
+            line_fds, fds = fds, []
+            yield buffer, line_fds
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def _peer_credentials(connection):
+    """
+    :return: (uid, gid) of the process at the other end of a Unix socket
+    """
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    __, uid, gid = struct.unpack("3i", credentials)
+    return uid, gid
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, service, mode=0o600, owner=None):
+        """
+        :param socket_path: Path of the Unix socket to listen on, a stale socket file is replaced
+        :param service: Daemon serving the requests
+        :param mode: Permissions of the socket file
+        :param owner: User id the socket file is given to, so that this (unprivileged) user can connect, see
+            RequestHandler
+        """
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+        os.chmod(socket_path, mode)
+        if owner is not None:
+            os.chown(socket_path, owner, -1)
+        self.owner = owner
+        self.service = service
+
+
+def helper_socket_path(uid):
+    """
+    Socket of the helper started for the GUI of user uid, it lives in a directory only root can write to
+
+    :param uid: User id of the GUI
+    :return: Path
+    """
+    return "/run/woeusb-helper-" + str(uid) + ".sock"
+
+
+def request(socket_path, command, fds=(), **fields):
+    """
+    Send a single request to the daemon
+
+    :param socket_path: Path of the daemon's socket
+    :param command: submit, status, cancel or watch
+    :param fds: File descriptors sent along with the request, e.g. the opened source of a submit
+    :param fields: Additional keys of the request
+    :return: Iterator over the decoded reply lines
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    with connection, connection.makefile("rb") as stream:
+        socket.send_fds(connection, [json.dumps(dict(command=command, **fields)).encode("utf-8") + b"\n"], list(fds))
+        connection.shutdown(socket.SHUT_WR)
+
+        for line in stream:
+            yield json.loads(line)
+
+
+def run():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run WoeUSB installations submitted over a local Unix socket.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH,
+                        help="Path of the socket to listen on (default: " + DEFAULT_SOCKET_PATH + ")")
+    parser.add_argument("--max-jobs", type=int, default=2,
+                        help="Maximal amount of installations running at the same time (default: 2)")
+    parser.add_argument("--history", type=int, default=100,
+                        help="Amount of finished jobs kept for status queries (default: 100)")
+    parser.add_argument("--controller-bandwidth", type=utils.parse_size, default=None, metavar="SIZE",
+                        help="Write bandwidth per second shared by the jobs on one USB controller (default: derived from the controller's speed)")
+    parser.add_argument("--job-bandwidth", type=utils.parse_size, default=None, metavar="SIZE",
+                        help="Maximal write bandwidth per second of every job (default: unlimited)")
+    parser.add_argument("--owner", type=int, default=os.environ.get("PKEXEC_UID"),
+                        help="User id allowed to connect to the socket (default: user that invoked pkexec, if any)")
+    parser.add_argument("--exit-with-stdin", action="store_true",
+                        help="Exit once standard input is closed, used by the GUI to tie the helper to its session")
+    args = parser.parse_args()
+
+    try:
+        service = Daemon(args.max_jobs, args.history, args.controller_bandwidth, args.job_bandwidth)
+    except RuntimeError as error:
+        utils.print_with_color(str(error), "red")
+        return 1
+
+    server = Server(args.socket, service, owner=args.owner)
+
+    if args.exit_with_stdin:
+        def wait_for_stdin():
+            while sys.stdin.buffer.read(4096):
+                pass
+            server.shutdown()
+
+        threading.Thread(target=wait_for_stdin, daemon=True).start()
+
+    utils.print_with_color(_("Listening on {0}").format(args.socket), "green")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        service.shutdown()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
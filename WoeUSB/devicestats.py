@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""
+What the kernel says has really been written, as opposed to what the copy engine handed to it
+
+Block device statistics (/sys/class/block/<device>/stat) count the sectors that reached the device, the
+Dirty and Writeback counters of /proc/meminfo hold what is still cached on its way there.
+"""
+
+import os
+
+#: Unit of the sector counters in the block device statistics, whatever the device's sector size
+SECTOR_SIZE = 512
+
+#: Index of "write sectors" in /sys/class/block/<device>/stat
+_WRITE_SECTORS_FIELD = 6
+
+
+def bytes_written(device):
+    """
+    :param device: Block device or partition, e.g. /dev/sdb
+    :return: Bytes written to the device since it appeared, None if unknown
+    """
+    if device is None:
+        return None
+
+    try:
+        with open("/sys/class/block/" + os.path.basename(device) + "/stat") as stat:
+            return int(stat.read().split()[_WRITE_SECTORS_FIELD]) * SECTOR_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def unwritten_bytes():
+    """
+    :return: Dirty and under writeback page cache of the whole system in bytes, None if unknown
+    """
+    total = None
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                name, __, value = line.partition(":")
+                if name in ("Dirty", "Writeback"):
+                    total = (total or 0) + int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        return None
+    return total
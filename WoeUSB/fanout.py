@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+
+"""
+Install one source onto several target devices at once
+
+The source is mounted and scanned once, targets are prepared in parallel, and every source file is read once and
+broadcast to one writer thread per target through bounded queues.  A target whose queue stays full for longer than
+detach_timeout is detached from the broadcast and continues reading the source on its own, a failed target is
+dropped, so neither of them holds the other targets back.
+"""
+
+import os
+import time
+import queue
+import threading
+
+import WoeUSB.core as core
+import WoeUSB.utils as utils
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+
+class MessageReporter:
+    """
+    Progress reporter of the targets of a fan-out, forwards their warnings and errors to the reporter of the
+    fan-out along with the name of the target, the fan-out reports stages and progress of all targets itself
+    """
+
+    def __init__(self, reporter):
+        self.reporter = reporter
+        self.current_stage = reporter.current_stage
+
+    def stage(self, stage):
+        pass
+
+    def progress(self, done, total, force=False):
+        pass
+
+    def warning(self, message):
+        self.reporter.warning(message, target=self._target())
+
+    def error(self, message):
+        self.reporter.error(message, target=self._target())
+
+    def finish(self, status):
+        pass
+
+    @staticmethod
+    def _target():
+        job = utils.current_job()
+        if job is not None and job.name:
+            return job.name
+        return None
+
+
+class FanOut:
+    """
+    Installation of one source onto several targets, every target is driven by its own core.Installer
+    """
+
+    def __init__(self, source_media, target_medias, queue_depth=8, detach_timeout=2.0, progress_reporter=None,
+                 **settings):
+        """
+        :param source_media: Optical disk drive, disk image (optionally xz/zstd compressed), or http(s):// URL of a
+            disk image
+        :param target_medias: Target devices (or partitions, see install_mode)
+        :param queue_depth: Amount of buffers queued for each target writer
+        :param detach_timeout: Seconds the broadcast waits for a full writer queue before detaching the writer
+        :param progress_reporter: Structured progress output of the whole fan-out
+        :param settings: Keyword arguments of core.Installer shared by all targets
+        """
+        self.source_media = source_media
+        self.queue_depth = queue_depth
+        self.detach_timeout = detach_timeout
+        self.progress_reporter = progress_reporter
+        self.cancel_event = threading.Event()
+
+        self.installers = [core.Installer(source_media, target_media, name=os.path.basename(target_media),
+                                          **settings)
+                           for target_media in target_medias]
+
+        # All installers work from one mount of the source
+        self.source_fs_mountpoint = self.installers[0].source_fs_mountpoint
+        for installer in self.installers:
+            installer.source_fs_mountpoint = self.source_fs_mountpoint
+            installer.shared_source = True
+
+        #: blockexport.BlockExport a streamed source is read through, see core.export_source()
+        self.source_export = None
+
+        self.manifest = []
+        self.directories = []
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+        for installer in self.installers:
+            installer.cancel()
+
+    def active_installers(self):
+        return [installer for installer in self.installers if installer.result is None]
+
+    def run(self):
+        """
+        :return: 0 - every target succeeded; 1 - at least one target failed
+        """
+        # Warnings and errors of all threads, bound to a target or not, are reported as events of the fan-out
+        previous_reporter = utils.progress_reporter
+        if self.progress_reporter is not None:
+            utils.progress_reporter = MessageReporter(self.progress_reporter)
+        try:
+            return self._run()
+        finally:
+            utils.progress_reporter = previous_reporter
+
+    def _run(self):
+        import tempfile
+
+        for installer in self.installers:
+            installer.temp_directory = tempfile.mkdtemp(prefix="WoeUSB.")
+
+        try:
+            self.main()
+        except (KeyboardInterrupt, SystemExit):
+            self.cancel()
+        except Exception as error:
+            utils.print_with_color(str(error), "red")
+
+        self._for_each(self.installers, self._cleanup)
+        if not core.cleanup_mountpoint(self.source_fs_mountpoint) and self.source_export is not None:
+            core.release_source_export(self.source_export)
+
+        for installer in self.installers:
+            if installer.state != "finished":
+                installer.result = 1
+            if installer.result:
+                utils.print_with_color(_("{0}: installation failed").format(installer.target_media), "red")
+            else:
+                utils.print_with_color(_("{0}: installation succeeded").format(installer.target_media), "green")
+
+        first = self.installers[0]
+        if first.nice is not None or first.io_priority is not None:
+            import WoeUSB.priority as priority
+
+            utils.print_with_color(_("Priority: {0}").format(priority.describe(first.nice, first.io_priority)))
+
+        result = 1 if any(installer.result for installer in self.installers) else 0
+        if self.progress_reporter is not None:
+            self.progress_reporter.finish(result)
+        return result
+
+    def main(self):
+        if self.installers[0].image_cache is not None:
+            utils.print_with_color(_("Error: --image-cache works with a single target only, install the targets one "
+                                     "after another to flash them from the cache"), "red")
+            return 1
+
+        # Tools are looked up once for all targets
+        commands = utils.check_runtime_dependencies(core.application_name)
+        for installer in self.installers:
+            installer.commands = commands
+            installer.state = "enter-init"
+
+        if self.installers[0].source_backend == "parse":
+            utils.print_with_color(_("Warning: Targets share one mount of the source, --source-backend parse is "
+                                     "ignored"), "yellow")
+
+        # A streamed source is exported once, every target reads the same device
+        try:
+            self.source_export = core.export_source(self.source_media)
+        except OSError as error:
+            utils.print_with_color(_("Error: Unable to read source {0}: {1}").format(self.source_media, error), "red")
+            return 1
+        if self.source_export is not None:
+            self.source_media = self.source_export.device
+            for installer in self.installers:
+                installer.source_media = self.source_media
+
+        # The targets share version, priority and user, these are printed once
+        self.installers[0].announce()
+        self._for_each(self.installers, lambda installer: installer.check_environment(announce=False),
+                       parallel=False)
+        if not self.active_installers():
+            return 1
+
+        if utils.check_is_target_device_busy(self.source_media):
+            utils.print_with_color(_("Error: Source media is currently mounted, unmount the partition then try again"),
+                                   "red")
+            return 1
+
+        if self.installers[0].disc_cache is not None:
+            import WoeUSB.rip as rip
+
+            if rip.is_optical(self.source_media):
+                self._report_stage("ripping")
+                self.source_media = rip.rip_disc(self.source_media, self.installers[0].disc_cache)
+                if self.source_media is None:
+                    return 1
+
+        self._report_stage("mounting")
+        if core.mount_source_filesystem(self.source_media, self.source_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to mount source filesystem"), "red")
+            return 1
+
+        self.scan_source()
+
+        for installer in self.active_installers():
+            installer.state = "start-mounting"
+        self._report_stage("partitioning")
+        self._for_each(self.active_installers(), lambda installer: installer.prepare_target())
+
+        for installer in self.active_installers():
+            installer.state = "copying-filesystem"
+        self._report_stage("copying")
+        self.copy_files()
+
+        self._report_stage("bootloader")
+        self._for_each(self.active_installers(), lambda installer: installer.finalize_target())
+
+        self._report_stage("flushing")
+        self._for_each(self.active_installers(), self._flush)
+
+        self._report_stage("finished")
+        return 0
+
+    def scan_source(self):
+        """
+        Walk the source filesystem once, collecting directories and files for every target, every target chooses
+        its layout from the profile of the files on its own
+        """
+        import WoeUSB.layout as layout
+
+        for dirpath, __, filenames in os.walk(self.source_fs_mountpoint):
+            self.directories.append(os.path.relpath(dirpath, self.source_fs_mountpoint))
+            for file in filenames:
+                path = os.path.join(dirpath, file)
+                self.manifest.append((os.path.relpath(path, self.source_fs_mountpoint), os.path.getsize(path)))
+
+        profile = layout.SourceProfile(self.manifest)
+        for installer in self.installers:
+            installer.source_profile = profile
+            installer.source_size = profile.size
+            installer.bytes_total = profile.size
+
+    def copy_files(self):
+        """
+        Read every source file once and broadcast it to the writers of all active targets
+        """
+        utils.print_with_color(_("Copying files from source media..."), "green")
+
+        for installer in self.active_installers():
+            installer.start_device_accounting()
+
+        # Buffers broadcast to the writers suit every target's geometry, chunk sizes are multiples of alignments
+        chunk_size = max(installer.copy_chunk_size() for installer in self.active_installers()) \
+            if self.active_installers() else 0
+
+        writers = [TargetWriter(installer, self, self.queue_depth) for installer in self.active_installers()]
+        for writer in writers:
+            writer.start()
+
+        reporter = FanOutProgress(self, writers)
+        reporter.start()
+
+        try:
+            for index, (path, size) in enumerate(self.manifest):
+                if self.cancelled:
+                    raise SystemExit
+
+                if not any(writer.attached for writer in writers):
+                    break
+
+                offset = 0
+                for data in core.read_source_chunks(os.path.join(self.source_fs_mountpoint, path), chunk_size):
+                    self._broadcast(writers, (index, offset, data))
+                    offset += len(data)
+
+                self._broadcast(writers, (index, offset, None))
+
+            self._broadcast(writers, None)
+        except BaseException:
+            # Writers still waiting for the broadcast stop after their queued buffers
+            for writer in writers:
+                if writer.attached:
+                    writer.detach(len(self.manifest), 0)
+            raise
+        finally:
+            for writer in writers:
+                writer.join()
+            reporter.stop = True
+            reporter.join()
+
+    def _broadcast(self, writers, item):
+        for writer in writers:
+            if not writer.attached:
+                continue
+
+            if writer.failed:
+                writer.attached = False
+                continue
+
+            try:
+                writer.queue.put(item, timeout=self.detach_timeout)
+            except queue.Full:
+                if item is None:
+                    writer.detach(len(self.manifest), 0)
+                else:
+                    writer.detach(item[0], item[1])
+                utils.print_with_color(
+                    _("Warning: {0} can't keep up with the other targets, it continues on its own").format(
+                        writer.installer.target_media),
+                    "yellow")
+
+    def _report_stage(self, stage):
+        if self.progress_reporter is not None:
+            self.progress_reporter.stage(stage)
+
+    def _flush(self, installer):
+        installer.flush_target()
+        installer.state = "finished"
+
+    def _cleanup(self, installer):
+        installer.cleanup()
+
+    def _for_each(self, installers, function, parallel=True):
+        """
+        Call function for every installer in a thread bound to it, installers it fails for are marked as failed
+
+        :param installers: Installers to call function for
+        :param function: Called with the installer, a non-zero return value means failure
+        :param parallel: Run the calls concurrently
+        """
+        def call(installer):
+            utils.bind_job(installer)
+            try:
+                if function(installer):
+                    installer.result = 1
+            except (KeyboardInterrupt, SystemExit):
+                installer.result = 1
+            except Exception as error:
+                installer.result = 1
+                utils.print_with_color(str(error), "red")
+            finally:
+                utils.bind_job(None)
+
+        if not parallel:
+            for installer in installers:
+                call(installer)
+            return
+
+        threads = [threading.Thread(target=call, args=(installer,)) for installer in installers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+class TargetWriter(threading.Thread):
+    """
+    Writes the broadcast buffers into one target, or reads the source by itself once detached
+    """
+
+    def __init__(self, installer, fanout, queue_depth):
+        threading.Thread.__init__(self)
+        self.installer = installer
+        self.fanout = fanout
+        self.queue = queue.Queue(queue_depth)
+
+        #: Still fed by the broadcast
+        self.attached = True
+        #: (manifest index, offset) of the first buffer the broadcast didn't deliver
+        self.resume_from = None
+        self.failed = False
+
+        self._index = None
+        self._file = None
+
+    def detach(self, index, offset):
+        self.attached = False
+        self.resume_from = (index, offset)
+
+    def run(self):
+        utils.bind_job(self.installer)
+        target_fs_mountpoint = self.installer.target_fs_mountpoint
+
+        if self.installer.bandwidth_scheduler is not None:
+            self.installer.bandwidth = self.installer.bandwidth_scheduler.register(self.installer.name,
+                                                                                   self.installer.target_device)
+
+        try:
+            for directory in self.fanout.directories:
+                os.makedirs(os.path.join(target_fs_mountpoint, directory), exist_ok=True)
+
+            while True:
+                try:
+                    item = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    if self.resume_from is not None:
+                        self._copy_on_own(*self.resume_from)
+                        break
+                    continue
+
+                if item is None:
+                    break
+                self._handle(*item)
+
+            self.installer.split_source_wims()
+            self.installer.close_target_files()
+        except (KeyboardInterrupt, SystemExit):
+            self.failed = True
+        except Exception as error:
+            self.failed = True
+            utils.print_with_color(str(error), "red")
+        finally:
+            if self._file is not None:
+                self._file.close()
+            if self.installer.bandwidth is not None:
+                self.installer.bandwidth.release()
+                self.installer.bandwidth = None
+            if self.failed:
+                self.installer.result = 1
+            utils.bind_job(None)
+
+    def _handle(self, index, offset, data):
+        utils.check_kill_signal()
+
+        if self.fanout.manifest[index][0] in self.installer.split_wims:
+            return  # Split at the end, see Installer.split_source_wims()
+
+        if index != self._index:
+            path = os.path.join(self.installer.target_fs_mountpoint, self.fanout.manifest[index][0])
+            self._file = self.installer.open_target_file(path)
+            self._index = index
+            self.installer.current_file = path
+
+        if data is None:
+            self._file.close()
+            self._file = None
+        else:
+            if self.installer.bandwidth is not None:
+                self.installer.bandwidth.consume(len(data))
+
+            self._file.write(data)
+            self.installer.bytes_copied += len(data)
+
+    def _copy_on_own(self, index, offset):
+        for current in range(index, len(self.fanout.manifest)):
+            path, size = self.fanout.manifest[current]
+            if path in self.installer.split_wims:
+                continue
+
+            position = offset if current == index else 0
+
+            for data in core.read_source_chunks(os.path.join(self.fanout.source_fs_mountpoint, path),
+                                                self.installer.copy_chunk_size(), position):
+                self._handle(current, position, data)
+                position += len(data)
+
+            self._handle(current, position, None)
+
+
+class FanOutProgress(threading.Thread):
+    """
+    Prints one line with the progress of every target, at most once per interval
+    """
+    stop = False
+
+    def __init__(self, fanout, writers, interval=2.0):
+        threading.Thread.__init__(self)
+        self.fanout = fanout
+        self.writers = writers
+        self.interval = interval
+
+    def run(self):
+        last_print = 0
+        while not self.stop:
+            time.sleep(0.1)
+
+            reporter = self.fanout.progress_reporter
+            if reporter is not None:
+                done = total = 0
+                for writer in self.writers:
+                    installer = writer.installer
+                    reporter.progress(installer.bytes_on_device(), installer.bytes_total, target=installer.name)
+                    done += installer.bytes_on_device()
+                    total += installer.bytes_total
+                reporter.progress(done, total)
+
+            if time.monotonic() - last_print < self.interval:
+                continue
+            last_print = time.monotonic()
+
+            states = []
+            for writer in self.writers:
+                installer = writer.installer
+                percentage = (installer.bytes_on_device() * 100) // installer.bytes_total if installer.bytes_total else 100
+                if writer.failed:
+                    states.append(installer.name + ": " + _("failed"))
+                elif writer.resume_from is not None:
+                    states.append(installer.name + ": " + str(percentage) + "% " + _("(detached)"))
+                else:
+                    states.append(installer.name + ": " + str(percentage) + "%")
+
+            utils.print_with_color("  ".join(states))
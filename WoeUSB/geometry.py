@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+Flash-aware layout of the target device: partition alignment, cluster size and copy chunk size
+
+USB sticks rarely tell their erase block size, but some report optimal/minimum I/O size or discard granularity
+in sysfs, which is the best hint there is.  Partitions are aligned to it (at least 4 MiB, which covers the erase
+blocks of common flash and leaves GRUB its post-MBR gap), clusters are sized after the capacity (big clusters keep
+the FATs of big sticks small) and raised to the I/O hint, and copy chunks are a multiple of the alignment so that
+writes cover whole erase blocks.
+"""
+
+import os
+
+import WoeUSB.utils as utils
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+KiB = 1024
+MiB = 1024 * KiB
+GiB = 1024 * MiB
+
+#: Smallest partition alignment, see create_target_partition()
+MINIMAL_ALIGNMENT = 4 * MiB
+MAXIMAL_ALIGNMENT = 16 * MiB
+#: Smallest alignment accepted as an override, anything less starts the partition inside GRUB's post-MBR gap
+MINIMAL_ALIGNMENT_OVERRIDE = 1 * MiB
+
+#: FAT32 cluster size by capacity, as chosen by Windows: (up to capacity, cluster size)
+FAT32_CLUSTER_SIZES = [(8 * GiB, 4 * KiB), (16 * GiB, 8 * KiB), (32 * GiB, 16 * KiB), (None, 32 * KiB)]
+MAXIMAL_FAT32_CLUSTER = 32 * KiB
+#: Fewer clusters make a FAT16 volume, whatever the FAT says
+MINIMAL_FAT32_CLUSTERS = 65525
+
+NTFS_CLUSTER_SIZE = 4 * KiB
+MAXIMAL_NTFS_CLUSTER = 64 * KiB
+
+#: exFAT cluster size by capacity, as chosen by Windows
+EXFAT_CLUSTER_SIZES = [(256 * MiB, 4 * KiB), (32 * GiB, 32 * KiB), (None, 128 * KiB)]
+MAXIMAL_EXFAT_CLUSTER = 32 * MiB
+
+#: Copy chunks are at least this big, speeds of shitty pendrives can be as low as 2 MiB/s
+MINIMAL_CHUNK_SIZE = 4 * MiB
+
+
+class Geometry:
+    """
+    Layout chosen for a target device
+    """
+
+    def __init__(self, alignment, cluster_size, chunk_size, io_hint, capacity, sector_size=512):
+        """
+        :param alignment: Start (and alignment) of the target partition in bytes
+        :param cluster_size: Cluster size of the target filesystem in bytes
+        :param chunk_size: Size of the writes of the copy engine in bytes
+        :param io_hint: Erase block size guessed from sysfs in bytes, 0 if the device gives no hint
+        :param capacity: Size of the device in bytes, 0 if unknown
+        :param sector_size: Logical sector size of the device in bytes
+        """
+        self.alignment = alignment
+        self.cluster_size = cluster_size
+        self.chunk_size = chunk_size
+        self.io_hint = io_hint
+        self.capacity = capacity
+        self.sector_size = sector_size
+
+    def describe(self):
+        size = utils.convert_to_human_readable_format
+        return _("alignment {0}, cluster size {1}, copy chunk {2} (device I/O hint: {3})").format(
+            size(self.alignment), size(self.cluster_size), size(self.chunk_size),
+            size(self.io_hint) if self.io_hint else _("none"))
+
+
+def detect(target_device, filesystem_type, alignment=None, cluster_size=None, chunk_size=None,
+           reference_device=None):
+    """
+    Choose geometry for target_device, values given explicitly are kept as they are
+
+    :param target_device: Block device, e.g. /dev/sdb
+    :param filesystem_type: "FAT", "NTFS" or "EXFAT"
+    :param alignment: Override of the partition alignment in bytes
+    :param cluster_size: Override of the cluster size in bytes
+    :param chunk_size: Override of the copy chunk size in bytes
+    :param reference_device: Device an image built on target_device is meant for, its capacity and I/O hint
+        choose the layout instead of target_device's
+    :return: Geometry, None if an override isn't valid for the device or the filesystem
+    """
+    if reference_device is None:
+        reference_device = target_device
+    io_hint = _io_hint(reference_device)
+    capacity = _capacity(reference_device)
+    sector_size = 512
+    if target_device is not None:
+        sector_size = _read_number(os.path.join(_sysfs_queue(target_device), "logical_block_size")) or 512
+
+    size = utils.convert_to_human_readable_format
+    if alignment is not None and (alignment < MINIMAL_ALIGNMENT_OVERRIDE or alignment % sector_size):
+        utils.print_with_color(
+            _("Error: Partition alignment must be a multiple of the sector size ({0}) of at least {1}").format(
+                size(sector_size), size(MINIMAL_ALIGNMENT_OVERRIDE)), "red")
+        return None
+
+    if cluster_size is not None:
+        maximum = {"NTFS": MAXIMAL_NTFS_CLUSTER, "EXFAT": MAXIMAL_EXFAT_CLUSTER}.get(filesystem_type,
+                                                                                   MAXIMAL_FAT32_CLUSTER)
+        if cluster_size & (cluster_size - 1) or not sector_size <= cluster_size <= maximum:
+            utils.print_with_color(
+                _("Error: Cluster size must be a power of two from {0} to {1}").format(size(sector_size),
+                                                                                        size(maximum)), "red")
+            return None
+
+    if alignment is None:
+        alignment = min(max(MINIMAL_ALIGNMENT, _power_of_two(io_hint)), MAXIMAL_ALIGNMENT)
+
+    if cluster_size is None:
+        if filesystem_type == "NTFS":
+            cluster_size = min(max(NTFS_CLUSTER_SIZE, _power_of_two(io_hint)), MAXIMAL_NTFS_CLUSTER)
+        else:
+            sizes, maximum = FAT32_CLUSTER_SIZES, MAXIMAL_FAT32_CLUSTER
+            if filesystem_type == "EXFAT":
+                sizes, maximum = EXFAT_CLUSTER_SIZES, MAXIMAL_EXFAT_CLUSTER
+            for limit, size in sizes:
+                if limit is None or capacity <= limit:
+                    cluster_size = size
+                    break
+            cluster_size = min(max(cluster_size, _power_of_two(io_hint)), maximum)
+
+    if chunk_size is None:
+        chunk_size = (MINIMAL_CHUNK_SIZE + alignment - 1) // alignment * alignment
+
+    return Geometry(alignment, cluster_size, chunk_size, io_hint, capacity, sector_size)
+
+
+def minimal_size(filesystem_type, target_geometry):
+    """
+    :return: Size in bytes of the smallest device a filesystem of target_geometry's cluster size fits onto
+    """
+    if filesystem_type != "FAT":
+        return 0
+
+    # Both FATs of 4-byte entries, rounded up to whole MiBs along with the partition start
+    clusters = MINIMAL_FAT32_CLUSTERS + 1
+    size = target_geometry.alignment + clusters * target_geometry.cluster_size + 2 * 4 * clusters
+    return (size + MiB - 1) // MiB * MiB + MiB
+
+
+def _sysfs_queue(device):
+    name = os.path.basename(device)
+    queue = "/sys/class/block/" + name + "/queue"
+    if not os.path.isdir(queue):  # Partitions share the queue of their device
+        queue = os.path.realpath("/sys/class/block/" + name) + "/../queue"
+    return queue
+
+
+def _read_number(path):
+    try:
+        with open(path) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def _io_hint(device):
+    if device is None:
+        return 0
+
+    queue = _sysfs_queue(device)
+    hints = [_read_number(os.path.join(queue, attribute))
+             for attribute in ["optimal_io_size", "discard_granularity", "minimum_io_size"]]
+    # minimum_io_size of 512 or 4096 is just the sector size, no hint about flash
+    hints = [hint for hint in hints if hint > 4 * KiB]
+    return max(hints) if hints else 0
+
+
+def _capacity(device):
+    if device is None:
+        return 0
+    return _read_number("/sys/class/block/" + os.path.basename(device) + "/size") * 512
+
+
+def _power_of_two(size):
+    power = 1
+    while power < size:
+        power *= 2
+    return power if size else 0
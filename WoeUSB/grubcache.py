@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+"""
+Cache of GRUB legacy PC boot code, replayed instead of running grub-install (--grub-cache)
+
+grub-install --target=i386-pc probes the target, loads modules and generates a core image on every run, which
+takes seconds per target.  What it writes only depends on the GRUB build, the partition table type, the offset and
+number of the partition and its filesystem type: the boot code in the MBR, the core image embedded in the gap
+between the MBR and the first partition, and the files of the GRUB directory on the target filesystem.  These are
+captured after a grub-install and written directly on later runs, then read back for verification.
+
+Like grub-install, replaying keeps the BIOS parameter block, disk signature and partition table of the MBR.  An
+installation that isn't relocatable isn't cached: a core image in blocklists of the filesystem, or one that finds
+the GRUB directory by the UUID of its filesystem.  The core image is compressed, so the latter can't be told from
+its bytes; it is told from what grub-install gets: for a GRUB directory on a plain partition of the very disk it
+installs to, grub-install (i386-pc) sets the prefix relative to the boot disk, e.g. (,msdos1)/grub, and searches
+nothing, otherwise (another disk, LVM, RAID, encryption) it searches for the filesystem's UUID.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+DEFAULT_DIRECTORY = "/var/cache/woeusb/grub"
+
+SECTOR_SIZE = 512
+#: Boot code in the MBR, the disk signature and the partition table follow it
+BOOT_CODE_SIZE = 440
+#: BIOS parameter block inside the boot code, kept from the target
+BPB_START = 0x03
+BPB_END = 0x5a
+#: Sector of the core image GRUB's boot code loads, 1 when it's embedded right after the MBR
+KERNEL_SECTOR = 0x5c
+
+#: Written by install_legacy_pc_bootloader_grub_config(), not by grub-install
+_EXCLUDED_FILES = ["grub.cfg"]
+
+
+def grub_version(command_grubinstall):
+    """
+    :param command_grubinstall: grub-install or grub2-install
+    :return: Version of GRUB with a digest of the command, distributions patch the same version differently
+    :raise OSError: Command can't be run
+    """
+    result = subprocess.run([command_grubinstall, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        raise OSError(_("Unable to determine version of {0}").format(command_grubinstall))
+
+    path = shutil.which(command_grubinstall)
+    with open(path, "rb") as command:
+        digest = hashlib.sha256(command.read()).hexdigest()
+    return result.stdout.decode("utf-8", "replace").strip() + " " + digest
+
+
+def partition_geometry(target_partition):
+    """
+    :param target_partition: Partition device file, e.g. /dev/sdb1 or /dev/loop0p1
+    :return: (offset in bytes, number) of the partition on its device
+    :raise OSError: Partition isn't known to the kernel
+    """
+    sysfs = "/sys/class/block/" + os.path.basename(os.path.realpath(target_partition))
+    with open(sysfs + "/start") as start, open(sysfs + "/partition") as number:
+        return int(start.read()) * SECTOR_SIZE, int(number.read())
+
+
+def on_device(target_device, target_partition):
+    """
+    :return: Whether target_partition is a plain partition of target_device, no device mapper or RAID in between
+    """
+    partition = os.path.realpath("/sys/class/block/" + os.path.basename(os.path.realpath(target_partition)))
+    return os.path.isfile(os.path.join(partition, "partition")) \
+        and os.path.basename(os.path.dirname(partition)) == os.path.basename(os.path.realpath(target_device))
+
+
+def probe(device, tag):
+    """
+    :param device: Block device file
+    :param tag: blkid tag, e.g. TYPE, UUID or PTTYPE
+    :return: Value of the tag, "" if the device has none
+    """
+    result = subprocess.run(["blkid", "-p", "-o", "value", "-s", tag, device], stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    return result.stdout.decode("utf-8", "replace").strip()
+
+
+class GRUBCache:
+    """
+    Directory of <key>/ entries holding boot.img (the boot code), core.img (the embedded core image), the GRUB
+    directory and manifest.json with digests of all of them
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        """
+        :param directory: Cache directory, created if missing
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, command_grubinstall, target_device, target_partition, name_grub_prefix):
+        """
+        :param command_grubinstall: grub-install or grub2-install
+        :param target_device: Entire device GRUB is installed on
+        :param target_partition: Partition holding the GRUB directory
+        :param name_grub_prefix: Name of the GRUB directory, grub or grub2
+        :return: Cache key
+        :raise OSError: Target can't be inspected
+        """
+        offset, number = partition_geometry(target_partition)
+        inputs = [grub_version(command_grubinstall), probe(target_device, "PTTYPE"), offset, number,
+                  probe(target_partition, "TYPE"), name_grub_prefix]
+        return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()[:32]
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key):
+        """
+        :return: Manifest of the cached installation, None on a miss
+        """
+        try:
+            with open(os.path.join(self.entry_path(key), "manifest.json")) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, target_device, target_partition, target_fs_mountpoint, name_grub_prefix):
+        """
+        Capture the installation grub-install has just made on the target
+
+        :return: None on success, otherwise the reason it can't be cached
+        """
+        if not on_device(target_device, target_partition):
+            return _("The GRUB directory isn't on a partition of {0}, GRUB finds it by its UUID").format(
+                target_device)
+
+        grub_directory = os.path.join(target_fs_mountpoint, name_grub_prefix)
+        core_path = os.path.join(grub_directory, "i386-pc", "core.img")
+        if not os.path.isfile(core_path):
+            return _("{0} is missing").format(core_path)
+
+        offset, __ = partition_geometry(target_partition)
+        core_size = -(-os.path.getsize(core_path) // SECTOR_SIZE) * SECTOR_SIZE
+        if SECTOR_SIZE + core_size > offset:
+            return _("Core image doesn't fit in front of the partition")
+
+        fd = os.open(target_device, os.O_RDONLY)
+        try:
+            boot = os.pread(fd, BOOT_CODE_SIZE, 0)
+            core = os.pread(fd, core_size, SECTOR_SIZE)
+        finally:
+            os.close(fd)
+        if int.from_bytes(boot[KERNEL_SECTOR:KERNEL_SECTOR + 8], "little") != 1:
+            return _("Core image isn't embedded after the MBR")
+
+        files = {}
+        for root, __, names in os.walk(grub_directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.relpath(path, grub_directory) not in _EXCLUDED_FILES:
+                    files[os.path.relpath(path, target_fs_mountpoint)] = path
+
+        temporary = tempfile.mkdtemp(prefix=key + ".", suffix=".partial", dir=self.directory)
+        try:
+            for name, data in [("boot.img", boot), ("core.img", core)]:
+                with open(os.path.join(temporary, name), "wb") as file:
+                    file.write(data)
+            for path, source in files.items():
+                os.makedirs(os.path.join(temporary, "files", os.path.dirname(path)), exist_ok=True)
+                shutil.copyfile(source, os.path.join(temporary, "files", path))
+
+            manifest = dict(boot=_digest(boot), core=_digest(core),
+                            files={path: _digest(_read(source)) for path, source in files.items()},
+                            created=time.time())
+            with open(os.path.join(temporary, "manifest.json"), "w") as file:
+                json.dump(manifest, file)
+
+            os.rename(temporary, self.entry_path(key))
+        except OSError:
+            # Stored by another target meanwhile, or the cache is unwritable
+            shutil.rmtree(temporary, ignore_errors=True)
+        return None
+
+    def replay(self, key, manifest, target_device, target_fs_mountpoint):
+        """
+        Write a cached installation onto the target and read it back
+
+        :param manifest: Manifest returned by lookup()
+        :return: 0 - success; 1 - failure, the cache entry or the target doesn't match
+        """
+        entry = self.entry_path(key)
+        try:
+            boot = _read(os.path.join(entry, "boot.img"))
+            core = _read(os.path.join(entry, "core.img"))
+            if _digest(boot) != manifest["boot"] or _digest(core) != manifest["core"]:
+                return 1
+
+            for path, digest in manifest["files"].items():
+                target = os.path.join(target_fs_mountpoint, path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(entry, "files", path), target)
+
+            fd = os.open(target_device, os.O_RDWR)
+            try:
+                mbr = os.pread(fd, SECTOR_SIZE, 0)
+                os.pwrite(fd, core, SECTOR_SIZE)
+                os.pwrite(fd, boot[:BPB_START] + mbr[BPB_START:BPB_END] + boot[BPB_END:], 0)
+                os.fsync(fd)
+
+                # Read back from the device, not from the page cache
+                os.posix_fadvise(fd, 0, SECTOR_SIZE + len(core), os.POSIX_FADV_DONTNEED)
+                written = os.pread(fd, BOOT_CODE_SIZE, 0)
+                if written[:BPB_START] + written[BPB_END:] != boot[:BPB_START] + boot[BPB_END:] \
+                        or os.pread(fd, len(core), SECTOR_SIZE) != core:
+                    return 1
+            finally:
+                os.close(fd)
+
+            for path, digest in manifest["files"].items():
+                if _digest(_read(os.path.join(target_fs_mountpoint, path))) != digest:
+                    return 1
+        except (OSError, KeyError):
+            return 1
+
+        return 0
+
+    def discard(self, key):
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+
+def _read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
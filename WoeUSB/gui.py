@@ -1,15 +1,12 @@
 #!/usr/bin/env python3
 
 import os
-import time
 import threading
 
-# Patch wxPython to avoid native GTK dialogs
+# Patch wxPython to avoid native GTK dialogs, when wx_patch is available on the module search path
 try:
-    import sys
-    sys.path.insert(0, '/var/home/ben/code/WoeUSB-ng')
     import wx_patch
-except:
+except ImportError:
     pass
 
 import wx
@@ -22,10 +19,17 @@ import WoeUSB.miscellaneous as miscellaneous
 
 data_directory = os.path.dirname(__file__) + "/data/"
 
-app = wx.App()
+#: Created in run(), importing this module must not initialize the toolkit
+app = None
 
 _ = miscellaneous.i18n
 
+# How many times per second the progress dialog is refreshed while installing
+try:
+    progress_frame_rate = max(1, int(os.environ.get("WOEUSB_PROGRESS_FPS", "15")))
+except ValueError:
+    progress_frame_rate = 15
+
 
 class MainFrame(wx.Frame):
     __MainPanel = None
@@ -114,6 +118,10 @@ class MainPanel(wx.Panel):
     __isoChoice = None
     __dvdChoice = None
 
+    __woe = None
+    __progressDialog = None
+    __progressTimer = None
+
     def __init__(self, parent, ID, pos=wx.DefaultPosition, size=wx.DefaultSize, style=wx.TAB_TRAVERSAL):
         super(MainPanel, self).__init__(parent, ID, pos, size, style)
 
@@ -180,6 +188,9 @@ class MainPanel(wx.Panel):
         self.Bind(wx.EVT_RADIOBUTTON, self.on_source_option_changed, self.__isoChoice)
         self.Bind(wx.EVT_RADIOBUTTON, self.on_source_option_changed, self.__dvdChoice)
 
+        self.__progressTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_progress_timer, self.__progressTimer)
+
         self.refresh_list_content()
         self.on_source_option_changed(wx.CommandEvent)
         install_ok = self.is_install_ok()
@@ -249,7 +260,6 @@ class MainPanel(wx.Panel):
         self.refresh_list_content()
 
     def on_install(self, __):
-        global woe
         print("DEBUG: Install button clicked!")
         print(f"DEBUG: Install OK check: {self.is_install_ok()}")
         
@@ -257,7 +267,7 @@ class MainPanel(wx.Panel):
         print("DEBUG: Skipping confirmation dialog due to GTK issues - proceeding directly")
         print("DEBUG: User confirmed installation (auto-confirmed), proceeding...")
         
-        if self.is_install_ok():
+        if self.is_install_ok() and self.__woe is None:
             is_iso = self.__isoChoice.GetValue()
 
             device = self.__usbStickDevList[self.__usbStickList.GetSelection()]
@@ -271,35 +281,70 @@ class MainPanel(wx.Panel):
                 filesystem = "NTFS"
             else:
                 filesystem = "FAT"
-		
-            woe = WoeUSB_handler(iso, device, boot_flag=self.__parent.options_boot.IsChecked(), filesystem=filesystem, skip_grub=self.__parent.options_skip_grub.IsChecked())
-            woe.start()
-
-            dialog = wx.ProgressDialog(_("Installing"), _("Please wait..."), 101, self.GetParent(),
-                                       wx.PD_APP_MODAL | wx.PD_SMOOTH | wx.PD_CAN_ABORT)
-
-            while woe.is_alive():
-                if not woe.progress:
-                    status = dialog.Pulse(woe.state)[0]
-                    time.sleep(0.06)
-                else:
-                    status = dialog.Update(woe.progress, woe.state)[0]
-
-                if not status:
-                    if wx.MessageBox(_("Are you sure you want to cancel the installation?"), _("Cancel"),
-                                     wx.YES_NO | wx.ICON_QUESTION, self) == wx.NO:
-                        dialog.Resume()
-                    else:
-                        woe.kill = True
-                        break
-            dialog.Destroy()
-
-            if woe.error == "":
-                wx.MessageBox(_("Installation succeeded!"), _("Installation"), wx.OK | wx.ICON_INFORMATION, self)
+
+            self.__woe = WoeUSB_handler(iso, device, boot_flag=self.__parent.options_boot.IsChecked(),
+                                        filesystem=filesystem, skip_grub=self.__parent.options_skip_grub.IsChecked(),
+                                        on_finished=self.on_install_finished)
+
+            self.__progressDialog = wx.ProgressDialog(_("Installing"), _("Please wait..."), 101, self.GetParent(),
+                                                      wx.PD_APP_MODAL | wx.PD_SMOOTH | wx.PD_CAN_ABORT)
+            self.__btInstall.Enable(False)
+
+            # The worker only stores its progress, the dialog is refreshed by the timer at progress_frame_rate
+            self.__woe.start()
+            self.__progressTimer.Start(1000 // progress_frame_rate)
+
+    def on_progress_timer(self, __):
+        woe = self.__woe
+        dialog = self.__progressDialog
+        if woe is None or dialog is None or woe.kill:
+            return
+
+        if not woe.progress:
+            status = dialog.Pulse(woe.state)[0]
+        else:
+            status = dialog.Update(woe.progress, woe.state)[0]
+
+        if not status:
+            self.__progressTimer.Stop()
+            answer = wx.MessageBox(_("Are you sure you want to cancel the installation?"), _("Cancel"),
+                                   wx.YES_NO | wx.ICON_QUESTION, self)
+
+            # The installation may have finished while the question was open, destroying the dialog
+            if self.__progressDialog is not dialog:
+                return
+
+            if answer == wx.NO:
+                dialog.Resume()
             else:
-                wx.MessageBox(_("Installation failed!") + "\n" + str(woe.error), _("Installation"),
-                              wx.OK | wx.ICON_ERROR,
-                              self)
+                # The worker notices the flag in utils.check_kill_signal() and reports back through on_finished
+                woe.kill = True
+                dialog.Pulse(_("Cancelling..."))
+
+            if self.__woe is not None:
+                self.__progressTimer.Start(1000 // progress_frame_rate)
+
+    def on_install_finished(self):
+        self.__progressTimer.Stop()
+
+        woe = self.__woe
+        self.__woe = None
+
+        if self.__progressDialog is not None:
+            self.__progressDialog.Destroy()
+            self.__progressDialog = None
+
+        self.__btInstall.Enable(self.is_install_ok())
+
+        if woe.kill:
+            return
+
+        if woe.error == "":
+            wx.MessageBox(_("Installation succeeded!"), _("Installation"), wx.OK | wx.ICON_INFORMATION, self)
+        else:
+            wx.MessageBox(_("Installation failed!") + "\n" + str(woe.error), _("Installation"),
+                          wx.OK | wx.ICON_ERROR,
+                          self)
 
     def on_show_all_drive(self, __):
         self.refresh_list_content()
@@ -412,33 +457,36 @@ class WoeUSB_handler(threading.Thread):
     error = ""
     kill = False
 
-    def __init__(self, source, target, boot_flag, filesystem, skip_grub=False):
+    def __init__(self, source, target, boot_flag, filesystem, skip_grub=False, on_finished=None):
+        """
+        :param on_finished: Called on the UI thread through wx.CallAfter once the installation ended
+        """
         threading.Thread.__init__(self)
 
-        core.gui = self
         self.source = source
         self.target = target
         self.boot_flag = boot_flag
         self.filesystem = filesystem
         self.skip_grub = skip_grub
+        self.on_finished = on_finished
 
     def run(self):
-        source_fs_mountpoint, target_fs_mountpoint, temp_directory, target_media = core.init(
-            from_cli=False,
-            install_mode="device",
-            source_media=self.source,
-            target_media=self.target
-        )
+        installer = core.Installer(self.source, self.target, "device", self.filesystem,
+                                   workaround_bios_boot_flag=self.boot_flag, skip_legacy_bootloader=self.skip_grub,
+                                   no_color=True, gui=self)
         try:
-            core.main(source_fs_mountpoint, target_fs_mountpoint, self.source, self.target, "device", temp_directory,
-                      self.filesystem, self.boot_flag , None, self.skip_grub)
-        except SystemExit:
-            pass
-
-        core.cleanup(source_fs_mountpoint, target_fs_mountpoint, temp_directory, target_media)
+            installer.run()
+        finally:
+            if self.on_finished is not None:
+                wx.CallAfter(self.on_finished)
 
 
 def run():
+    global app
+
+    if app is None:
+        app = wx.App()
+
     frameTitle = "WoeUSB-ng"
 
     frame = MainFrame(frameTitle, wx.DefaultPosition, wx.Size(400, 600))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+"""
+Source ISO read straight from an http(s):// URL, without downloading it first
+
+The image is read with HTTP range requests in blocks of BLOCK_SIZE, each fetched once into a bounded in-memory
+cache.  Fetches run on a few threads, each keeping its connection to the server alive, and a read continuing a
+sequential stream prefetches the blocks following it, so the copy of a large file reads ahead of the kernel.  The
+reader is exported as a block device (see WoeUSB.blockexport) and mounted as any other source, files are copied
+as soon as their extents have arrived.
+
+The server must answer range requests (206 Partial Content).  Redirects (typically to a mirror) are followed
+once, when the image is opened, and all reads go to the final URL.  An image changed on the server while it is
+read is caught by If-Range with the validator of the first response, a strong ETag or Last-Modified (weak ETags
+aren't allowed in If-Range), the server then answers with the whole new image (200), which fails the read instead
+of mixing two images.
+"""
+
+import time
+import threading
+import http.client
+import urllib.parse
+
+import WoeUSB.blockexport as blockexport
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+#: Size of the range requests, and of the blocks of the cache
+BLOCK_SIZE = 1024 * 1024
+#: Blocks kept in memory
+CACHE_BLOCKS = 64
+#: Blocks fetched ahead of a sequential read
+PREFETCH_BLOCKS = 8
+#: Parallel fetches, each on a connection of its own
+CONNECTIONS = 4
+#: Attempts of a request before the read fails, with growing pauses
+RETRIES = 3
+TIMEOUT = 30
+#: Redirects followed to the final URL of the image
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+def is_url(source_media):
+    """
+    :param source_media: Source given by the user
+    :return: Whether the source is an http(s):// URL
+    """
+    return urllib.parse.urlsplit(source_media).scheme.lower() in ("http", "https")
+
+
+class HTTPReader(blockexport.BlockReader):
+    """
+    Random access to the file at an http(s):// URL, see module documentation
+
+    Safe to read from several threads at once.
+    """
+
+    def __init__(self, url, block_size=BLOCK_SIZE, cache_blocks=CACHE_BLOCKS, prefetch_blocks=PREFETCH_BLOCKS,
+                 connections=CONNECTIONS, user_agent=None):
+        """
+        :param url: http(s):// URL of the file
+        :param block_size: Size of the range requests
+        :param cache_blocks: Blocks kept in memory, at least prefetch_blocks
+        :param prefetch_blocks: Blocks fetched ahead of a sequential read, 0 disables prefetch
+        :param connections: Parallel fetches
+        :param user_agent: User-Agent header of the requests
+        :raise OSError: File can't be read, or the server doesn't support range requests
+        """
+        #: URL the file is read from, the final one once redirects are followed
+        self.url = None
+        self.block_size = block_size
+        self.user_agent = user_agent or "WoeUSB/" + miscellaneous.__version__
+        self._set_url(url)
+
+        #: Bytes and requests fetched from the server, for statistics
+        self.bytes_fetched = 0
+        self.requests = 0
+
+        self._statistics_lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        self._validator = None
+
+        size = self._probe()
+        blockexport.BlockReader.__init__(self, size, range(0, size, block_size), cache_blocks, prefetch_blocks,
+                                         connections)
+
+    @property
+    def validator(self):
+        """
+        Strong ETag or Last-Modified of the file, None if the server sent neither
+        """
+        return self._validator
+
+    def load_block(self, index):
+        start = index * self.block_size
+        return self._get(start, min(start + self.block_size, self.size))
+
+    def close(self):
+        blockexport.BlockReader.close(self)
+        with self._statistics_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+    def _set_url(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme.lower() not in ("http", "https") or not parts.hostname:
+            raise OSError(_("Not an http(s) URL: {0}").format(url))
+
+        self.url = url
+        self._https = parts.scheme.lower() == "https"
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+
+    def _probe(self):
+        """
+        Follow redirects to the final URL of the file
+
+        :return: Size of the file
+        """
+        for __ in range(MAX_REDIRECTS + 1):
+            response, body = self._request(0, 1, redirects=True)
+            if response.status not in REDIRECT_STATUSES:
+                break
+
+            # Another server, or the same one closing the connection, the next request opens a new one
+            self._drop_connection()
+            self._set_url(urllib.parse.urljoin(self.url, response.getheader("Location")))
+        else:
+            raise OSError(_("Too many redirects reading {0}").format(self.url))
+
+        size = response.getheader("Content-Range", "").rsplit("/", 1)[-1].strip()
+        if not size.isdigit():
+            raise OSError(_("Server of {0} doesn't tell the size of the file").format(self.url))
+
+        etag = response.getheader("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            self._validator = etag
+        else:
+            self._validator = response.getheader("Last-Modified")
+        return int(size)
+
+    def _get(self, start, end):
+        """
+        :return: Bytes start to end of the file
+        """
+        response, body = self._request(start, end)
+        if len(body) != end - start:
+            raise OSError(_("Server of {0} returned a partial response").format(self.url))
+        return body
+
+    def _request(self, start, end, redirects=False):
+        """
+        Range request on the connection of the calling thread, retried on a fresh connection on failure
+
+        :param redirects: Return redirects with a Location too
+        :return: (response, body) of a 206 Partial Content response, or of a redirect
+        """
+        headers = {"Range": "bytes={0}-{1}".format(start, end - 1), "User-Agent": self.user_agent}
+        if self._validator is not None:
+            headers["If-Range"] = self._validator
+
+        for attempt in range(RETRIES):
+            connection = self._connection()
+            try:
+                connection.request("GET", self._path, headers=headers)
+                response = connection.getresponse()
+                if response.status == 200:
+                    # The whole file follows, never read it
+                    self._drop_connection()
+                    raise OSError(_("Server of {0} ignored a range request, it doesn't support them or the file "
+                                    "changed on the server").format(self.url))
+                body = response.read()
+            except (ConnectionError, TimeoutError, http.client.HTTPException) as error:
+                self._drop_connection()
+                if attempt == RETRIES - 1:
+                    raise OSError(_("Unable to read {0}: {1}").format(self.url, error))
+                time.sleep(attempt + 1)
+                continue
+
+            if response.status >= 500 and attempt < RETRIES - 1:
+                time.sleep(attempt + 1)
+                continue
+            if redirects and response.status in REDIRECT_STATUSES and response.getheader("Location"):
+                return response, body
+            if response.status != 206:
+                raise OSError(_("Unable to read {0}: HTTP {1} {2}").format(self.url, response.status,
+                                                                            response.reason))
+            if response.will_close:
+                self._drop_connection()
+
+            with self._statistics_lock:
+                self.bytes_fetched += len(body)
+                self.requests += 1
+            return response, body
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self._https:
+                connection = http.client.HTTPSConnection(self._host, self._port, timeout=TIMEOUT)
+            else:
+                connection = http.client.HTTPConnection(self._host, self._port, timeout=TIMEOUT)
+            self._local.connection = connection
+            with self._statistics_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _drop_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+            with self._statistics_lock:
+                self._connections.remove(connection)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+Disk image files as targets (--target-image)
+
+The image is a sparse file attached to a loop device with partition scanning, the installation then runs on the
+loop device exactly as on a stick: the image holds what device mode writes onto a device of the same size, ready
+to be flashed onto sticks block by block.
+"""
+
+import os
+import subprocess
+
+MiB = 1024 * 1024
+
+#: Room for partition alignment, the UEFI:NTFS partition, GRUB and filesystem metadata, on top of the source
+IMAGE_SIZE_HEADROOM = 64 * MiB
+#: Room for filesystem overhead proportional to the source (clusters, directories)
+IMAGE_SIZE_SLACK = 0.05
+
+
+def default_size(source_media, source_size=None):
+    """
+    :param source_media: Disk image or optical drive
+    :param source_size: Size of the source in bytes, None looks it up
+    :return: Image size in bytes the source comfortably fits into, whole MiBs
+    """
+    if source_size is not None:
+        size = source_size
+    elif os.path.isfile(source_media):
+        size = os.path.getsize(source_media)
+    else:
+        result = subprocess.run(["blockdev", "--getsize64", source_media], stdout=subprocess.PIPE)
+        size = int(result.stdout.decode("utf-8").strip() or 0)
+
+    size = int(size * (1 + IMAGE_SIZE_SLACK)) + IMAGE_SIZE_HEADROOM
+    return (size + MiB - 1) // MiB * MiB
+
+
+def create(path, size):
+    """
+    Create an empty sparse image, an existing file is emptied and resized
+
+    :param path: Path of the image file
+    :param size: Size in bytes
+    :raise OSError: Image can't be created
+    """
+    with open(path, "wb") as image:
+        image.truncate(size)
+
+
+def attach(path):
+    """
+    :param path: Path of the image file
+    :return: Path of the loop device the image is attached to, None on failure
+    """
+    result = subprocess.run(["losetup", "--find", "--show", "--partscan", path], stdout=subprocess.PIPE)
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode("utf-8").strip()
+
+
+def detach(loop_device):
+    """
+    :param loop_device: Path returned by attach()
+    :return: 0 - success; 1 - failure
+    """
+    return 1 if subprocess.run(["losetup", "--detach", loop_device]).returncode else 0
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+"""
+Cache of finished disk images (see WoeUSB.image), flashed onto targets block by block
+
+Images are keyed by a fingerprint of the source media and every option that changes what is written (filesystem,
+label, bootloader options, layout overrides, application version).  The fingerprint hashes the identity of the
+source, path, inode and modification time of an image file, or URL and validator (ETag/Last-Modified) of a
+remote image, with its size and samples of its content spread over all of it, reading a few MiB instead of the
+whole image.  A re-mastered image of the same size written in place gets a new modification time, the samples
+alone would miss changes between them.  Optical discs have no identity, they are told apart by their samples.
+Entries are evicted least recently used first once the allocated size of the cache exceeds its cap, images in
+use (locked, see ImageCache.lock()) are skipped.
+
+Flashing writes only the data extents of the sparse image (SEEK_DATA/SEEK_HOLE) with large aligned O_DIRECT
+writes and reads them back for verification.  Holes are space the filesystems never wrote, they read nothing
+from it, so whatever the target holds there doesn't matter.
+"""
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import hashlib
+
+DEFAULT_DIRECTORY = "/var/cache/woeusb/images"
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024 * 1024
+
+#: Fingerprint reads the head and the tail of the source plus FINGERPRINT_SAMPLES blocks spread between them
+FINGERPRINT_EDGE = 1024 * 1024
+FINGERPRINT_SAMPLES = 64
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+#: Flashed extents are aligned to this, a multiple of any logical block size and of the page size
+ALIGNMENT = 4096
+
+
+def fingerprint(source_media):
+    """
+    :param source_media: Disk image or optical drive, or a reader with size and read(offset, length) (see
+        WoeUSB.blockexport)
+    :return: Hex digest of the size and sampled content of the source
+    """
+    if not isinstance(source_media, str):
+        return _fingerprint(source_media.size, source_media.read, _identity(source_media))
+
+    with open(source_media, "rb") as source:
+        return _fingerprint(source.seek(0, os.SEEK_END), lambda offset, length: os.pread(source.fileno(), length,
+                                                                                          offset),
+                            _identity(source_media))
+
+
+def _identity(source_media):
+    """
+    :param source_media: See fingerprint()
+    :return: What identifies the source besides its content, JSON serializable
+    """
+    if not isinstance(source_media, str):
+        if getattr(source_media, "url", None) is not None:
+            return [source_media.url, source_media.validator]
+        source_media = getattr(source_media, "path", None)
+        if source_media is None:
+            return None
+
+    if not os.path.isfile(source_media):
+        return None
+    status = os.stat(source_media)
+    return [os.path.realpath(source_media), status.st_dev, status.st_ino, status.st_size, status.st_mtime_ns]
+
+
+def _fingerprint(size, read, identity=None):
+    digest = hashlib.sha256()
+    digest.update(str(size).encode())
+    if identity is not None:
+        digest.update(json.dumps(identity).encode())
+
+    offsets = [0, max(0, size - FINGERPRINT_EDGE)]
+    lengths = [FINGERPRINT_EDGE, FINGERPRINT_EDGE]
+    for index in range(1, FINGERPRINT_SAMPLES + 1):
+        offsets.append(size * index // (FINGERPRINT_SAMPLES + 1))
+        lengths.append(FINGERPRINT_SAMPLE_SIZE)
+
+    for offset, length in zip(offsets, lengths):
+        digest.update(read(offset, length))
+    return digest.hexdigest()
+
+
+class ImageCache:
+    """
+    Directory of <key>.img disk images with <key>.json metadata
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_size=None):
+        """
+        :param directory: Cache directory, created if missing
+        :param max_size: Cap of the allocated size of all images in bytes, None means DEFAULT_MAX_SIZE
+        """
+        self.directory = directory
+        self.max_size = DEFAULT_MAX_SIZE if max_size is None else max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source_media, **inputs):
+        """
+        :param source_media: Disk image or optical drive, or a reader, see fingerprint()
+        :param inputs: Options the image depends on, JSON serializable
+        :return: Cache key
+        """
+        digest = hashlib.sha256(fingerprint(source_media).encode())
+        digest.update(json.dumps(inputs, sort_keys=True).encode())
+        return digest.hexdigest()[:32]
+
+    def image_path(self, key):
+        return os.path.join(self.directory, key + ".img")
+
+    def partial_path(self, key):
+        """
+        :return: Path an image is built at before store() publishes it
+        """
+        return os.path.join(self.directory, key + ".img.partial")
+
+    def lock(self, key):
+        """
+        :return: Context manager holding an exclusive lock of key across processes, so an image is built once
+        """
+        return _FileLock(os.path.join(self.directory, key + ".lock"))
+
+    def lookup(self, key):
+        """
+        :return: Metadata of the cached image, None on a miss; a hit makes the image most recently used
+        """
+        metadata = self._metadata(key)
+        if metadata is None or not os.path.isfile(self.image_path(key)):
+            return None
+
+        metadata["last_used"] = time.time()
+        self._write_metadata(key, metadata)
+        return metadata
+
+    def store(self, key, **metadata):
+        """
+        Publish the image built at partial_path(key) and evict old images beyond the cap
+
+        :param metadata: Facts about the image needed to flash it, JSON serializable
+        :return: Metadata of the new entry
+        """
+        os.replace(self.partial_path(key), self.image_path(key))
+
+        metadata.update(created=time.time(), last_used=time.time(), size=os.path.getsize(self.image_path(key)))
+        self._write_metadata(key, metadata)
+
+        self.evict(keep=key)
+        return metadata
+
+    def discard(self, key):
+        """
+        Remove the entry of key along with its lock, which the caller holds
+        """
+        for path in [self.image_path(key), self.partial_path(key), self._metadata_path(key),
+                     os.path.join(self.directory, key + ".lock")]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used images until the cache fits into its cap
+
+        :param keep: Key never evicted, the image just stored
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                key = name[:-len(".json")]
+                metadata = self._metadata(key) or {}
+                entries.append((metadata.get("last_used", 0), key, _allocated(self.image_path(key))))
+
+        total = sum(allocated for __, __, allocated in entries)
+        for __, key, allocated in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+
+            # Locked images are being built, looked up or opened, they stay
+            lock = self.lock(key)
+            if lock.acquire(blocking=False):
+                try:
+                    self.discard(key)
+                finally:
+                    lock.release()
+                total -= allocated
+
+    def _metadata_path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _metadata(self, key):
+        try:
+            with open(self._metadata_path(key)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_metadata(self, key, metadata):
+        temporary = self._metadata_path(key) + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(metadata, file)
+        os.replace(temporary, self._metadata_path(key))
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking=True):
+        """
+        :return: Whether the lock was taken, always True when blocking
+        """
+        while True:
+            self.file = open(self.path, "w")
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.file.close()
+                self.file = None
+                return False
+
+            # The holder may have discarded the entry with its lock file meanwhile, see ImageCache.discard()
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino:
+                    return True
+            except FileNotFoundError:
+                pass
+            self.release()
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _allocated(path):
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+
+def data_extents(fd, size):
+    """
+    :param fd: File descriptor of a (sparse) file
+    :param size: Size of the file
+    :return: (start, end) of the parts of the file holding data, aligned to ALIGNMENT
+    """
+    extents = []
+    position = 0
+    while position < size:
+        try:
+            start = os.lseek(fd, position, os.SEEK_DATA)
+        except OSError:
+            break  # ENXIO, only a hole is left
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+
+        start = start // ALIGNMENT * ALIGNMENT
+        end = min((end + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT, size)
+        if extents and start <= extents[-1][1]:
+            extents[-1] = (extents[-1][0], end)
+        else:
+            extents.append((start, end))
+        position = end
+    return extents
+
+
+def flash(image_fd, target_device, chunk_size, progress=None):
+    """
+    Write the data extents of an image onto a device
+
+    :param image_fd: File descriptor of the image
+    :param target_device: Block device, e.g. /dev/sdb
+    :param chunk_size: Size of the writes, a multiple of ALIGNMENT
+    :param progress: Called with (bytes written, bytes to be written) after every write, may raise to cancel
+    :return: Data extents written, to be passed to verify()
+    """
+    extents = data_extents(image_fd, os.fstat(image_fd).st_size)
+    total = sum(end - start for start, end in extents)
+    done = 0
+
+    buffer = mmap.mmap(-1, chunk_size)
+    fd = os.open(target_device, os.O_WRONLY | os.O_DIRECT)
+    try:
+        for start, end in extents:
+            for offset in range(start, end, chunk_size):
+                view = memoryview(buffer)[:min(chunk_size, end - offset)]
+                os.preadv(image_fd, [view], offset)
+                os.pwritev(fd, [view], offset)
+                view.release()
+
+                done += min(chunk_size, end - offset)
+                if progress is not None:
+                    progress(done, total)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        buffer.close()
+
+    return extents
+
+
+def verify(image_fd, target_device, extents, chunk_size, progress=None):
+    """
+    Read back flashed extents, bypassing the page cache
+
+    :return: Offset of the first chunk that differs from the image, None if the device holds the image
+    """
+    total = sum(end - start for start, end in extents)
+    done = 0
+
+    expected = mmap.mmap(-1, chunk_size)
+    found = mmap.mmap(-1, chunk_size)
+    fd = os.open(target_device, os.O_RDONLY | os.O_DIRECT)
+    try:
+        for start, end in extents:
+            for offset in range(start, end, chunk_size):
+                length = min(chunk_size, end - offset)
+                os.preadv(image_fd, [memoryview(expected)[:length]], offset)
+                os.preadv(fd, [memoryview(found)[:length]], offset)
+                if expected[:length] != found[:length]:
+                    return offset
+
+                done += length
+                if progress is not None:
+                    progress(done, total)
+    finally:
+        os.close(fd)
+        expected.close()
+        found.close()
+
+    return None
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+
+"""
+ISO9660 (with Joliet) and UDF filesystems of a source image, read without mounting it (--source-backend parse)
+
+The filesystem is parsed into a manifest: every directory, and every file with its extents, the byte ranges of the
+image holding its content.  Files are then copied straight from those ranges of the image, see
+core.copy_image_files(), with no loop device, mount or root privileges for the source.  UDF is preferred when the
+image has it: the ISO9660 filesystem of Windows images only holds a README telling to use UDF.  Joliet comes next,
+for its long names, then plain ISO9660.
+
+Supported: UDF 1.02 to 2.60 on type 1, sparable (spared packets are ignored, images have none) and metadata
+partitions; ISO9660 levels 1 to 3 including multi-extent files.  Not supported: virtual partitions of
+incrementally written discs, interleaved ISO9660 files, Rock Ridge names.
+"""
+
+import os
+import stat
+import struct
+
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+SECTOR_SIZE = 2048
+#: Volume descriptors and the volume recognition sequence start here
+SYSTEM_AREA_SECTORS = 16
+UDF_ANCHOR_SECTOR = 256
+
+#: UDF descriptor tag identifiers
+TAG_ANCHOR = 2
+TAG_PARTITION = 5
+TAG_LOGICAL_VOLUME = 6
+TAG_TERMINATING = 8
+TAG_FILE_SET = 256
+TAG_FILE_IDENTIFIER = 257
+TAG_ALLOCATION_EXTENT = 258
+TAG_FILE_ENTRY = 261
+TAG_EXTENDED_FILE_ENTRY = 266
+
+#: Extent types in the two top bits of the length of UDF allocation descriptors
+EXTENT_RECORDED = 0
+EXTENT_NEXT = 3
+
+
+class FilesystemError(Exception):
+    pass
+
+
+class SourceFile:
+    """
+    File of the manifest
+    """
+
+    def __init__(self, path, size, extents):
+        """
+        :param path: Path relative to the root of the filesystem
+        :param size: Size in bytes
+        :param extents: (offset in the image, length) of the content in order, offset None for a hole of zeros
+        """
+        self.path = path
+        self.size = size
+        self.extents = extents
+
+
+class ImageReader:
+    """
+    Reads a disk image file or a block device
+    """
+
+    def __init__(self, path):
+        """
+        :raise OSError: Image can't be opened
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        #: Whether the image is a regular file, which copy_file_range() can copy from
+        self.regular = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+
+    def read(self, offset, length):
+        return os.pread(self.fd, length, offset)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+
+def read_chunks(reader, extents, chunk_size):
+    """
+    :param reader: Reader of the image, see ISOImage
+    :param extents: Extents of a SourceFile
+    :param chunk_size: Size of the chunks in bytes
+    :return: Iterator over the content of the extents in chunks of at most chunk_size
+    """
+    for offset, length in extents:
+        for position in range(0, length, chunk_size):
+            size = min(chunk_size, length - position)
+            if offset is None:
+                yield bytes(size)
+                continue
+
+            data = reader.read(offset + position, size)
+            if len(data) != size:
+                raise OSError(_("Source image ends within a file"))
+            yield data
+
+
+class ISOImage:
+    """
+    Manifest of the filesystem of an image
+    """
+
+    def __init__(self, reader):
+        """
+        :param reader: Object with size and read(offset, length), e.g. ImageReader or a reader of
+            WoeUSB.blockexport
+        :raise FilesystemError: No supported filesystem
+        :raise OSError: Image can't be read
+        """
+        self.reader = reader
+        #: "UDF", "Joliet" or "ISO9660"
+        self.filesystem = None
+        #: Paths of all directories but the root, every directory before its subdirectories
+        self.directories = []
+        #: SourceFile of every file, in directory order
+        self.files = []
+
+        if self._has_udf():
+            self.filesystem = "UDF"
+            self._read_udf()
+        else:
+            self._read_iso9660()
+
+    @property
+    def size(self):
+        return sum(file.size for file in self.files)
+
+    def _sector(self, sector, count=1):
+        data = self.reader.read(sector * SECTOR_SIZE, count * SECTOR_SIZE)
+        if len(data) != count * SECTOR_SIZE:
+            raise FilesystemError(_("Source image is truncated"))
+        return data
+
+    def _read_extents(self, extents):
+        return b"".join(read_chunks(self.reader, extents, 1024 * 1024))
+
+    # ISO9660
+
+    def _read_iso9660(self):
+        primary = None
+        joliet = None
+        for sector in range(SYSTEM_AREA_SECTORS, SYSTEM_AREA_SECTORS + 64):
+            descriptor = self._sector(sector)
+            if descriptor[1:6] != b"CD001" or descriptor[0] == 255:
+                break
+            if descriptor[0] == 1 and primary is None:
+                primary = descriptor
+            elif descriptor[0] == 2 and descriptor[88:91] in (b"%/@", b"%/C", b"%/E"):
+                joliet = descriptor
+
+        if primary is None:
+            raise FilesystemError(_("Source image has neither an ISO9660 nor an UDF filesystem"))
+
+        self.filesystem = "ISO9660" if joliet is None else "Joliet"
+        root = _iso9660_record(joliet or primary, 156)
+        pending = [("", root[0], root[1])]
+        while pending:
+            directory, offset, size = pending.pop(0)
+            entries = {}
+            data = self._read_extents([(offset, size)])
+
+            position = 0
+            while position < len(data):
+                length = data[position]
+                if length == 0:
+                    # Records don't cross sectors, the rest of the sector is padding
+                    position = (position // SECTOR_SIZE + 1) * SECTOR_SIZE
+                    continue
+
+                record = data[position:position + length]
+                position += length
+                name = record[33:33 + record[32]]
+                if name in (b"\0", b"\1"):
+                    continue  # Directory itself and its parent
+                if record[26] or record[27]:
+                    raise FilesystemError(_("Interleaved files are not supported"))
+
+                name = self._iso9660_name(name, joliet is not None, record[25] & 2)
+                extent_offset, extent_size = _iso9660_record(record, 0)
+                entry = entries.setdefault(name, [bool(record[25] & 2), []])
+                entry[1].append((extent_offset, extent_size))
+
+            for name, (is_directory, extents) in entries.items():
+                path = name if directory == "" else directory + "/" + name
+                if is_directory:
+                    self.directories.append(path)
+                    pending.append((path,) + extents[0])
+                else:
+                    # Multi-extent files are several records of the same name
+                    self.files.append(SourceFile(path, sum(length for __, length in extents), extents))
+
+    @staticmethod
+    def _iso9660_name(name, joliet, is_directory):
+        name = name.decode("utf-16-be", "replace") if joliet else name.decode("ascii", "replace")
+        if ";" in name:
+            name = name[:name.rindex(";")]
+        if not is_directory and name.endswith("."):
+            name = name[:-1]
+        return name
+
+    # UDF
+
+    def _has_udf(self):
+        for sector in range(SYSTEM_AREA_SECTORS, SYSTEM_AREA_SECTORS + 64):
+            identifier = self._sector(sector)[1:6]
+            if identifier in (b"NSR02", b"NSR03"):
+                return True
+            if identifier not in (b"BEA01", b"CD001", b"BOOT2", b"CDW02", b"TEA01"):
+                return False
+        return False
+
+    def _read_udf(self):
+        anchor = self._sector(UDF_ANCHOR_SECTOR)
+        if _tag(anchor) != TAG_ANCHOR:
+            raise FilesystemError(_("UDF anchor volume descriptor not found"))
+        length, location = struct.unpack_from("<II", anchor, 16)
+
+        partitions = {}
+        volume = None
+        for sector in range(location, location + length // SECTOR_SIZE):
+            descriptor = self._sector(sector)
+            tag = _tag(descriptor)
+            if tag == TAG_PARTITION:
+                number, = struct.unpack_from("<H", descriptor, 22)
+                partitions[number] = struct.unpack_from("<I", descriptor, 188)[0]
+            elif tag == TAG_LOGICAL_VOLUME:
+                volume = descriptor
+            elif tag == TAG_TERMINATING:
+                break
+        if volume is None:
+            raise FilesystemError(_("UDF logical volume descriptor not found"))
+        if struct.unpack_from("<I", volume, 212)[0] != SECTOR_SIZE:
+            raise FilesystemError(_("UDF logical block size is not {0}").format(SECTOR_SIZE))
+
+        #: Partition reference -> start sector of a physical partition, or extents of a metadata file
+        self._maps = []
+        metadata = []
+        position = 440
+        for __ in range(struct.unpack_from("<I", volume, 268)[0]):
+            map_type, map_length = volume[position], volume[position + 1]
+            if map_type == 1:
+                self._maps.append(partitions[struct.unpack_from("<H", volume, position + 4)[0]])
+            elif b"Sparable" in volume[position + 5:position + 28]:
+                self._maps.append(partitions[struct.unpack_from("<H", volume, position + 38)[0]])
+            elif b"Metadata" in volume[position + 5:position + 28]:
+                number, file_location = struct.unpack_from("<HI", volume, position + 38)
+                metadata.append((len(self._maps), partitions[number], file_location))
+                self._maps.append(None)
+            else:
+                raise FilesystemError(_("UDF partition type {0} is not supported").format(
+                    volume[position + 5:position + 28].strip(b"\0").decode("ascii", "replace")))
+            position += map_length
+
+        for reference, start, file_location in metadata:
+            # The metadata file lives in the physical partition its map points to
+            if start not in self._maps:
+                self._maps.append(start)
+            __, extents = self._file_entry(self._maps.index(start), file_location)
+            self._maps[reference] = extents
+
+        file_set_length, file_set_block, file_set_reference = struct.unpack_from("<IIH", volume, 248)
+        file_set = self._read_extents(self._blocks(file_set_reference, file_set_block, SECTOR_SIZE))
+        if _tag(file_set) != TAG_FILE_SET:
+            raise FilesystemError(_("UDF file set descriptor not found"))
+        root_block, root_reference = struct.unpack_from("<IH", file_set, 404)
+
+        visited = set()
+        pending = [("", root_reference, root_block)]
+        while pending:
+            directory, reference, block = pending.pop(0)
+            if (reference, block) in visited:
+                continue
+            visited.add((reference, block))
+
+            __, extents = self._file_entry(reference, block)
+            data = self._read_extents(extents)
+            position = 0
+            while position + 38 <= len(data):
+                if _tag(data[position:]) != TAG_FILE_IDENTIFIER:
+                    break
+                characteristics, name_length = data[position + 18], data[position + 19]
+                block, reference = struct.unpack_from("<IH", data, position + 24)
+                implementation_length, = struct.unpack_from("<H", data, position + 36)
+                name = data[position + 38 + implementation_length:position + 38 + implementation_length + name_length]
+                position += (38 + implementation_length + name_length + 3) // 4 * 4
+
+                if characteristics & 0x0c:
+                    continue  # Deleted, or the parent directory
+
+                path = _udf_name(name) if directory == "" else directory + "/" + _udf_name(name)
+                if characteristics & 0x02:
+                    self.directories.append(path)
+                    pending.append((path, reference, block))
+                else:
+                    size, file_extents = self._file_entry(reference, block)
+                    self.files.append(SourceFile(path, size, file_extents))
+
+    def _blocks(self, reference, block, length):
+        """
+        :return: Extents of the image holding length bytes from a logical block of a partition
+        """
+        mapping = self._maps[reference]
+        if not isinstance(mapping, list):
+            return [((mapping + block) * SECTOR_SIZE, length)]
+
+        # Metadata partition: its blocks are the content of the metadata file
+        extents = []
+        position = block * SECTOR_SIZE
+        file_position = 0
+        for offset, extent_length in mapping:
+            if length > 0 and position < file_position + extent_length:
+                start = position - file_position
+                size = min(extent_length - start, length)
+                extents.append((None if offset is None else offset + start, size))
+                position += size
+                length -= size
+            file_position += extent_length
+        if length > 0:
+            raise FilesystemError(_("UDF metadata partition is truncated"))
+        return extents
+
+    def _file_entry(self, reference, block):
+        """
+        :return: (size, extents) of the file whose (extended) file entry is at block of partition reference
+        """
+        entry_extents = self._blocks(reference, block, SECTOR_SIZE)
+        entry = self._read_extents(entry_extents)
+        tag = _tag(entry)
+        if tag == TAG_FILE_ENTRY:
+            attributes_length, descriptors_length = struct.unpack_from("<II", entry, 168)
+            start = 176 + attributes_length
+        elif tag == TAG_EXTENDED_FILE_ENTRY:
+            attributes_length, descriptors_length = struct.unpack_from("<II", entry, 208)
+            start = 216 + attributes_length
+        else:
+            raise FilesystemError(_("UDF file entry not found at block {0}").format(block))
+
+        size, = struct.unpack_from("<Q", entry, 56)
+        descriptor_type = struct.unpack_from("<H", entry, 34)[0] & 7
+        if descriptor_type == 3:
+            # Content embedded into the file entry
+            return size, [(entry_extents[0][0] + start, size)]
+
+        extents = []
+        descriptors = entry[start:start + descriptors_length]
+        while descriptors:
+            descriptors, following = self._allocation_descriptors(descriptors, descriptor_type, reference, extents)
+            if following is None:
+                break
+            # Continued in an allocation extent descriptor
+            descriptors = self._read_extents(self._blocks(*following))
+            if _tag(descriptors) != TAG_ALLOCATION_EXTENT:
+                raise FilesystemError(_("UDF allocation extent not found"))
+            descriptors = descriptors[24:24 + struct.unpack_from("<I", descriptors, 20)[0]]
+
+        # The last extent is rounded up to whole blocks
+        remaining = size
+        for index, (offset, length) in enumerate(extents):
+            extents[index] = (offset, min(length, remaining))
+            remaining -= extents[index][1]
+        return size, [extent for extent in extents if extent[1] > 0]
+
+    def _allocation_descriptors(self, descriptors, descriptor_type, reference, extents):
+        """
+        Append the extents of a run of allocation descriptors to extents
+
+        :return: (rest of the descriptors, (reference, block, length) of their continuation or None)
+        """
+        size = {0: 8, 1: 16, 2: 20}.get(descriptor_type)
+        if size is None:
+            raise FilesystemError(_("UDF allocation descriptor type {0} is not supported").format(descriptor_type))
+
+        for position in range(0, len(descriptors) - size + 1, size):
+            length, = struct.unpack_from("<I", descriptors, position)
+            extent_type, length = length >> 30, length & 0x3fffffff
+            if length == 0:
+                return b"", None
+
+            if descriptor_type == 0:
+                block, = struct.unpack_from("<I", descriptors, position + 4)
+                extent_reference = reference
+            elif descriptor_type == 1:
+                block, extent_reference = struct.unpack_from("<IH", descriptors, position + 4)
+            else:
+                block, extent_reference = struct.unpack_from("<IH", descriptors, position + 12)
+
+            if extent_type == EXTENT_NEXT:
+                return descriptors[position + size:], (extent_reference, block, length)
+            if extent_type == EXTENT_RECORDED:
+                extents.extend(self._blocks(extent_reference, block, length))
+            else:
+                extents.append((None, length))  # Allocated or not, unrecorded extents read as zeros
+        return b"", None
+
+
+def _tag(descriptor):
+    return struct.unpack_from("<H", descriptor, 0)[0] if len(descriptor) >= 16 else None
+
+
+def _udf_name(name):
+    """
+    Decode an OSTA compressed Unicode file identifier
+    """
+    if not name:
+        return ""
+    if name[0] in (16, 255):
+        return name[1:].decode("utf-16-be", "replace")
+    return name[1:].decode("latin-1")
+
+
+def _iso9660_record(data, position):
+    """
+    :return: (offset in the image, size) of the extent of the directory record at position
+    """
+    attribute_sectors = data[position + 1]
+    sector, size = struct.unpack_from("<I4xI", data, position + 2)
+    return (sector + attribute_sectors) * SECTOR_SIZE, size
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+"""
+Choice of the target layout (filesystem, and whether big WIM images are split) from speed probes of the target
+
+With --target-filesystem AUTO, the wiped target is formatted with every viable filesystem in turn and
+probe_filesystem() measures, through the mounted filesystem and its driver, how fast a big file is written and how
+long every small file takes until it is on the device.  Every viable layout gets a predicted copy time from the
+speeds of its filesystem and the source profile: its bytes at the measured sequential speed plus the measured cost
+of each of its files.  The fastest layout wins, layouts within LAYOUT_TIE_MARGIN of it are considered equal and the
+more compatible one is taken (FAT32 boots everywhere without the UEFI:NTFS helper partition).
+
+Formatting and probing every filesystem takes some seconds per filesystem, FAT32 remains the default.
+
+Viable layouts:
+* FAT32, if no source file exceeds the 4 GiB file size limit of FAT32
+* FAT32 with split WIM, if the only files exceeding it are WIM images and wimlib-imagex is installed, the images
+  are split into .swm parts Windows Setup reads natively
+* NTFS
+* exFAT, if mkfs.exfat is installed
+"""
+
+import os
+import time
+import shutil
+import subprocess
+
+import WoeUSB.utils as utils
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+KiB = 1024
+MiB = 1024 * KiB
+
+#: Max fat32 file size
+FAT32_MAXIMAL_FILE_SIZE = (2 ** 32) - 1
+
+#: Size of the .swm parts of split WIM images, in MiB
+SPLIT_WIM_PART_SIZE = 3800
+
+#: Big file written by the probe, in blocks, flushed to the device before its write is timed as finished
+PROBE_FILE_SIZE = 64 * MiB
+PROBE_BLOCK_SIZE = 4 * MiB
+#: Small files written by the probe, then flushed to the device together like the copy flushes its files
+PROBE_SMALL_FILES = 64
+PROBE_SMALL_FILE_SIZE = 16 * KiB
+#: Seconds writing the big file may take at most, slow sticks are measured on less data
+PROBE_TIME_LIMIT = 2.0
+
+#: wimlib-imagex parses the image on top of copying it
+SPLIT_WIM_EFFICIENCY = 0.9
+
+LAYOUT_TIE_MARGIN = 0.05
+
+
+class SourceProfile:
+    """
+    What the layout choice needs to know about the source files
+    """
+
+    def __init__(self, files):
+        """
+        :param files: (path relative to the source filesystem, size in bytes) of every source file
+        """
+        self.files = len(files)
+        self.size = sum(size for __, size in files)
+        #: Paths of the files FAT32 can't store
+        self.oversized = [path for path, size in files if size > FAT32_MAXIMAL_FILE_SIZE]
+        self.oversized_size = sum(size for __, size in files if size > FAT32_MAXIMAL_FILE_SIZE)
+
+
+def scan_source(source_fs_mountpoint):
+    """
+    :param source_fs_mountpoint: Mountpoint of the source filesystem
+    :return: SourceProfile
+    """
+    files = []
+    for dirpath, __, filenames in os.walk(source_fs_mountpoint):
+        for file in filenames:
+            path = os.path.join(dirpath, file)
+            files.append((os.path.relpath(path, source_fs_mountpoint), os.path.getsize(path)))
+    return SourceProfile(files)
+
+
+class Speeds:
+    """
+    Write speeds of a filesystem on the target measured by probe_filesystem()
+    """
+
+    def __init__(self, sequential_write, file_time):
+        """
+        :param sequential_write: Bytes per second written into a big file
+        :param file_time: Seconds every small file takes on top of its data: directory entry, allocation, metadata
+        """
+        self.sequential_write = sequential_write
+        self.file_time = file_time
+
+    def describe(self):
+        return _("sequential write {0}/s, {1:.1f} ms per file").format(
+            utils.convert_to_human_readable_format(self.sequential_write), self.file_time * 1000)
+
+
+class Layout:
+    """
+    Filesystem of the target partition and the source files to be split to fit into it
+    """
+
+    def __init__(self, filesystem_type, split_wims=()):
+        """
+        :param filesystem_type: "FAT", "NTFS" or "EXFAT"
+        :param split_wims: Paths (relative to the source filesystem) of the WIM images to be split
+        """
+        self.filesystem_type = filesystem_type
+        self.split_wims = list(split_wims)
+
+    def describe(self):
+        if self.split_wims:
+            return _("FAT32 with split WIM")
+        return {"FAT": "FAT32", "NTFS": "NTFS", "EXFAT": "exFAT"}[self.filesystem_type]
+
+
+def probe_filesystem(target_fs_mountpoint):
+    """
+    Measure writing files into a freshly formatted, mounted target filesystem, the files are removed afterwards
+
+    :param target_fs_mountpoint: Mountpoint of the target filesystem
+    :return: Speeds, None if the filesystem can't be written
+    """
+    utils.check_kill_signal()
+
+    directory = os.path.join(target_fs_mountpoint, "woeusb-probe")
+    # Random data, some controllers compress or deduplicate
+    block = os.urandom(PROBE_BLOCK_SIZE)
+
+    try:
+        os.mkdir(directory)
+
+        written = 0
+        start = time.monotonic()
+        with open(os.path.join(directory, "sequential"), "wb", buffering=0) as file:
+            while written < PROBE_FILE_SIZE and time.monotonic() - start < PROBE_TIME_LIMIT:
+                file.write(block)
+                written += len(block)
+            os.fsync(file.fileno())
+        sequential_write = written / max(time.monotonic() - start, 1e-6)
+        utils.check_kill_signal()
+
+        start = time.monotonic()
+        for index in range(PROBE_SMALL_FILES):
+            with open(os.path.join(directory, str(index)), "wb") as file:
+                file.write(block[:PROBE_SMALL_FILE_SIZE])
+        _sync_filesystem(directory)
+        elapsed = time.monotonic() - start
+    except OSError:
+        return None
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    file_time = max(elapsed / PROBE_SMALL_FILES - PROBE_SMALL_FILE_SIZE / sequential_write, 0)
+    return Speeds(sequential_write, file_time)
+
+
+def _sync_filesystem(path):
+    """
+    Write everything cached for the filesystem of path onto its device
+    """
+    if subprocess.run(["sync", "--file-system", path]).returncode != 0:
+        raise OSError(_("Unable to sync {0}").format(path))
+
+
+def viable_layouts(profile):
+    """
+    :param profile: SourceProfile
+    :return: Layouts the source fits into, most compatible first
+    """
+    layouts = []
+    if not profile.oversized:
+        layouts.append(Layout("FAT"))
+    elif all(path.lower().endswith(".wim") for path in profile.oversized) \
+            and shutil.which("wimlib-imagex") is not None:
+        layouts.append(Layout("FAT", profile.oversized))
+
+    layouts.append(Layout("NTFS"))
+    if shutil.which("mkfs.exfat") is not None:
+        layouts.append(Layout("EXFAT"))
+    return layouts
+
+
+def predict(layout, profile, speeds):
+    """
+    :param speeds: Speeds of the layout's filesystem on the target
+    :return: Predicted seconds of copying profile into layout
+    """
+    split_size = profile.oversized_size if layout.split_wims else 0
+
+    data = (profile.size - split_size) / speeds.sequential_write
+    data += split_size / (speeds.sequential_write * SPLIT_WIM_EFFICIENCY)
+
+    files = profile.files + len(layout.split_wims) * (profile.oversized_size // (SPLIT_WIM_PART_SIZE * MiB) + 1)
+
+    return data + files * speeds.file_time
+
+
+def choose(requested, profile, speeds=None):
+    """
+    Choose layout of the target, printing the predictions it is based on
+
+    :param requested: "AUTO", or the filesystem asked for: "FAT", "NTFS" or "EXFAT"
+    :param profile: SourceProfile
+    :param speeds: Speeds by filesystem type measured on the target (see probe_filesystem()), None takes the most
+        compatible layout, layouts of filesystems that couldn't be measured aren't taken
+    :return: Layout, None if the requested filesystem can't be used
+    """
+    layouts = viable_layouts(profile)
+
+    if requested != "AUTO":
+        layouts = [layout for layout in layouts if layout.filesystem_type == requested]
+        if not layouts and requested == "FAT":
+            utils.print_with_color(
+                _("Warning: File {0} in source image has exceed the FAT32 Filesystem 4GiB Single File Size Limitation, swiching to NTFS filesystem.").format(
+                    profile.oversized[0]),
+                "yellow")
+            utils.print_with_color(
+                _("Refer: https://github.com/slacka/WoeUSB/wiki/Limitations#fat32-filesystem-4gib-single-file-size-limitation for more info."),
+                "yellow")
+            layouts = [Layout("NTFS")]
+        elif not layouts:
+            utils.print_with_color(_("Error: mkfs.exfat command not found!"), "red")
+            utils.print_with_color(_("Error: Please make sure that exfatprogs is properly installed!"), "red")
+            return None
+
+    if speeds is not None:
+        layouts = [layout for layout in layouts if speeds.get(layout.filesystem_type) is not None] or layouts[:1]
+    if speeds is None or len(layouts) == 1:
+        return layouts[0]
+
+    for filesystem_type, filesystem_speeds in speeds.items():
+        if filesystem_speeds is not None:
+            utils.print_with_color(_("Target speed with {0}: {1}").format(
+                Layout(filesystem_type).describe(), filesystem_speeds.describe()))
+
+    predictions = [predict(layout, profile, speeds[layout.filesystem_type]) for layout in layouts]
+    for layout, seconds in zip(layouts, predictions):
+        utils.print_with_color(_("Predicted copy time with {0}: {1}").format(layout.describe(),
+                                                                             _format_duration(seconds)))
+
+    fastest = min(predictions)
+    for layout, seconds in zip(layouts, predictions):
+        if seconds <= fastest * (1 + LAYOUT_TIE_MARGIN):
+            if layout.filesystem_type != "FAT" and layouts[0].filesystem_type == "FAT":
+                utils.print_with_color(
+                    _("Warning: {0} is predicted to be faster than {1}, but boots on UEFI through the UEFI:NTFS "
+                      "helper partition only, some firmwares don't boot it, use --target-filesystem FAT for the "
+                      "most compatible layout").format(layout.describe(), layouts[0].describe()), "yellow")
+            return layout
+
+
+def existing_filesystem(target_partition):
+    """
+    :param target_partition: Partition, e.g. /dev/sdb1
+    :return: "FAT", "NTFS" or "EXFAT", None for other filesystems
+    """
+    filesystem = subprocess.run(["lsblk",
+                                 "--output", "FSTYPE",
+                                 "--noheadings",
+                                 target_partition], stdout=subprocess.PIPE).stdout.decode("utf-8").strip()
+    return {"vfat": "FAT", "ntfs": "NTFS", "exfat": "EXFAT"}.get(filesystem)
+
+
+def split_wim(source, target, progress=None):
+    """
+    Split a WIM image into .swm parts small enough for FAT32
+
+    :param source: Path of the image
+    :param target: Path of the first part, e.g. .../sources/install.swm, the others are numbered after it
+    :param progress: Called with the bytes written so far while splitting
+    :return: 0 - success; 1 - failure
+    """
+    directory = os.path.dirname(target)
+    stem = os.path.splitext(os.path.basename(target))[0]
+
+    process = subprocess.Popen(["wimlib-imagex", "split", source, target, str(SPLIT_WIM_PART_SIZE)],
+                               stdout=subprocess.DEVNULL)
+    try:
+        while process.poll() is None:
+            time.sleep(0.5)
+            utils.check_kill_signal()
+
+            if progress is not None:
+                progress(sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+                             if name.startswith(stem) and name.endswith(".swm")))
+    finally:
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+
+    return 1 if process.returncode else 0
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    if minutes:
+        return _("{0} min {1} s").format(minutes, seconds)
+    return _("{0} s").format(seconds)
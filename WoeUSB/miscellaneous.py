@@ -1,9 +1,25 @@
-import gettext
-import locale
 import os
 
 __version__ = "0.2.12"
 
-translation = gettext.translation("woeusb", os.path.dirname(__file__) + "/locale", [locale.getlocale()[0]], fallback=True)
-translation.install()
-i18n = translation.gettext
+translation = None
+
+
+def i18n(message):
+    """
+    gettext wrapper, message catalogs are loaded on first use so that `woeusb --version` doesn't pay for them
+
+    :param message: Message to be translated
+    :return: Translated message
+    """
+    global translation
+
+    if translation is None:
+        import gettext
+        import locale
+
+        translation = gettext.translation("woeusb", os.path.dirname(__file__) + "/locale", [locale.getlocale()[0]],
+                                          fallback=True)
+        translation.install()
+
+    return translation.gettext(message)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""
+CPU niceness and I/O priority of the threads working for an installation
+
+On Linux both are attributes of a thread (not of the whole process) and are inherited by the processes it
+spawns, so applying them to every thread bound to a job (see utils.bind_job()) covers the copy threads as well
+as mkntfs, grub-install, 7z and the other tools they run.
+"""
+
+import os
+import ctypes
+import platform
+import threading
+
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+#: I/O scheduling classes of ioprio_set(2)
+IO_CLASSES = {"none": 0, "realtime": 1, "best-effort": 2, "idle": 3}
+
+#: Niceness and I/O priority of --background
+BACKGROUND = (10, ("best-effort", 7))
+
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+
+#: (ioprio_set, ioprio_get) system call numbers
+_SYSCALLS = {
+    "x86_64": (251, 252),
+    "i386": (289, 290),
+    "i686": (289, 290),
+    "aarch64": (30, 31),
+    "riscv64": (30, 31),
+    "armv7l": (314, 315),
+    "ppc64le": (273, 274),
+    "s390x": (282, 283),
+}
+
+_libc = None
+
+
+def parse_io_priority(value):
+    """
+    Parse I/O priority written as CLASS or CLASS:LEVEL, e.g. idle or best-effort:7
+
+    :param value: String to be parsed
+    :return: (class, level), level is None for classes without levels
+    """
+    io_class, __, level = str(value).partition(":")
+    io_class = io_class.strip().lower()
+    if io_class not in IO_CLASSES:
+        raise ValueError(_("Invalid I/O priority class: {0}").format(io_class))
+
+    if io_class in ("none", "idle"):
+        return io_class, None
+
+    level = int(level) if level else 4
+    if not 0 <= level <= 7:
+        raise ValueError(_("I/O priority level has to be between 0 and 7"))
+    return io_class, level
+
+
+def describe(nice, io_priority):
+    """
+    :return: Human readable summary of the priority settings, None when both are default
+    """
+    parts = []
+    if nice is not None:
+        parts.append(_("nice {0}").format(nice))
+    if io_priority is not None:
+        io_class, level = io_priority
+        parts.append(_("I/O {0}").format(io_class if level is None else io_class + ":" + str(level)))
+    return ", ".join(parts) if parts else None
+
+
+def apply(nice, io_priority):
+    """
+    Set niceness and I/O priority of the calling thread
+
+    :param nice: Niceness, None keeps the current one
+    :param io_priority: (class, level) as returned by parse_io_priority(), None keeps the current one
+    :return: Previous settings to be passed to restore()
+    """
+    tid = threading.get_native_id()
+    previous = (None, None)
+
+    if nice is not None:
+        try:
+            previous = (os.getpriority(os.PRIO_PROCESS, tid), previous[1])
+            os.setpriority(os.PRIO_PROCESS, tid, nice)
+        except OSError:
+            pass  # Not permitted, priorities are only a hint
+
+    if io_priority is not None:
+        current = _ioprio_get(tid)
+        io_class, level = io_priority
+        if current is not None and _ioprio_set(tid, (IO_CLASSES[io_class] << _IOPRIO_CLASS_SHIFT) | (level or 0)):
+            previous = (previous[0], current)
+
+    return previous
+
+
+def restore(previous):
+    """
+    :param previous: Value returned by apply()
+    """
+    tid = threading.get_native_id()
+    nice, ioprio = previous
+
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, nice)
+        except OSError:
+            pass
+    if ioprio is not None:
+        _ioprio_set(tid, ioprio)
+
+
+def _syscall(index, *arguments):
+    global _libc
+
+    numbers = _SYSCALLS.get(platform.machine())
+    if numbers is None:
+        return -1
+
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    return _libc.syscall(numbers[index], *arguments)
+
+
+def _ioprio_get(tid):
+    result = _syscall(1, _IOPRIO_WHO_PROCESS, tid)
+    return result if result >= 0 else None
+
+
+def _ioprio_set(tid, ioprio):
+    return _syscall(0, _IOPRIO_WHO_PROCESS, tid, ioprio) == 0
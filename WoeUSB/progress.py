@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+Machine-readable progress protocol
+
+Every event is a single line holding a compact JSON object with at least "event" and "time" keys:
+
+* {"event": "stage", "stage": "copying"}
+* {"event": "progress", "stage": "copying", "done": 1048576, "total": 4194304, "rate": 2097152.0, "eta": 1.5}
+* {"event": "warning", "message": "..."}
+* {"event": "error", "message": "..."}
+* {"event": "finished", "status": 0}
+
+Progress, warning and error events about one target of a fan-out (see fanout.FanOut) carry its name as "target",
+progress events without one are about the whole installation.  Progress events are rate limited per target,
+stage/warning/error/finished events are always emitted
+"""
+
+import json
+import os
+import threading
+import time
+
+#: Stages in the order they are entered by core.Installer.main: the source is mounted before the target is wiped,
+#: mounting is entered again for the target after formatting; in flushing the kernel writes what it still caches for
+#: the target device; a target flashed from the image cache goes through flashing and verifying instead of copying,
+#: then partitioning to grow its partition; ripping waits for the source disc to be ripped (see
+#: core.Installer.wait_for_source())
+STAGES = ["init", "mounting", "wiping", "discarding", "ripping", "partitioning", "formatting", "copying", "flashing",
+          "verifying", "bootloader", "flushing", "finished"]
+
+
+class JSONProgressReporter:
+    """
+    Writes progress events as JSON lines into a file descriptor
+    """
+
+    def __init__(self, fd, min_interval=0.25):
+        """
+        :param fd: File descriptor the events are written into, None for subclasses overriding write()
+        :param min_interval: Minimal interval between two progress events in seconds
+        """
+        self.file = os.fdopen(fd, "w", buffering=1, closefd=False) if fd is not None else None
+        self.min_interval = min_interval
+        self.current_stage = "init"
+
+        #: Guards writes and the meters, progress is reported from the writer threads of a fan-out concurrently
+        self._lock = threading.RLock()
+        #: Target (None for the whole installation) -> _Meter of the current stage
+        self._meters = {}
+
+    def emit(self, event, **fields):
+        """
+        Write single event
+
+        :param event: Name of the event
+        :param fields: Additional JSON serializable keys of the event
+        """
+        event = dict(event=event, time=round(time.time(), 3), **fields)
+        line = json.dumps(event, separators=(",", ":"), default=str)
+
+        with self._lock:
+            try:
+                self.write(line)
+            except (OSError, ValueError):
+                pass  # Reader went away, progress reporting must never break the installation
+
+    def write(self, line):
+        """
+        :param line: Serialized event, without line terminator
+        """
+        self.file.write(line + "\n")
+
+    def stage(self, stage):
+        with self._lock:
+            if stage == self.current_stage:
+                return
+
+            self.current_stage = stage
+            self._meters = {}
+            self.emit("stage", stage=stage)
+
+    def progress(self, done, total, force=False, target=None):
+        """
+        Report amount of bytes processed in current stage, rate and ETA are derived from consecutive calls
+
+        :param done: Bytes done
+        :param total: Bytes expected in total
+        :param force: Emit even if the last event was emitted less than min_interval ago
+        :param target: Name of the target of a fan-out the progress is about, None for the whole installation
+        """
+        with self._lock:
+            now = time.monotonic()
+            meter = self._meters.setdefault(target, _Meter())
+
+            if meter.last_sample is not None:
+                last_time, last_done = meter.last_sample
+                if now > last_time:
+                    rate = (done - last_done) / (now - last_time)
+                    # Exponential moving average keeps the rate steady on bursty devices
+                    meter.rate = 0.7 * meter.rate + 0.3 * rate if meter.rate else rate
+            meter.last_sample = (now, done)
+
+            if not force and now - meter.last_emit < self.min_interval:
+                return
+            meter.last_emit = now
+
+            eta = (total - done) / meter.rate if meter.rate > 0 and total >= done else None
+            self.emit("progress", stage=self.current_stage, done=done, total=total, rate=round(meter.rate, 1),
+                      eta=round(eta, 1) if eta is not None else None, **_target_field(target))
+
+    def warning(self, message, target=None):
+        self.emit("warning", message=str(message), **_target_field(target))
+
+    def error(self, message, target=None):
+        self.emit("error", message=str(message), **_target_field(target))
+
+    def finish(self, status):
+        self.emit("finished", status=status)
+
+
+class _Meter:
+    """
+    Transfer rate of one target within a stage
+    """
+
+    def __init__(self):
+        self.last_emit = 0
+        self.last_sample = None
+        self.rate = 0.0
+
+
+def _target_field(target):
+    return {} if target is None else dict(target=target)
+
+
+def parse_event(line):
+    """
+    Parse a line written by JSONProgressReporter
+
+    :param line: Line to be parsed
+    :return: Event dictionary, None if the line isn't a progress event
+    """
+    line = line.strip()
+    if not line.startswith("{"):
+        return None
+
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+
+    if not isinstance(event, dict) or "event" not in event:
+        return None
+    return event
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""
+Rip optical discs once into a local cache of disc images (--disc-cache)
+
+Copying straight from a disc runs at optical speed and seeks between every file, and every target reads the whole
+disc again.  Instead the disc is read once, sequentially and in large blocks, into an image file kept in an
+imagecache.ImageCache keyed by the volume ID and size of the disc, later runs use the image.  Unreadable blocks are
+retried sector by sector, a sector that stays unreadable fails the rip, a disc image with holes would only fail
+later, in Windows Setup.  The rip runs in a thread of its own so the target can be prepared meanwhile, see
+core.Installer.prepare_source().
+"""
+
+import os
+import re
+import time
+import threading
+
+import WoeUSB.utils as utils
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+DEFAULT_DIRECTORY = "/var/cache/woeusb/discs"
+
+SECTOR_SIZE = 2048
+#: Size of the sequential reads, a multiple of SECTOR_SIZE
+READ_SIZE = 2 * 1024 * 1024
+#: Reads of an unreadable sector before the rip fails, with growing pauses for the drive to recalibrate
+RETRIES = 5
+
+#: ISO 9660 Primary Volume Descriptor, the volume identifier is a field of it
+_PVD_OFFSET = 16 * SECTOR_SIZE
+
+
+def is_optical(source_media):
+    """
+    :param source_media: Source given by the user
+    :return: Whether source_media is an optical drive (SCSI type 5, e.g. /dev/sr0)
+    """
+    if os.path.isfile(source_media):
+        return False
+
+    name = os.path.basename(os.path.realpath(source_media))
+    try:
+        with open("/sys/class/block/" + name + "/device/type") as device_type:
+            return device_type.read().strip() == "5"
+    except OSError:
+        return re.match("sr[0-9]", name) is not None
+
+
+def disc_identity(device):
+    """
+    :param device: Optical drive with a disc
+    :return: (volume ID, size in bytes)
+    """
+    with open(device, "rb") as disc:
+        size = disc.seek(0, os.SEEK_END)
+        disc.seek(_PVD_OFFSET)
+        descriptor = disc.read(SECTOR_SIZE)
+
+    volume = ""
+    if descriptor[1:6] == b"CD001":
+        volume = descriptor[40:72].decode("ascii", "replace").strip()
+    return volume, size
+
+
+def cache_key(volume, size):
+    """
+    :return: Key of the image of a disc in the disc cache
+    """
+    return (re.sub("[^A-Za-z0-9_.-]", "_", volume) or "disc") + "-" + str(size)
+
+
+def rip_disc(device, directory):
+    """
+    Rip a disc into the disc cache in the calling thread, unless it's there already
+
+    :param device: Optical drive with a disc
+    :param directory: Directory of the disc cache
+    :return: Path of the disc's image, None on failure
+    """
+    import WoeUSB.imagecache as imagecache
+
+    volume, size = disc_identity(device)
+    cache = imagecache.ImageCache(directory)
+    ripper = Ripper(device, cache, cache_key(volume, size), size)
+
+    if cache.lookup(ripper.key) is None:
+        utils.print_with_color(_("Ripping disc {0} ({1}) into {2}...").format(
+            volume, utils.convert_to_human_readable_format(size), ripper.path), "green")
+        ripper.run()
+        if ripper.error is not None:
+            utils.print_with_color(ripper.error, "red")
+            return None
+
+    utils.print_with_color(_("Using ripped image {0} of disc {1}").format(ripper.path, volume), "green")
+    return ripper.path
+
+
+class RipError(Exception):
+    pass
+
+
+class Ripper(threading.Thread):
+    """
+    Reads a disc into the disc cache, the image is published in the cache once complete
+    """
+
+    def __init__(self, device, cache, key, size, job=None):
+        """
+        :param device: Optical drive
+        :param cache: imagecache.ImageCache of disc images
+        :param key: Key of the disc, see cache_key()
+        :param size: Size of the disc in bytes
+        :param job: core.Installer the rip works for, its priority applies and cancelling it stops the rip
+        """
+        threading.Thread.__init__(self)
+        self.device = device
+        self.cache = cache
+        self.key = key
+        self.size = size
+        self.job = job
+
+        self.done = 0
+        self.stop = False
+        #: Message of the failure, None if the rip succeeded (or still runs)
+        self.error = None
+
+    @property
+    def path(self):
+        return self.cache.image_path(self.key)
+
+    def run(self):
+        utils.bind_job(self.job)
+        try:
+            with self.cache.lock(self.key):
+                if self.cache.lookup(self.key) is None:
+                    self._rip()
+                    self.cache.store(self.key, device=self.device)
+        except (KeyboardInterrupt, SystemExit):
+            self.error = _("Ripping cancelled")
+            self.cache.discard(self.key)
+        except (OSError, RipError) as error:
+            self.error = str(error)
+            self.cache.discard(self.key)
+        finally:
+            utils.bind_job(None)
+
+    def _rip(self):
+        fd = os.open(self.device, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            with open(self.cache.partial_path(self.key), "wb") as image:
+                while self.done < self.size:
+                    if self.stop:
+                        raise SystemExit
+                    utils.check_kill_signal()
+
+                    data = self._read(fd, self.done, min(READ_SIZE, self.size - self.done))
+                    image.write(data)
+                    # The disc's own cache is of no use once ripped
+                    os.posix_fadvise(fd, self.done, len(data), os.POSIX_FADV_DONTNEED)
+                    self.done += len(data)
+        finally:
+            os.close(fd)
+
+    def _read(self, fd, offset, length):
+        try:
+            data = os.pread(fd, length, offset)
+            if len(data) == length:
+                return data
+        except OSError:
+            pass
+
+        # Read error (or short read) somewhere in the block, go sector by sector
+        data = b""
+        for sector in range(offset, offset + length, SECTOR_SIZE):
+            data += self._read_sector(fd, sector, min(SECTOR_SIZE, offset + length - sector))
+        return data
+
+    def _read_sector(self, fd, offset, length):
+        for attempt in range(RETRIES):
+            try:
+                data = os.pread(fd, length, offset)
+                if len(data) == length:
+                    return data
+            except OSError:
+                pass
+            time.sleep(0.5 * (attempt + 1))
+
+        raise RipError(_("Error: Unable to read sector {0} of {1}").format(offset // SECTOR_SIZE, self.device))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+Throttled target backend that emulates a slow USB flash drive on top of a regular directory, see
+core.Installer's target_backend
+
+It lets the copy engine of core be benchmarked and tested on any Linux box, without root or a real stick
+"""
+
+import os
+import sys
+import time
+import threading
+
+import WoeUSB.utils as utils
+import WoeUSB.miscellaneous as miscellaneous
+
+_ = miscellaneous.i18n
+
+MiB = 1024 * 1024
+
+
+class SimulatedUSBStick:
+    """
+    Timing model of a cheap USB flash drive
+
+    Writes are serialized like on a real device: every write costs a fixed latency plus its size divided by
+    the current bandwidth.  The first slc_cache_size bytes are absorbed by the (fast) SLC cache, after which
+    the drive falls off the cliff down to the sustained bandwidth.  The cache is folded back at the sustained
+    bandwidth while the drive is idle.  Closing a file and syncing the drive costs flush_latency.
+    """
+
+    def __init__(self, bandwidth=2 * MiB, write_latency=0.002, slc_cache_size=0, slc_bandwidth=None,
+                 flush_latency=0.05):
+        """
+        :param bandwidth: Sustained sequential write bandwidth in bytes per second
+        :param write_latency: Fixed cost of a single write request in seconds
+        :param slc_cache_size: Size of the fast write cache in bytes, 0 disables it
+        :param slc_bandwidth: Write bandwidth while the cache isn't exhausted, defaults to 4 times the bandwidth
+        :param flush_latency: Cost in seconds of closing a file or flushing the drive
+        """
+        self.bandwidth = bandwidth
+        self.write_latency = write_latency
+        self.slc_cache_size = slc_cache_size
+        self.slc_bandwidth = slc_bandwidth if slc_bandwidth is not None else bandwidth * 4
+        self.flush_latency = flush_latency
+
+        self.bytes_written = 0
+        self.cache_used = 0
+
+        self._busy_until = time.monotonic()
+        self._lock = threading.Lock()
+
+    def open(self, path, mode="wb"):
+        """
+        Open a file on the simulated drive
+
+        :param path: Path of the file inside the backing directory
+        :param mode: Mode passed to open(), must be a writing mode
+        :return: SimulatedFile
+        """
+        return SimulatedFile(self, open(path, mode))
+
+    def sync(self):
+        """
+        Flush the drive, waiting for every outstanding write first
+        """
+        self._occupy(self.flush_latency)
+
+    def account_write(self, length):
+        """
+        Block the calling thread for as long as the simulated drive needs to store length bytes
+
+        :param length: Amount of bytes written
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._busy_until)
+
+            # Cache is folded into the slow flash while the drive sits idle
+            if self.cache_used:
+                self.cache_used = max(0, self.cache_used - int((start - self._busy_until) * self.bandwidth))
+
+            cached = min(length, self.slc_cache_size - self.cache_used)
+            self.cache_used += cached
+
+            duration = self.write_latency + cached / self.slc_bandwidth + (length - cached) / self.bandwidth
+
+            self._busy_until = start + duration
+            self.bytes_written += length
+            deadline = self._busy_until
+
+        _sleep_until(deadline)
+
+    def _occupy(self, duration):
+        with self._lock:
+            self._busy_until = max(time.monotonic(), self._busy_until) + duration
+            deadline = self._busy_until
+
+        _sleep_until(deadline)
+
+
+class SimulatedFile:
+    """
+    File object whose writes are throttled by a SimulatedUSBStick
+    """
+
+    def __init__(self, device, file):
+        self.device = device
+        self.file = file
+
+    def write(self, data):
+        self.device.account_write(len(data))
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        self.file.close()
+        self.device._occupy(self.device.flush_latency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _sleep_until(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def benchmark(source_directory, target_directory, device):
+    """
+    Run the copy engine of core from source_directory into target_directory on a simulated drive
+
+    :param source_directory: Directory that stands in for the mounted source filesystem
+    :param target_directory: Existing directory that stands in for the mounted target filesystem
+    :param device: SimulatedUSBStick used as target backend
+    :return: Elapsed time in seconds
+    """
+    import WoeUSB.core as core
+
+    utils.bind_job(core.Installer(source_directory, target_directory, target_backend=device))
+    start = time.monotonic()
+    try:
+        core.copy_filesystem_files(source_directory, target_directory)
+        device.sync()
+    finally:
+        utils.bind_job(None)
+
+    return time.monotonic() - start
+
+
+def run():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark WoeUSB's copy engine against a simulated slow USB storage device.")
+    parser.add_argument("source", help="Directory to copy from, e.g. a mounted Windows ISO")
+    parser.add_argument("target", help="Empty directory to copy into")
+    parser.add_argument("--bandwidth", default="2M", type=utils.parse_size,
+                        help="Sustained write bandwidth per second (default: 2M)")
+    parser.add_argument("--write-latency", default=0.002, type=float,
+                        help="Latency of every write request in seconds (default: 0.002)")
+    parser.add_argument("--slc-cache", default="0", type=utils.parse_size,
+                        help="Size of the fast SLC write cache, 0 disables it (default: 0)")
+    parser.add_argument("--slc-bandwidth", default=None, type=utils.parse_size,
+                        help="Write bandwidth while the SLC cache isn't exhausted (default: 4 times --bandwidth)")
+    parser.add_argument("--flush-latency", default=0.05, type=float,
+                        help="Latency of closing a file or flushing the device in seconds (default: 0.05)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source) or not os.path.isdir(args.target):
+        utils.print_with_color(_("Error: Both source and target have to be existing directories"), "red")
+        return 1
+
+    device = SimulatedUSBStick(args.bandwidth, args.write_latency, args.slc_cache, args.slc_bandwidth,
+                               args.flush_latency)
+
+    elapsed = benchmark(args.source, args.target, device)
+
+    utils.print_with_color(
+        _("Wrote {0} in {1:.1f} seconds ({2}/s)").format(
+            utils.convert_to_human_readable_format(device.bytes_written),
+            elapsed,
+            utils.convert_to_human_readable_format(device.bytes_written / elapsed if elapsed else 0)),
+        "green")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
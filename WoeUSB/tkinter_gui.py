@@ -4,14 +4,53 @@ import tkinter as tk
 import subprocess
 import threading
 import queue
+import time
 import os
+import re
 import shutil
 
 # Assuming list_devices is in the same directory or accessible
 try:
     from . import list_devices
+    from . import progress
 except ImportError:
     import list_devices
+    import progress
+
+# Share of the progress bar (start, end) given to every stage reported by `woeusb --json-progress`, in the order
+# the stages are entered: the source is mounted before the target is wiped, ripping waits for the rip of a disc
+# after that.  "mounting" is entered again for the target and "partitioning" again to grow a flashed image, the
+# bar never moves back for those
+STAGE_PROGRESS = {
+    "init": (0, 2),
+    "mounting": (2, 4),
+    "wiping": (4, 5),
+    "discarding": (5, 6),
+    "ripping": (6, 10),
+    "partitioning": (10, 12),
+    "formatting": (12, 15),
+    "copying": (15, 85),
+    "flashing": (15, 80),
+    "verifying": (80, 90),
+    "bootloader": (85, 90),
+    "flushing": (90, 98),
+    "finished": (98, 98),
+}
+
+# The log widget keeps only this many most recent lines
+LOG_MAX_LINES = 2000
+
+# Interval in milliseconds between two passes of the queue pump, roughly one frame
+QUEUE_PUMP_INTERVAL = 50
+
+# Progress lines printed by the CLI, these update the status line instead of piling up in the log
+PROGRESS_LINE = re.compile(r"^(Copied .* from a total of .*|[0-9]+%)$")
+
+# Prefix the privileged helper puts in front of the messages of every job
+HELPER_JOB_PREFIX = re.compile(r"^\[job-[0-9]+\] ")
+
+# Seconds to wait for the privileged helper to come up, including the time spent in the pkexec dialog
+HELPER_START_TIMEOUT = 120
 
 class WoeUSBtkinter(tk.Tk):
     def __init__(self):
@@ -82,10 +121,13 @@ class WoeUSBtkinter(tk.Tk):
         self.iso_path = tk.StringVar()
         self.target_device = tk.StringVar()
         self.devices = []
+        # Privileged helper process (woeusbd) of this session, see ensure_helper()
+        self.helper = None
 
         self._create_widgets()
         self._bind_zoom_keys()
-        self.refresh_devices()
+        # lsblk is slow on some systems, don't let it delay the first paint
+        self.after_idle(self.refresh_devices)
 
     def increase_font(self):
         '''Make the font 2 points bigger'''
@@ -164,6 +206,10 @@ class WoeUSBtkinter(tk.Tk):
         self.progress = ttk.Progressbar(main_frame, orient=tk.HORIZONTAL, length=100, mode='determinate')
         self.progress.pack(fill=tk.X, pady=5)
 
+        # --- Status line ---
+        self.status = tk.StringVar()
+        ttk.Label(main_frame, textvariable=self.status, anchor='w').pack(fill=tk.X, pady=(0, 5))
+
         # --- Log ---
         tk.Label(main_frame, text="Log", font=self.header_font, anchor='w').pack(anchor='w', padx=4)
         log_container = ttk.Frame(main_frame, borderwidth=1, relief="sunken", padding="10")
@@ -223,8 +269,20 @@ class WoeUSBtkinter(tk.Tk):
             messagebox.showerror("Device Error", f"Could not list devices. Make sure 'lsblk' and 'udisksctl' are installed.\nError: {e}")
 
     def log(self, message):
+        self.log_lines([message])
+
+    def log_lines(self, messages):
+        """Append several lines to the log at once, dropping the oldest ones beyond LOG_MAX_LINES"""
+        if not messages:
+            return
+
         self.log_text.configure(state='normal')
-        self.log_text.insert(tk.END, message + '\n')
+        self.log_text.insert(tk.END, '\n'.join(messages) + '\n')
+
+        line_count = int(self.log_text.index('end-1c').split('.')[0]) - 1
+        if line_count > LOG_MAX_LINES:
+            self.log_text.delete('1.0', f'{line_count - LOG_MAX_LINES + 1}.0')
+
         self.log_text.configure(state='disabled')
         self.log_text.see(tk.END)
 
@@ -256,6 +314,7 @@ class WoeUSBtkinter(tk.Tk):
 
         self.install_button.config(state="disabled")
         self.progress['value'] = 0
+        self.status.set("")
         self.log("Starting installation...")
 
         self.queue = queue.Queue()
@@ -264,16 +323,87 @@ class WoeUSBtkinter(tk.Tk):
             args=(iso, selected_device_path)
         )
         self.thread.start()
-        self.after(100, self.process_queue)
+        self.after(QUEUE_PUMP_INTERVAL, self.process_queue)
+
+    def ensure_helper(self):
+        """Start the privileged helper (woeusbd) once per session, returns its socket path or None if unavailable"""
+        daemon = _import_daemon()
+        socket_path = daemon.helper_socket_path(os.getuid())
+
+        if _helper_alive(daemon, socket_path):
+            return socket_path
+
+        if not shutil.which('pkexec') or not shutil.which('woeusbd'):
+            return None
+
+        # The helper exits once its stdin, held open by this process, is closed
+        self.helper = subprocess.Popen(
+            ['pkexec', 'woeusbd', '--socket', socket_path, '--exit-with-stdin'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+        threading.Thread(target=self._pump_helper_output, args=(self.helper.stdout,), daemon=True).start()
+
+        deadline = time.monotonic() + HELPER_START_TIMEOUT
+        while self.helper.poll() is None and time.monotonic() < deadline:
+            if _helper_alive(daemon, socket_path):
+                return socket_path
+            time.sleep(0.1)
+        return None
+
+    def _pump_helper_output(self, stream):
+        # Messages of all jobs of the session, the current install's queue shows them
+        for line in iter(stream.readline, ''):
+            self.queue.put(HELPER_JOB_PREFIX.sub('', line))
+        stream.close()
+
+    def run_helper_job(self, socket_path, iso, device):
+        """Run the install through the helper, returns its exit status or None if the helper refuses the job"""
+        daemon = _import_daemon()
+        try:
+            # The helper reads the image through this descriptor, it doesn't open paths for the session's user
+            source_fd = os.open(iso, os.O_RDONLY | os.O_CLOEXEC)
+            try:
+                reply = list(daemon.request(socket_path, 'submit', fds=[source_fd],
+                                            arguments=['--device', iso, device]))[0]
+            finally:
+                os.close(source_fd)
+            if reply.get("refused"):
+                self.queue.put(f"INFO: {reply['error']}")
+                return None
+            if "error" in reply:
+                self.queue.put(f"ERROR: {reply['error']}")
+                return 1
+
+            rc = 1
+            for event in daemon.request(socket_path, 'watch', job=reply["job"]["id"]):
+                self.queue.put(event)
+                if event["event"] == "finished":
+                    rc = event["status"]
+            return rc
+        except (OSError, ValueError, IndexError) as e:
+            self.queue.put(f"ERROR: Lost connection to the privileged helper: {e}")
+            return 1
 
     def run_woeusb_process(self, iso, device):
+        # Structured progress events arrive on stderr, everything else is logged as is
+        def _pump_stderr(stream):
+            for line in iter(stream.readline, ''):
+                event = progress.parse_event(line)
+                self.queue.put(event if event is not None else line)
+            stream.close()
+
         # Helper to run a command and stream output to the GUI
         def _run_and_stream(cmd, stdin_text=None):
+            cmd = cmd + ['--json-progress']
             try:
                 process = subprocess.Popen(
                     cmd,
                     stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
+                    stderr=subprocess.PIPE,
                     text=True,
                     bufsize=1,
                     universal_newlines=True,
@@ -289,10 +419,13 @@ class WoeUSBtkinter(tk.Tk):
                         process.stdin.close()
                     except Exception:
                         pass
+                stderr_thread = threading.Thread(target=_pump_stderr, args=(process.stderr,), daemon=True)
+                stderr_thread.start()
                 for line in iter(process.stdout.readline, ''):
                     self.queue.put(line)
                 process.stdout.close()
                 process.wait()
+                stderr_thread.join()
                 return process.returncode
             except FileNotFoundError:
                 return 127
@@ -305,16 +438,18 @@ class WoeUSBtkinter(tk.Tk):
             rc = _run_and_stream(['woeusb', '--device', iso, device])
         else:
             rc = None
-            # 2) Try pkexec if available
-            if shutil.which('pkexec'):
-                rc = _run_and_stream(['pkexec', 'woeusb', '--device', iso, device])
-                if rc != 0:
-                    self.queue.put("INFO: pkexec failed or was canceled; trying sudo...")
+            # 2) Hand the job to the privileged helper, started via pkexec on the first install of the session
+            socket_path = self.ensure_helper()
+            if socket_path is not None:
+                rc = self.run_helper_job(socket_path, iso, device)
+                if rc is None:
+                    # Not a job the helper runs unauthenticated, this install authenticates on its own
+                    rc = _run_and_stream(['pkexec', 'woeusb', '--device', iso, device])
             else:
-                self.queue.put("INFO: pkexec not found; trying sudo...")
+                self.queue.put("INFO: privileged helper unavailable or canceled; trying sudo...")
 
             # 3) Fallback to sudo -S (prompt user for password)
-            if rc is None or rc != 0:
+            if socket_path is None:
                 pw = None
                 try:
                     pw = simpledialog.askstring(
@@ -334,39 +469,94 @@ class WoeUSBtkinter(tk.Tk):
         else:
             self.queue.put(f"ERROR: Installation failed with return code {rc}.")
 
+    def handle_progress_event(self, event):
+        if event["event"] == "stage":
+            start = STAGE_PROGRESS.get(event["stage"], (0, 0))[0]
+            self.progress['value'] = max(float(self.progress['value']), start)
+        elif event["event"] == "progress" and event.get("total"):
+            start, end = STAGE_PROGRESS.get(event["stage"], (0, 0))
+            fraction = min(event["done"] / event["total"], 1)
+            self.progress['value'] = max(float(self.progress['value']), start + (end - start) * fraction)
+
+            # Imported once progress shows up, it isn't worth slowing down the start of the window
+            from WoeUSB.utils import convert_to_human_readable_format as size
+
+            status = f"{event['stage'].capitalize()}: {size(event['done'])} of {size(event['total'])}"
+            if event.get("rate"):
+                status += f", {size(event['rate'])}/s"
+            if event.get("eta") is not None:
+                status += f", {int(event['eta']) // 60}:{int(event['eta']) % 60:02d} left"
+            self.status.set(status)
+        # Warnings and errors are printed on stdout as well, so they already are in the log
+
     def process_queue(self):
+        # Drain everything queued since the last frame and touch the widgets only once
+        thread_alive = self.thread.is_alive()
+        lines = []
+        last_progress_event = None
+        outcome = None
         try:
             while True:
-                line = self.queue.get_nowait()
-                self.log(line.strip())
-                # Simple progress parsing
-                if "Erasing" in line:
-                    self.progress['value'] = 10
-                elif "Partitioning" in line:
-                    self.progress['value'] = 25
-                elif "Copying" in line:
-                    self.progress['value'] = 50
-                elif "Installing bootloader" in line:
-                    self.progress['value'] = 85
-                elif "Installation succeeded" in line:
-                    self.progress['value'] = 100
-                    self.install_button.config(state="normal")
-                    messagebox.showinfo("Success", "The USB drive has been successfully created!")
+                item = self.queue.get_nowait()
+                if isinstance(item, dict):
+                    if item["event"] == "progress":
+                        last_progress_event = item
+                    else:
+                        self.handle_progress_event(item)
+                    continue
+
+                line = item.strip()
+                if PROGRESS_LINE.match(line):
+                    self.status.set(line)
+                    continue
+
+                lines.append(line)
+                if "Installation succeeded" in line:
+                    outcome = "success"
                 elif "ERROR:" in line:
-                    self.progress['value'] = 0
-                    self.install_button.config(state="normal")
-                    messagebox.showerror("Failed", f"Installation failed. Check the log for details.")
-
+                    outcome = "failure"
         except queue.Empty:
-            if self.thread.is_alive():
-                self.after(100, self.process_queue)
-            else: # Thread finished
-                self.install_button.config(state="normal")
+            pass
+
+        if last_progress_event is not None:
+            self.handle_progress_event(last_progress_event)
+        self.log_lines(lines)
+
+        if outcome == "success":
+            self.progress['value'] = 100
+            self.install_button.config(state="normal")
+            messagebox.showinfo("Success", "The USB drive has been successfully created!")
+        elif outcome == "failure":
+            self.progress['value'] = 0
+            self.install_button.config(state="normal")
+            messagebox.showerror("Failed", f"Installation failed. Check the log for details.")
+
+        if thread_alive:
+            self.after(QUEUE_PUMP_INTERVAL, self.process_queue)
+        else:  # Thread finished and everything it queued has been shown
+            self.install_button.config(state="normal")
+
+
+def _import_daemon():
+    # The helper protocol pulls in the whole installer, so it is imported only once an installation starts
+    try:
+        from . import daemon
+    except ImportError:
+        import daemon
+    return daemon
+
+
+def _helper_alive(daemon, socket_path):
+    try:
+        list(daemon.request(socket_path, 'status'))
+        return True
+    except (OSError, ValueError):
+        return False
 
 
 def main():
     """Main function to run the Tkinter GUI."""
-    # Run the GUI unprivileged; elevation is handled per-operation via pkexec.
+    # Run the GUI unprivileged; installs go through a privileged helper started once via pkexec.
     app = WoeUSBtkinter()
     app.mainloop()
 
@@ -1,10 +1,8 @@
 import os
-import pathlib
 import re
-import shutil
 import subprocess
 import sys
-from xml.dom.minidom import parseString
+import threading
 
 import WoeUSB.miscellaneous as miscellaneous
 
@@ -18,20 +16,71 @@ try:
     import termcolor
 except ImportError:
     print("Module termcolor is not installed, text coloring disabled")
+    termcolor = None
     no_color = True
 
 gui = None
 verbose = False
 
+#: Structured progress output (see WoeUSB.progress), enabled by --progress-fd/--json-progress
+progress_reporter = None
+
+#: Job (core.Installer) each thread works for, see bind_job()
+_job_context = threading.local()
+
+
+def bind_job(job):
+    """
+    Bind job to the calling thread, messages, progress and cancellation of the thread are then routed to it and
+    the thread (with the processes it spawns) takes over the job's niceness and I/O priority
+
+    :param job: core.Installer, None unbinds
+    """
+    _job_context.job = job
+
+    previous = getattr(_job_context, "priority", None)
+    if previous is not None:
+        import WoeUSB.priority as priority
+
+        priority.restore(previous)
+        _job_context.priority = None
+
+    if getattr(job, "nice", None) is not None or getattr(job, "io_priority", None) is not None:
+        import WoeUSB.priority as priority
+
+        _job_context.priority = priority.apply(job.nice, job.io_priority)
+
+
+def current_job():
+    """
+    :return: Job bound to the calling thread, None if there is none
+    """
+    return getattr(_job_context, "job", None)
+
+
+def job_setting(name):
+    """
+    Setting of the job bound to the calling thread, falls back to the module level default of the same name
+
+    :param name: One of gui, verbose, no_color, progress_reporter
+    :return: Value of the setting
+    """
+    value = getattr(current_job(), name, None)
+    if value is None:
+        value = globals()[name]
+    return value
+
 
 def check_runtime_dependencies(application_name):
     """
     :param application_name:
     :return:
     """
+    import shutil
+
     result = "success"
 
-    system_commands = ["mount", "umount", "wipefs", "lsblk", "blockdev", "df", "parted", "7z"]
+    system_commands = ["mount", "umount", "losetup", "wipefs", "lsblk", "blockdev", "df", "parted", "7z"]
     for command in system_commands:
         if shutil.which(command) is None:
             print_with_color(
@@ -77,11 +126,14 @@ def check_runtime_dependencies(application_name):
 def check_runtime_parameters(install_mode, source_media, target_media):
     """
     :param install_mode:
-    :param source_media:
+    :param source_media: None skips the check of the source, e.g. when it has been read already
     :param target_media:
     :return:
     """
-    if not os.path.isfile(source_media) and not pathlib.Path(source_media).is_block_device():
+    import pathlib
+
+    if source_media is not None and not os.path.isfile(source_media) \
+            and not pathlib.Path(source_media).is_block_device():
         print_with_color(
             _("Error: Source media \"{0}\" not found or not a regular file or a block device file!").format(
                 source_media),
@@ -92,16 +144,38 @@ def check_runtime_parameters(install_mode, source_media, target_media):
         print_with_color(_("Error: Target media \"{0}\" is not a block device file!").format(target_media), "red")
         return 1
 
-    if install_mode == "device" and target_media[-1].isdigit():
+    if install_mode == "device" and is_partition(target_media):
         print_with_color(_("Error: Target media \"{0}\" is not an entire storage device!").format(target_media), "red")
         return 1
 
-    if install_mode == "partition" and not target_media[-1].isdigit():
+    if install_mode == "partition" and not is_partition(target_media):
         print_with_color(_("Error: Target media \"{0}\" is not an partition!").format(target_media), "red")
         return 1
     return 0
 
 
+def is_partition(media):
+    """
+    :param media: Block device file, e.g. /dev/sdb, /dev/sdb1 or /dev/loop0
+    :return: Whether media is a partition rather than an entire device
+    """
+    sysfs = "/sys/class/block/" + os.path.basename(os.path.realpath(media))
+    if os.path.isdir(sysfs):
+        return os.path.exists(sysfs + "/partition")
+    return media[-1].isdigit()
+
+
+def partition_path(target_device, number):
+    """
+    :param target_device: Entire device, e.g. /dev/sdb or /dev/loop0
+    :param number: Partition number
+    :return: Partition device file, e.g. /dev/sdb1 or /dev/loop0p1
+    """
+    if target_device[-1].isdigit():
+        return target_device + "p" + str(number)
+    return target_device + str(number)
+
+
 def determine_target_parameters(install_mode, target_media):
     """
     :param install_mode:
@@ -116,9 +190,9 @@ def determine_target_parameters(install_mode, target_media):
         target_device = target_media
     else:
         target_device = target_media
-        target_partition = target_media + str(1)
+        target_partition = partition_path(target_media, 1)
 
-    if verbose:
+    if job_setting("verbose"):
         print_with_color(_("Info: Target device is {0}").format(target_device))
         print_with_color(_("Info: Target partition is {0}").format(target_partition))
 
@@ -143,12 +217,12 @@ def check_is_target_device_busy(device):
 def check_source_and_target_not_busy(install_mode, source_media, target_device, target_partition):
     """
     :param install_mode:
-    :param source_media:
+    :param source_media: None skips the check of the source, e.g. when it is shared and already mounted by us
     :param target_device:
     :param target_partition:
     :return:
     """
-    if check_is_target_device_busy(source_media):
+    if source_media is not None and check_is_target_device_busy(source_media):
         print_with_color(_("Error: Source media is currently mounted, unmount the partition then try again"), "red")
         return 1
 
@@ -166,28 +240,6 @@ def check_source_and_target_not_busy(install_mode, source_media, target_device,
             return 1
 
 
-def check_fat32_filesize_limitation(source_fs_mountpoint):
-    """
-    :param source_fs_mountpoint:
-    :return:
-    """
-    for dirpath, dirnames, filenames in os.walk(source_fs_mountpoint):
-        for file in filenames:
-            path = os.path.join(dirpath, file)
-            if os.path.getsize(path) > (2 ** 32) - 1:  # Max fat32 file size
-                print_with_color(
-                    _(
-                        "Warning: File {0} in source image has exceed the FAT32 Filesystem 4GiB Single File Size Limitation, swiching to NTFS filesystem.").format(
-                        path),
-                    "yellow")
-                print_with_color(
-                    _(
-                        "Refer: https://github.com/slacka/WoeUSB/wiki/Limitations#fat32-filesystem-4gib-single-file-size-limitation for more info."),
-                    "yellow")
-                return 1
-    return 0
-
-
 def check_target_partition(target_partition, target_device):
     """
     Check target partition for potential problems before mounting them for --partition creation mode as we don't know about the existing partition
@@ -203,10 +255,10 @@ def check_target_partition(target_partition, target_device):
 
     if target_filesystem == "vfat":
         pass  # supported
-    elif target_filesystem == "ntfs":
+    elif target_filesystem in ["ntfs", "exfat"]:
         check_uefi_ntfs_support_partition(target_device)
     else:
-        print_with_color(_("Error: Target filesystem not supported, currently supported filesystem: FAT, NTFS."), "red")
+        print_with_color(_("Error: Target filesystem not supported, currently supported filesystem: FAT, NTFS, exFAT."), "red")
         return 1
 
     return 0
@@ -233,11 +285,13 @@ def check_uefi_ntfs_support_partition(target_device):
             _("Info: You may recreate disk with an UEFI:NTFS partition by using the --device creation method"))
 
 
-def check_target_filesystem_free_space(target_fs_mountpoint, source_fs_mountpoint, target_partition):
+def check_target_filesystem_free_space(target_fs_mountpoint, source_fs_mountpoint, target_partition,
+                                       source_size=None):
     """
     :param target_fs_mountpoint:
     :param source_fs_mountpoint:
     :param target_partition:
+    :param source_size: Total size of the source files if already known, saves walking the source filesystem
     :return:
     """
     df = subprocess.run(["df",
@@ -251,11 +305,10 @@ def check_target_filesystem_free_space(target_fs_mountpoint, source_fs_mountpoin
     free_space = re.sub("[^0-9]", "", free_space)
     free_space = int(free_space)
 
-    needed_space = 0
-    for dirpath, dirnames, filenames in os.walk(source_fs_mountpoint):
-        for file in filenames:
-            path = os.path.join(dirpath, file)
-            needed_space += os.path.getsize(path)
+    if source_size is not None:
+        needed_space = source_size
+    else:
+        needed_space = get_size(source_fs_mountpoint)
 
     additional_space_required_for_grub_installation = 1000 * 1000 * 10  # 10MiB
 
@@ -283,18 +336,41 @@ def print_with_color(text, color=""):
     :param text: Text to be printed
     :param color: Color of the text
     """
-    if gui is not None:
-        gui.state = text
+    reporter = job_setting("progress_reporter")
+    if reporter is not None:
+        if color == "red":
+            reporter.error(text)
+        elif color == "yellow":
+            reporter.warning(text)
+
+    job_gui = job_setting("gui")
+    if job_gui is not None:
+        job_gui.state = text
         if color == "red":
-            gui.error = text
+            job_gui.error = text
             sys.exit()
     else:
-        if no_color or color == "":
-            sys.stdout.write(text + "\n")
+        job = current_job()
+        if job is not None and job.name:
+            text = "[" + job.name + "] " + str(text)
+
+        if job_setting("no_color") or color == "" or termcolor is None:
+            sys.stdout.write(str(text) + "\n")
         else:
             termcolor.cprint(text, color)
 
 
+def report_stage(stage):
+    """
+    Let structured progress output know that installation entered a new stage
+
+    :param stage: One of WoeUSB.progress.STAGES
+    """
+    reporter = job_setting("progress_reporter")
+    if reporter is not None:
+        reporter.stage(stage)
+
+
 def convert_to_human_readable_format(num, suffix='B'):
     for unit in ['', 'Ki', 'Mi', 'Gi']:
         if abs(num) < 1024.0:
@@ -303,6 +379,21 @@ def convert_to_human_readable_format(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Ti', suffix)
 
 
+def parse_size(size):
+    """
+    Convert human written size (2M, 512KiB, 1.5G) into number of bytes
+
+    :param size: String to be converted
+    :return: int
+    """
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)(i?B)?\s*", str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError(_("Invalid size: {0}").format(size))
+
+    multiplier = 1024 ** " KMGT".index(match.group(2).upper() or " ")
+    return int(float(match.group(1)) * multiplier)
+
+
 def get_size(path):
     total_size = 0
     for dirpath, __, filenames in os.walk(path):
@@ -320,14 +411,22 @@ def check_kill_signal():
     So, here, if gui is set, we throw exception which is going to be (hopefully) catch by GUI,
     simultaneously ending whatever script was doing meantime!
     Everyone goes to home happy and user is left with wrecked pendrive (just joking, next thing called by gui is cleanup)
+    The same goes for jobs cancelled through core.Installer.cancel()
     """
-    if gui is not None:
-        if gui.kill:
+    job = current_job()
+    if job is not None and job.cancelled:
+        raise sys.exit()
+
+    job_gui = job_setting("gui")
+    if job_gui is not None:
+        if job_gui.kill:
             raise sys.exit()
 
 
 # noinspection DuplicatedCode
 def update_policy_to_allow_for_running_gui_as_root(path):
+    from xml.dom.minidom import parseString
+
     dom = parseString(
         "<?xml version=\"1.0\" ?>"
         "<!DOCTYPE policyconfig  PUBLIC '-//freedesktop//DTD polkit Policy Configuration 1.0//EN'  "
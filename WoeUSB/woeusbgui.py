@@ -22,14 +22,14 @@ You should have received a copy of the GNU General Public License
 along with WoeUSB-ng  If not, see <http://www.gnu.org/licenses/>.
 +"""
 
-import subprocess
 import sys
 import os
 
 def main():
     # print('running main2')
     if os.getuid() != 0:
-        subprocess.run(["pkexec", os.path.realpath(__file__)])
+        # Replace this unprivileged interpreter instead of idling in it until the privileged one exits
+        os.execvp("pkexec", ["pkexec", os.path.realpath(__file__)])
     else:
         try:
             import WoeUSB.gui
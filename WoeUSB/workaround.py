@@ -67,11 +67,11 @@ def support_windows_7_uefi_boot(source_fs_mountpoint, target_fs_mountpoint):
 
     if test_efi_directory == "":
         efi_directory = target_fs_mountpoint + "/efi"
-        if utils.verbose:
+        if utils.job_setting("verbose"):
             utils.print_with_color(_("DEBUG: Can't find efi directory, use {0}").format(efi_directory), "yellow")
     else:
         efi_directory = test_efi_directory
-        if utils.verbose:
+        if utils.job_setting("verbose"):
             utils.print_with_color(_("DEBUG: {0} detected.").format(efi_directory), "yellow")
 
     test_efi_boot_directory = subprocess.run(["find", target_fs_mountpoint, "-ipath", target_fs_mountpoint + "/boot"],
@@ -79,11 +79,11 @@ def support_windows_7_uefi_boot(source_fs_mountpoint, target_fs_mountpoint):
 
     if test_efi_boot_directory == "":
         efi_boot_directory = target_fs_mountpoint + "/boot"
-        if utils.verbose:
+        if utils.job_setting("verbose"):
             utils.print_with_color(_("DEBUG: Can't find efi/boot directory, use {0}").format(efi_boot_directory), "yellow")
     else:
         efi_boot_directory = test_efi_boot_directory
-        if utils.verbose:
+        if utils.job_setting("verbose"):
             utils.print_with_color(_("DEBUG: {0} detected.").format(efi_boot_directory), "yellow")
 
     # If there's already an EFI bootloader existed, skip the workaround
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+Target write modes of the copy engine, see core.Installer.open_target_file()
+
+* paced: buffered writes, but writeback of every file is started right behind the writer (sync_file_range) and
+  the target filesystem is synced every PACING_WINDOW bytes, so dirty memory stays bounded, progress follows what
+  really is on the stick and umount doesn't have minutes of hidden flushing left to do
+* direct: O_DIRECT writes from a pool of page aligned buffers sized to the device's optimal I/O size, the page
+  cache isn't touched at all.  Some filesystems (vfat among them) quietly fall back to buffered I/O for direct
+  writes extending a file, so direct writes are paced like paced ones: on a real direct write there is nothing
+  left to write back, on a fallback dirty memory stays bounded
+"""
+
+import os
+import mmap
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+
+#: Buffer size when the device doesn't report its optimal I/O size
+DEFAULT_IO_SIZE = 1024 * 1024
+
+#: Bytes written to the target filesystem between two syncs in paced mode
+PACING_WINDOW = 32 * 1024 * 1024
+
+_SYNC_FILE_RANGE_WRITE = 2
+
+_libc = None
+
+
+def _c_library():
+    global _libc
+
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.sync_file_range.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_uint]
+        _libc.syncfs.argtypes = [ctypes.c_int]
+    return _libc
+
+
+def optimal_io_size(device):
+    """
+    :param device: Block device or partition, e.g. /dev/sdb
+    :return: Preferred size of write requests in bytes, a multiple of the page size
+    """
+    size = 0
+    if device is not None:
+        queue = "/sys/class/block/" + os.path.basename(device) + "/queue"
+        if not os.path.isdir(queue):  # Partitions share the queue of their device
+            queue = os.path.realpath("/sys/class/block/" + os.path.basename(device)) + "/../queue"
+
+        for attribute in ["optimal_io_size", "minimum_io_size"]:
+            try:
+                with open(os.path.join(queue, attribute)) as file:
+                    size = int(file.read())
+            except (OSError, ValueError):
+                continue
+            if size:
+                break
+
+    size = max(size, DEFAULT_IO_SIZE)
+    return (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+
+
+class BufferPool:
+    """
+    Page aligned (anonymous mmap) buffers, as required by O_DIRECT
+    """
+
+    def __init__(self, size, count=2):
+        self.size = size
+        self._free = [mmap.mmap(-1, size) for __ in range(count)]
+        self._all = list(self._free)
+
+    def acquire(self):
+        if self._free:
+            return self._free.pop()
+
+        buffer = mmap.mmap(-1, self.size)
+        self._all.append(buffer)
+        return buffer
+
+    def release(self, buffer):
+        self._free.append(buffer)
+
+    def close(self):
+        for buffer in self._all:
+            buffer.close()
+        self._all = []
+        self._free = []
+
+
+class DirectFile:
+    """
+    Write-only file opened with O_DIRECT, data is collected into an aligned buffer and written a buffer at a time
+    """
+
+    def __init__(self, path, pool, pacer=None):
+        """
+        :param path: Path of the file to be created
+        :param pool: BufferPool to take the buffer from
+        :param pacer: WritebackPacer accounting the writes, see module documentation
+        :raise OSError: Filesystem doesn't support O_DIRECT
+        """
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+        self.pool = pool
+        self.pacer = pacer
+        self.buffer = pool.acquire()
+        self.fill = 0
+        self.offset = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            length = min(len(view), self.pool.size - self.fill)
+            self.buffer[self.fill:self.fill + length] = view[:length]
+            self.fill += length
+            view = view[length:]
+
+            if self.fill == self.pool.size:
+                self._write_buffer(self.fill)
+                self.fill = 0
+        return len(data)
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        try:
+            # Aligned part of the tail goes directly, the rest through the page cache
+            aligned = self.fill // mmap.PAGESIZE * mmap.PAGESIZE
+            if aligned:
+                self._write_buffer(aligned)
+            if self.fill > aligned:
+                fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+                os.write(self.fd, memoryview(self.buffer)[aligned:self.fill])
+                os.fdatasync(self.fd)
+        finally:
+            self.pool.release(self.buffer)
+            os.close(self.fd)
+            self.fd = None
+
+    def _write_buffer(self, length):
+        start = self.offset
+        view = memoryview(self.buffer)[:length]
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+            self.offset += written
+
+        # Nothing to do unless the filesystem buffered the write after all
+        _c_library().sync_file_range(self.fd, start, self.offset - start, _SYNC_FILE_RANGE_WRITE)
+        if self.pacer is not None:
+            self.pacer.account(self.offset - start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class WritebackPacer:
+    """
+    Syncs the target filesystem every window bytes written into it
+    """
+
+    def __init__(self, mountpoint, window=PACING_WINDOW):
+        self.mountpoint = mountpoint
+        self.window = window
+        self.pending = 0
+
+    def account(self, length):
+        """
+        :param length: Bytes just written into the target filesystem
+        """
+        self.pending += length
+        if self.pending >= self.window:
+            self.flush()
+
+    def flush(self):
+        """
+        Wait until everything written so far is on the device
+        """
+        self.pending = 0
+        sync_filesystem(self.mountpoint)
+
+
+def sync_filesystem(mountpoint):
+    """
+    Write everything cached for the filesystem mounted at mountpoint to its device and wait for it (syncfs(2))
+
+    :param mountpoint: Any path inside the filesystem
+    """
+    try:
+        fd = os.open(mountpoint, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        os.sync()
+        return
+
+    try:
+        if _c_library().syncfs(fd) != 0:
+            os.sync()
+    finally:
+        os.close(fd)
+
+
+class PacedFile:
+    """
+    Buffered write-only file that starts writeback of every write immediately and is paced by a WritebackPacer
+    """
+
+    def __init__(self, path, pacer):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.pacer = pacer
+        self.offset = 0
+        #: copy_from() falls back to sendfile(2) once the kernel refuses copy_file_range(2) between the filesystems
+        self.copy_file_range = True
+
+    def write(self, data):
+        view = memoryview(data)
+        start = self.offset
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+            self.offset += written
+
+        self._written(start)
+        return len(data)
+
+    def copy_from(self, fd, offset, length):
+        """
+        Append length bytes of another file without passing them through user space
+
+        :param fd: File descriptor of a regular file
+        :param offset: Position of the bytes in it
+        """
+        start = self.offset
+        while length > 0:
+            try:
+                if self.copy_file_range:
+                    copied = os.copy_file_range(fd, self.fd, length, offset)
+                else:
+                    copied = os.sendfile(self.fd, fd, offset, length)
+            except OSError as error:
+                if not self.copy_file_range or error.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                                                                   errno.EOPNOTSUPP):
+                    raise
+                self.copy_file_range = False
+                continue
+
+            if copied == 0:
+                raise OSError(errno.EIO, "Source file ends before the bytes to be copied")
+            offset += copied
+            length -= copied
+            self.offset += copied
+
+        self._written(start)
+
+    def _written(self, start):
+        # Asynchronous, the pacer's sync then has (almost) nothing left to wait for
+        _c_library().sync_file_range(self.fd, start, self.offset - start, _SYNC_FILE_RANGE_WRITE)
+        self.pacer.account(self.offset - start)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -63,6 +63,9 @@ setup(
         'gui_scripts': [
             'woeusbgui = WoeUSB.tkinter_gui:main',
         ],
+        'console_scripts': [
+            'woeusbd = WoeUSB.daemon:run',
+        ],
     },
     scripts=[
         'WoeUSB/woeusb',
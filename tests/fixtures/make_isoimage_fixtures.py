@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+Build the images tests/test_isoimage.py reads: udf.iso.gz (UDF 2.60 bridge with ISO9660 and Joliet), joliet.iso.gz
+(ISO9660 with Joliet) and iso9660.iso.gz (plain ISO9660), all holding test_isoimage.FILES
+
+Requires pycdlib (pip install pycdlib), run from anywhere.
+"""
+
+import io
+import os
+import sys
+import gzip
+
+import pycdlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(HERE), os.path.dirname(os.path.dirname(HERE))]
+
+from test_isoimage import FILES
+
+
+def iso9660_path(path):
+    """
+    :return: Level 1 style ISO9660 name of path: upper case, 8.3, version ;1 for files
+    """
+    parts = [part.upper().replace(" ", "_") for part in path.split("/")]
+    return "/" + "/".join(part[:8] for part in parts)
+
+
+def iso9660_file_path(path):
+    directory, __, name = path.rpartition("/")
+    stem, __, extension = name.upper().replace(" ", "_").rpartition(".")
+    prefix = iso9660_path(directory) + "/" if directory else "/"
+    return prefix + stem[:8] + "." + extension[:3] + ";1"
+
+
+def build(name, udf, joliet):
+    image = pycdlib.PyCdlib()
+    image.new(interchange_level=3, joliet=3 if joliet else None, udf="2.60" if udf else None)
+
+    directories = sorted({"/".join(path.split("/")[:index]) for path in FILES
+                          for index in range(1, path.count("/") + 1)})
+    for directory in directories:
+        paths = dict(iso_path=iso9660_path(directory))
+        if joliet:
+            paths["joliet_path"] = "/" + directory
+        if udf:
+            paths["udf_path"] = "/" + directory
+        image.add_directory(**paths)
+
+    for path, data in FILES.items():
+        paths = dict(iso_path=iso9660_file_path(path))
+        if joliet:
+            paths["joliet_path"] = "/" + path
+        if udf:
+            paths["udf_path"] = "/" + path
+        image.add_fp(io.BytesIO(data), len(data), **paths)
+
+    output = io.BytesIO()
+    image.write_fp(output)
+    image.close()
+
+    with gzip.GzipFile(os.path.join(HERE, name + ".gz"), "wb", mtime=0) as compressed:
+        compressed.write(output.getvalue())
+
+
+if __name__ == "__main__":
+    build("udf.iso", udf=True, joliet=True)
+    build("joliet.iso", udf=False, joliet=True)
+    build("iso9660.iso", udf=False, joliet=False)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+"""
+Tests of the max-min fair split of WoeUSB.bandwidth
+"""
+
+import unittest
+
+import WoeUSB.bandwidth as bandwidth
+
+
+class MaxMinFairTest(unittest.TestCase):
+    def test_unlimited_capacity(self):
+        self.assertEqual(bandwidth._max_min_fair(None, [10, None, 30]), [None, None, None])
+
+    def test_no_demands(self):
+        self.assertEqual(bandwidth._max_min_fair(100, []), [])
+
+    def test_equal_split(self):
+        self.assertEqual(bandwidth._max_min_fair(90, [None, None, None]), [30, 30, 30])
+        self.assertEqual(bandwidth._max_min_fair(90, [50, 40, None]), [30, 30, 30])
+
+    def test_small_demands_satisfied_first(self):
+        # The slow stick keeps what it can use, the rest is split between the others
+        self.assertEqual(bandwidth._max_min_fair(100, [10, None, None]), [10, 45, 45])
+        self.assertEqual(bandwidth._max_min_fair(100, [60, 10, 20]), [60, 10, 20])
+        self.assertEqual(bandwidth._max_min_fair(100, [80, 10, 20]), [70, 10, 20])
+
+    def test_order_kept(self):
+        rates = bandwidth._max_min_fair(120, [None, 5, 100, 15])
+        self.assertEqual(rates, [50, 5, 50, 15])
+        self.assertLessEqual(sum(rates), 120)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+Tests of where WoeUSB.capacity writes its samples
+"""
+
+import unittest
+
+import WoeUSB.capacity as capacity
+
+KiB = 1024
+MiB = 1024 * KiB
+GiB = 1024 * MiB
+
+
+class SampleOffsetsTest(unittest.TestCase):
+    def check_offsets(self, device_size, size=capacity.SAMPLE_SIZE, samples=capacity.SAMPLES):
+        offsets = capacity.sample_offsets(device_size, samples, size)
+
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertGreaterEqual(len(offsets), samples)
+        self.assertLessEqual(len(offsets), 2 * samples + 1)
+
+        # Power of two spacing, the last sample ends at the last whole block
+        steps = {second - first for first, second in zip(offsets[:-2], offsets[1:-1])}
+        self.assertEqual(len(steps), 1)
+        step = steps.pop()
+        self.assertEqual(step & (step - 1), 0)
+        self.assertGreaterEqual(step, size)
+        self.assertEqual(offsets[-1], device_size // capacity.BLOCK_SIZE * capacity.BLOCK_SIZE - size)
+
+        # Aligned, not overlapping, nothing past the end
+        for offset in offsets:
+            self.assertEqual(offset % capacity.BLOCK_SIZE, 0)
+        for first, second in zip(offsets, offsets[1:]):
+            self.assertGreaterEqual(second - first, size)
+        self.assertGreaterEqual(offsets[0], 0)
+        self.assertLessEqual(offsets[-1] + size, device_size)
+        return offsets
+
+    def test_sizes(self):
+        for device_size in [64 * MiB, 1 * GiB, 8 * GiB - 512, 15 * GiB + 123 * 512, 256 * GiB, 2 * 1024 * GiB]:
+            for size in [capacity.MINIMAL_SAMPLE_SIZE, capacity.SAMPLE_SIZE, capacity.MAXIMAL_SAMPLE_SIZE]:
+                with self.subTest(device_size=device_size, size=size):
+                    self.check_offsets(device_size, size)
+
+    def test_start_is_random(self):
+        starts = {capacity.sample_offsets(8 * GiB)[0] for __ in range(50)}
+        self.assertGreater(len(starts), 1)
+
+    def test_sample_size(self):
+        self.assertEqual(capacity.sample_size(0), capacity.SAMPLE_SIZE)
+        self.assertEqual(capacity.sample_size(8 * KiB), capacity.MINIMAL_SAMPLE_SIZE)
+        self.assertEqual(capacity.sample_size(3 * 128 * KiB), 512 * KiB)
+        self.assertEqual(capacity.sample_size(16 * MiB), capacity.MAXIMAL_SAMPLE_SIZE)
+
+    def test_write_order(self):
+        offsets = capacity.sample_offsets(16 * GiB)
+        order = capacity.write_order(offsets)
+
+        self.assertEqual(sorted(order), offsets)
+        self.assertEqual(order[0], offsets[-1])
+        # Any prefix cut short by the time budget is still spread over the whole device
+        spaced = offsets[:-1]
+        for count in [2, 4, 8, 16]:
+            prefix = sorted(order[1:count + 1])
+            self.assertEqual(prefix, spaced[::len(spaced) // count][:count])
+
+
+if __name__ == "__main__":
+    unittest.main()
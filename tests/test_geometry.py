@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""
+Tests of the capacity tables and overrides of WoeUSB.geometry, on a device that doesn't exist in sysfs
+"""
+
+import unittest
+from unittest import mock
+
+import WoeUSB.geometry as geometry
+
+KiB = geometry.KiB
+MiB = geometry.MiB
+GiB = geometry.GiB
+
+
+class GeometryTest(unittest.TestCase):
+    def detect(self, filesystem_type, capacity, io_hint=0, **overrides):
+        with mock.patch.object(geometry, "_capacity", return_value=capacity), \
+                mock.patch.object(geometry, "_io_hint", return_value=io_hint):
+            return geometry.detect("/dev/woeusb-test", filesystem_type, **overrides)
+
+    def test_fat32_clusters_by_capacity(self):
+        for capacity, cluster_size in [(2 * GiB, 4 * KiB), (8 * GiB, 4 * KiB), (8 * GiB + 512, 8 * KiB),
+                                       (16 * GiB, 8 * KiB), (31 * GiB, 16 * KiB), (64 * GiB, 32 * KiB),
+                                       (2 * 1024 * GiB, 32 * KiB)]:
+            with self.subTest(capacity=capacity):
+                self.assertEqual(self.detect("FAT", capacity).cluster_size, cluster_size)
+
+    def test_exfat_clusters_by_capacity(self):
+        for capacity, cluster_size in [(128 * MiB, 4 * KiB), (16 * GiB, 32 * KiB), (64 * GiB, 128 * KiB)]:
+            with self.subTest(capacity=capacity):
+                self.assertEqual(self.detect("EXFAT", capacity).cluster_size, cluster_size)
+
+    def test_ntfs_clusters(self):
+        self.assertEqual(self.detect("NTFS", 64 * GiB).cluster_size, geometry.NTFS_CLUSTER_SIZE)
+        self.assertEqual(self.detect("NTFS", 64 * GiB, io_hint=1 * MiB).cluster_size, geometry.MAXIMAL_NTFS_CLUSTER)
+
+    def test_io_hint(self):
+        chosen = self.detect("FAT", 8 * GiB, io_hint=12 * MiB)
+
+        self.assertEqual(chosen.alignment, geometry.MAXIMAL_ALIGNMENT)
+        self.assertEqual(chosen.cluster_size, geometry.MAXIMAL_FAT32_CLUSTER)
+        self.assertEqual(chosen.chunk_size % chosen.alignment, 0)
+
+        chosen = self.detect("FAT", 8 * GiB, io_hint=6 * MiB)
+        self.assertEqual(chosen.alignment, 8 * MiB)
+        self.assertEqual(chosen.chunk_size, 8 * MiB)
+
+    def test_no_hint(self):
+        chosen = self.detect("FAT", 8 * GiB)
+
+        self.assertEqual(chosen.alignment, geometry.MINIMAL_ALIGNMENT)
+        self.assertEqual(chosen.chunk_size, geometry.MINIMAL_CHUNK_SIZE)
+
+    def test_overrides(self):
+        chosen = self.detect("FAT", 64 * GiB, alignment=1 * MiB, cluster_size=4 * KiB, chunk_size=3 * MiB)
+        self.assertEqual((chosen.alignment, chosen.cluster_size, chosen.chunk_size), (1 * MiB, 4 * KiB, 3 * MiB))
+
+    def test_invalid_overrides(self):
+        self.assertIsNone(self.detect("FAT", 8 * GiB, alignment=512 * KiB))
+        self.assertIsNone(self.detect("FAT", 8 * GiB, alignment=1 * MiB + 100))
+        self.assertIsNone(self.detect("FAT", 8 * GiB, cluster_size=12 * KiB))
+        self.assertIsNone(self.detect("FAT", 8 * GiB, cluster_size=64 * KiB))
+        self.assertIsNotNone(self.detect("EXFAT", 8 * GiB, cluster_size=64 * KiB))
+
+    def test_minimal_size(self):
+        chosen = self.detect("FAT", 64 * GiB)
+
+        self.assertGreater(geometry.minimal_size("FAT", chosen),
+                           geometry.MINIMAL_FAT32_CLUSTERS * chosen.cluster_size + chosen.alignment)
+        self.assertEqual(geometry.minimal_size("NTFS", chosen), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+Tests of WoeUSB.grubcache: a replayed installation must match what grub-install writes onto a fresh target
+
+Needs root, loop devices with partition scanning, parted, mkfs.vfat and grub-install (or grub2-install) for i386-pc,
+skipped otherwise.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import WoeUSB.core as core
+import WoeUSB.utils as utils
+import WoeUSB.grubcache as grubcache
+
+COMMAND_GRUBINSTALL = shutil.which("grub-install") or shutil.which("grub2-install")
+NAME_GRUB_PREFIX = "grub" if COMMAND_GRUBINSTALL is None or "grub2" not in COMMAND_GRUBINSTALL else "grub2"
+
+TARGET_SIZE = 64 * 1024 * 1024
+PARTITION_START = 4 * 1024 * 1024
+
+
+def _available():
+    return os.geteuid() == 0 and COMMAND_GRUBINSTALL is not None \
+        and all(shutil.which(command) for command in ["parted", "mkfs.vfat", "losetup"])
+
+
+@unittest.skipUnless(_available(), "needs root, loop devices, parted, mkfs.vfat and grub-install")
+class GRUBCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="WoeUSB-test.")
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = os.path.join(self.directory, "cache")
+
+    def make_target(self, name):
+        """
+        :return: (device, partition, mountpoint) of a loop device holding an msdos label and a FAT32 partition
+        """
+        image = os.path.join(self.directory, name + ".img")
+        with open(image, "wb") as file:
+            file.truncate(TARGET_SIZE)
+
+        device = subprocess.run(["losetup", "--find", "--show", "--partscan", image], stdout=subprocess.PIPE,
+                                check=True).stdout.decode().strip()
+        self.addCleanup(subprocess.run, ["losetup", "--detach", device])
+
+        subprocess.run(["parted", "--script", device, "mklabel", "msdos", "mkpart", "primary", "fat32",
+                        str(PARTITION_START // 1024) + "KiB", "100%"], check=True)
+        if shutil.which("partx"):
+            subprocess.run(["partx", "--update", device])
+        partition = utils.partition_path(device, 1)
+        if not os.path.exists(partition):
+            self.skipTest("loop device partitions aren't available")
+        subprocess.run(["mkfs.vfat", "-F", "32", partition], stdout=subprocess.DEVNULL, check=True)
+
+        mountpoint = os.path.join(self.directory, name)
+        os.mkdir(mountpoint)
+        subprocess.run(["mount", partition, mountpoint], check=True)
+        self.addCleanup(subprocess.run, ["umount", mountpoint])
+        return device, partition, mountpoint
+
+    def install(self, target, grub_cache):
+        device, partition, mountpoint = target
+        core.install_legacy_pc_bootloader_grub(mountpoint, device, COMMAND_GRUBINSTALL, partition, NAME_GRUB_PREFIX,
+                                               grub_cache)
+        subprocess.run(["sync"])
+
+    def boot_area(self, device):
+        """
+        :return: Boot code of the MBR and the gap between the MBR and the partition, where the core image is
+        """
+        with open(device, "rb") as file:
+            data = file.read(PARTITION_START)
+        return data[:grubcache.BOOT_CODE_SIZE], data[grubcache.SECTOR_SIZE:]
+
+    def test_replay_matches_grub_install(self):
+        stored = self.make_target("stored")
+        self.install(stored, self.cache)
+        key = grubcache.GRUBCache(self.cache).key(COMMAND_GRUBINSTALL, stored[0], stored[1], NAME_GRUB_PREFIX)
+        self.assertIsNotNone(grubcache.GRUBCache(self.cache).lookup(key), "installation wasn't cached")
+
+        replayed = self.make_target("replayed")
+        self.install(replayed, self.cache)
+
+        fresh = self.make_target("fresh")
+        self.install(fresh, None)
+
+        self.assertEqual(self.boot_area(replayed[0]), self.boot_area(fresh[0]))
+        for root, __, names in os.walk(os.path.join(fresh[2], NAME_GRUB_PREFIX)):
+            for name in names:
+                path = os.path.relpath(os.path.join(root, name), fresh[2])
+                with open(os.path.join(fresh[2], path), "rb") as expected, \
+                        open(os.path.join(replayed[2], path), "rb") as actual:
+                    self.assertEqual(actual.read(), expected.read(), path)
+
+    def test_other_disk_not_cached(self):
+        target = self.make_target("target")
+        other = self.make_target("other")
+
+        self.assertFalse(grubcache.on_device(other[0], target[1]))
+        self.assertIsNotNone(grubcache.GRUBCache(self.cache).store("key", other[0], target[1], target[2],
+                                                                   NAME_GRUB_PREFIX))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""
+Tests of WoeUSB.httpsource against a local stand-in HTTP server, and of the NBD request loop of WoeUSB.blockexport
+"""
+
+import errno
+import socket
+import threading
+import unittest
+import http.server
+
+import WoeUSB.httpsource as httpsource
+import WoeUSB.blockexport as blockexport
+
+BLOCK_SIZE = 4096
+#: Image with a short final block
+DATA = bytes((index * 7 + index // 4099) % 256 for index in range(3 * BLOCK_SIZE + 1000))
+LAST_MODIFIED = "Mon, 19 Oct 2026 00:00:00 GMT"
+
+
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves DATA at /image.iso with range requests and If-Range, /redirect redirects to it
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/image.iso")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path != "/image.iso":
+            self.send_error(404)
+            return
+
+        server = self.server
+        etag = server.etag
+        validator = etag if etag is not None and not etag.startswith("W/") else LAST_MODIFIED
+        if_range = self.headers.get("If-Range")
+        byte_range = self.headers.get("Range")
+
+        if byte_range is None or (if_range is not None and if_range != validator):
+            self.send_response(200)
+            self.send_headers(len(DATA))
+            self.wfile.write(DATA)
+            return
+
+        start, end = byte_range[len("bytes="):].split("-")
+        start, end = int(start), min(int(end), len(DATA) - 1)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, len(DATA)))
+        self.send_headers(end + 1 - start)
+        self.wfile.write(DATA[start:end + 1])
+
+    def send_headers(self, length):
+        if self.server.etag is not None:
+            self.send_header("ETag", self.server.etag)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+        self.server.daemon_threads = True
+        self.server.etag = '"image-1"'
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def open(self, path="/image.iso", **options):
+        options.setdefault("block_size", BLOCK_SIZE)
+        options.setdefault("cache_blocks", 2)
+        options.setdefault("prefetch_blocks", 1)
+        options.setdefault("connections", 2)
+        reader = httpsource.HTTPReader("http://127.0.0.1:{0}{1}".format(self.server.server_port, path), **options)
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_reads_across_blocks(self):
+        reader = self.open()
+
+        self.assertEqual(reader.size, len(DATA))
+        for offset, length in [(BLOCK_SIZE - 10, 20), (0, len(DATA)), (1, 2 * BLOCK_SIZE), (BLOCK_SIZE, BLOCK_SIZE),
+                               (5000, 3), (0, 1)]:
+            self.assertEqual(reader.read(offset, length), DATA[offset:offset + length], (offset, length))
+
+    def test_sequential_reads(self):
+        reader = self.open()
+
+        data = b"".join(reader.read(offset, 1000) for offset in range(0, len(DATA), 1000))
+        self.assertEqual(data, DATA)
+
+    def test_short_final_block(self):
+        reader = self.open()
+
+        self.assertEqual(reader.read(len(DATA) - 100, BLOCK_SIZE), DATA[-100:])
+        self.assertEqual(reader.read(len(DATA), 10), b"")
+
+    def test_redirect(self):
+        reader = self.open("/redirect")
+
+        self.assertTrue(reader.url.endswith("/image.iso"))
+        self.assertEqual(reader.read(0, len(DATA)), DATA)
+
+    def test_strong_etag_validator(self):
+        self.assertEqual(self.open().validator, '"image-1"')
+
+    def test_weak_etag_falls_back_to_last_modified(self):
+        self.server.etag = 'W/"image-1"'
+        reader = self.open()
+
+        self.assertEqual(reader.validator, LAST_MODIFIED)
+        self.assertEqual(reader.read(0, len(DATA)), DATA)
+
+    def test_changed_image_fails_read(self):
+        reader = self.open(prefetch_blocks=0)
+        self.assertEqual(reader.read(0, 10), DATA[:10])
+
+        # The server now answers If-Range with the whole (new) image
+        self.server.etag = '"image-2"'
+        with self.assertRaises(OSError):
+            reader.read(2 * BLOCK_SIZE, 10)
+
+    def test_block_export_serve(self):
+        reader = self.open()
+        export = blockexport.BlockExport(reader, workers=2)
+        kernel_socket, server_socket = socket.socketpair()
+        self.addCleanup(kernel_socket.close)
+        self.addCleanup(server_socket.close)
+        thread = threading.Thread(target=export.serve, args=(server_socket,), daemon=True)
+        thread.start()
+
+        def request(command, handle, offset=0, length=0):
+            kernel_socket.sendall(blockexport._REQUEST.pack(blockexport.NBD_REQUEST_MAGIC, command, handle, offset,
+                                                            length))
+
+        def reply(length=0):
+            header = blockexport._receive(kernel_socket, blockexport._REPLY.size)
+            magic, error, handle = blockexport._REPLY.unpack(header)
+            self.assertEqual(magic, blockexport.NBD_REPLY_MAGIC)
+            return error, handle, blockexport._receive(kernel_socket, length) if length and not error else b""
+
+        request(blockexport.NBD_CMD_READ, b"read-001", BLOCK_SIZE - 512, 1024)
+        self.assertEqual(reply(1024), (0, b"read-001", DATA[BLOCK_SIZE - 512:BLOCK_SIZE + 512]))
+
+        # The device is rounded up to whole blocks, the end is padded with zeros
+        end = len(DATA) // 512 * 512
+        request(blockexport.NBD_CMD_READ, b"read-002", end, 512)
+        self.assertEqual(reply(512), (0, b"read-002", DATA[end:] + bytes(512 - (len(DATA) - end))))
+
+        request(1, b"write-01", 0, 0)  # NBD_CMD_WRITE
+        self.assertEqual(reply(), (errno.EPERM, b"write-01", b""))
+
+        request(blockexport.NBD_CMD_FLUSH, b"flush-01")
+        self.assertEqual(reply(), (0, b"flush-01", b""))
+
+        request(blockexport.NBD_CMD_DISC, b"disc-001")
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
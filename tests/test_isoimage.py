@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Tests of WoeUSB.isoimage against small images in fixtures/, see fixtures/make_isoimage_fixtures.py
+"""
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+import WoeUSB.isoimage as isoimage
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def pattern(size, seed):
+    """
+    :return: size bytes of content that differs between seeds and compresses well
+    """
+    return bytes((index * seed + index // 251) % 256 for index in range(size))
+
+
+#: Files of every fixture image, path -> content
+FILES = {
+    "setup.exe": pattern(5000, 1),
+    "sources/boot.wim": pattern(300000, 2),
+    "sources/long name file.txt": b"",
+    "efi/boot/bootx64.efi": pattern(2049, 3),
+    "sources/sxs/a.cab": pattern(4096, 5),
+}
+
+#: Directories of every fixture image
+DIRECTORIES = ["efi", "efi/boot", "sources", "sources/sxs"]
+
+
+class ISOImageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="WoeUSB-test.")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_fixture(self, name):
+        path = os.path.join(self.directory, name)
+        with gzip.open(os.path.join(FIXTURES, name + ".gz"), "rb") as compressed, open(path, "wb") as image:
+            shutil.copyfileobj(compressed, image)
+
+        image = isoimage.ISOImage(isoimage.ImageReader(path))
+        self.addCleanup(image.reader.close)
+        return image
+
+    def contents(self, image):
+        return {file.path: b"".join(isoimage.read_chunks(image.reader, file.extents, 7000))
+                for file in image.files}
+
+    def test_udf(self):
+        image = self.open_fixture("udf.iso")
+
+        self.assertEqual(image.filesystem, "UDF")
+        self.assertEqual(sorted(image.directories), DIRECTORIES)
+        self.assertEqual(self.contents(image), FILES)
+        self.assertEqual(image.size, sum(len(data) for data in FILES.values()))
+
+    def test_joliet(self):
+        image = self.open_fixture("joliet.iso")
+
+        self.assertEqual(image.filesystem, "Joliet")
+        self.assertEqual(sorted(image.directories), DIRECTORIES)
+        self.assertEqual(self.contents(image), FILES)
+
+    def test_iso9660(self):
+        image = self.open_fixture("iso9660.iso")
+
+        # Plain ISO9660 names are upper case 8.3, the content is the same
+        self.assertEqual(image.filesystem, "ISO9660")
+        self.assertEqual(sorted(self.contents(image).values()), sorted(FILES.values()))
+
+    def test_sizes_match_extents(self):
+        for name in ["udf.iso", "joliet.iso", "iso9660.iso"]:
+            image = self.open_fixture(name)
+            for file in image.files:
+                self.assertEqual(file.size, sum(length for __, length in file.extents), file.path)
+
+    def test_not_a_filesystem(self):
+        path = os.path.join(self.directory, "zeros.img")
+        with open(path, "wb") as image:
+            image.truncate(1024 * 1024)
+
+        reader = isoimage.ImageReader(path)
+        self.addCleanup(reader.close)
+        with self.assertRaises(isoimage.FilesystemError):
+            isoimage.ISOImage(reader)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Tests of the copy engine of WoeUSB.core writing through a WoeUSB.simulated_device.SimulatedUSBStick target backend,
+from a source directory and from a source image read by the parse backend
+"""
+
+import os
+import gzip
+import time
+import shutil
+import tempfile
+import unittest
+
+import WoeUSB.core as core
+import WoeUSB.utils as utils
+import WoeUSB.simulated_device as simulated_device
+
+from test_isoimage import FILES, FIXTURES, pattern
+
+MiB = 1024 * 1024
+
+#: Files of the source directory, install.wim is big enough for the large file path of the copy engine
+DIRECTORY_FILES = {
+    "setup.exe": pattern(10000, 1),
+    "boot/bcd": b"",
+    "sources/install.wim": pattern(6 * MiB + 123, 2),
+    "efi/boot/bootx64.efi": pattern(4096, 3),
+}
+
+
+class SimulatedDeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="WoeUSB-test.")
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.target = os.path.join(self.directory, "target")
+        os.mkdir(self.target)
+        self.addCleanup(utils.bind_job, None)
+
+    def target_files(self):
+        files = {}
+        for dirpath, __, filenames in os.walk(self.target):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with open(path, "rb") as file:
+                    files[os.path.relpath(path, self.target)] = file.read()
+        return files
+
+    def test_copy_directory(self):
+        source = os.path.join(self.directory, "source")
+        for path, data in DIRECTORY_FILES.items():
+            os.makedirs(os.path.dirname(os.path.join(source, path)), exist_ok=True)
+            with open(os.path.join(source, path), "wb") as file:
+                file.write(data)
+
+        size = sum(len(data) for data in DIRECTORY_FILES.values())
+        device = simulated_device.SimulatedUSBStick(bandwidth=64 * MiB, write_latency=0, flush_latency=0)
+        installer = core.Installer(source, self.target, target_backend=device)
+        utils.bind_job(installer)
+
+        start = time.monotonic()
+        core.copy_filesystem_files(source, self.target)
+        device.sync()
+
+        self.assertEqual(self.target_files(), DIRECTORY_FILES)
+        self.assertEqual(device.bytes_written, size)
+        self.assertEqual((installer.bytes_copied, installer.bytes_total), (size, size))
+        # Writes are throttled to the bandwidth of the stick
+        self.assertGreaterEqual(time.monotonic() - start, size / device.bandwidth)
+
+    def test_copy_parsed_image(self):
+        image = os.path.join(self.directory, "udf.iso")
+        with gzip.open(os.path.join(FIXTURES, "udf.iso.gz"), "rb") as compressed, open(image, "wb") as file:
+            shutil.copyfileobj(compressed, file)
+
+        device = simulated_device.SimulatedUSBStick(bandwidth=16 * MiB, write_latency=0, flush_latency=0)
+        installer = core.Installer(image, self.target, target_backend=device, source_backend="parse")
+        utils.bind_job(installer)
+
+        self.assertEqual(installer.open_source(), 0)
+        self.addCleanup(installer.source_image.reader.close)
+        core.copy_image_files(installer.source_image, self.target)
+
+        self.assertEqual(self.target_files(), FILES)
+        self.assertEqual(device.bytes_written, sum(len(data) for data in FILES.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
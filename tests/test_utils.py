@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+"""
+Tests of helpers of WoeUSB.utils
+"""
+
+import unittest
+
+import WoeUSB.utils as utils
+
+
+class ParseSizeTest(unittest.TestCase):
+    def test_units(self):
+        for text, size in [("0", 0), ("512", 512), ("2K", 2048), ("2M", 2 * 1024 ** 2), ("1.5G", 3 * 1024 ** 3 // 2),
+                           ("1T", 1024 ** 4), ("512KiB", 512 * 1024), ("4MB", 4 * 1024 ** 2), (" 8 m ", 8 * 1024 ** 2),
+                           ("16kib", 16 * 1024), (4096, 4096)]:
+            with self.subTest(text=text):
+                self.assertEqual(utils.parse_size(text), size)
+
+    def test_invalid(self):
+        for text in ["", "M", "2X", "-1M", "2 M B", "1e3"]:
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    utils.parse_size(text)
+
+
+if __name__ == "__main__":
+    unittest.main()
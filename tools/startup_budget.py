@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Measure startup time of the woeusb CLI and the GUI against a time budget
+
+Every command is run several times and the median wall-clock time is compared with its budget,
+then an import-time report (python -X importtime) lists the slowest imports of each entry point.
+
+Exits with 1 if any command fails or is over budget.  The GUI needs a display ($DISPLAY).  Launching through
+woeusbgui isn't measured: it re-executes itself through pkexec, which starts a second interpreter behind the
+authentication dialog.  Run from the repository root: python3 tools/startup_budget.py
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RUNS = 5
+
+CLI = "import sys, WoeUSB.core; sys.argv[0] = 'woeusb'; WoeUSB.core.run()"
+
+#: Builds the main window, paints it once and quits instead of entering the main loop
+GUI = "import WoeUSB.tkinter_gui; app = WoeUSB.tkinter_gui.WoeUSBtkinter(); app.update(); app.destroy()"
+
+#: (description, python arguments, extra environment, budget in seconds)
+BUDGETS = [
+    ("woeusb --version", ["-c", CLI, "--version"], {}, 0.15),
+    ("woeusb --about", ["-c", CLI, "--about"], {}, 0.2),
+    ("GUI first paint", ["-c", GUI], {}, 1.5),
+]
+
+#: (description, module whose import is profiled)
+IMPORT_REPORTS = [
+    ("woeusb", "WoeUSB.core"),
+    ("GUI", "WoeUSB.tkinter_gui"),
+]
+
+
+def measure(arguments, environment):
+    """
+    :return: (median seconds, None) of the runs, (None, last line of its error output) if a run failed
+    """
+    env = dict(os.environ, **environment)
+    timings = []
+    for __ in range(RUNS):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable] + arguments, env=env, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True)
+        timings.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            lines = result.stderr.strip().splitlines()
+            return None, lines[-1] if lines else "exit status " + str(result.returncode)
+    return statistics.median(timings), None
+
+
+def import_report(module, limit=15):
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), int(self_time), name.rstrip()))
+
+    imports.sort(reverse=True)
+    return imports[:limit]
+
+
+def main():
+    failed = False
+
+    print("Startup budget (median of {0} runs)".format(RUNS))
+    for description, arguments, environment, budget in BUDGETS:
+        elapsed, error = measure(arguments, environment)
+        if error is not None:
+            failed = True
+            print("  {0:<20} FAILED: {1}".format(description, error))
+            continue
+
+        status = "ok" if elapsed <= budget else "OVER BUDGET"
+        failed = failed or elapsed > budget
+        print("  {0:<20} {1:7.1f} ms / {2:7.1f} ms  {3}".format(description, elapsed * 1000, budget * 1000, status))
+
+    for description, module in IMPORT_REPORTS:
+        print()
+        print("Slowest imports of {0} ({1}), cumulative / self in ms".format(description, module))
+        for cumulative, self_time, name in import_report(module):
+            print("  {0:8.1f} {1:8.1f}  {2}".format(cumulative / 1000, self_time / 1000, name))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())